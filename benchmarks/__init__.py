@@ -0,0 +1,4 @@
+"""
+Benchmarks of tasks C1 and C3 on a synthetic corpus in the layout of the ASAP dataset.
+Run them with python -m benchmarks from the root of the repository.
+"""
@@ -0,0 +1,45 @@
+"""
+Run the benchmark suite: python -m benchmarks [--sizes 100 1000 ...] [--baseline baseline.json [--save-baseline]]
+The exit status is 1 when a stage regresses past the baseline.
+"""
+import argparse
+import sys
+
+from benchmarks.suite import DEFAULT_SIZES, DEFAULT_TOLERANCE, RUNNER_MAX_SIZE, find_regressions, format_results, \
+    load_baseline, run_benchmarks, save_baseline
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="number of beats of the synthetic pieces")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of each stage")
+    parser.add_argument("--reader", choices=("native", "music21"), default="native",
+                        help="MIDI reader of the MIDI stages")
+    parser.add_argument("--runner-max-size", type=int, default=RUNNER_MAX_SIZE,
+                        help="largest size for which the whole dataset runners are timed")
+    parser.add_argument("--work-dir", help="directory of the corpus and of the feature cache")
+    parser.add_argument("--baseline", help="JSON file of the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="a stage regresses when it is slower than tolerance times its baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.repeat, args.reader, args.runner_max_size, args.work_dir,
+                             lambda size, stage, seconds: print(f"{size:>8} {stage:<18} {seconds * 1000:10.2f}ms",
+                                                                file=sys.stderr))
+    print(format_results(results))
+    if args.baseline is None:
+        return 0
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f"Baseline stored in {args.baseline}")
+        return 0
+    regressions = find_regressions(results, load_baseline(args.baseline), args.tolerance)
+    for stage, size, seconds, reference in regressions:
+        print(f"REGRESSION {stage} at {size} beats: {seconds * 1000:.2f}ms, baseline {reference * 1000:.2f}ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
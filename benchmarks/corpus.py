@@ -0,0 +1,227 @@
+"""
+This module contains the generator of the synthetic corpus used by the benchmarks.
+Each piece has the layout of an ASAP piece folder:
+- midi_score_annotations.txt and PerfN_annotations.txt, one "onset onset beat_type[,meter[,key]]" line per beat,
+  with meter and key changes
+- midi_score.mid, the notes of the score on a quarter grid, built from repeated motifs so that task C3 finds patterns
+- PerfN.mid, the same notes played with the tempo curve of the performance annotations
+"""
+import os
+import struct
+
+import numpy as np
+
+METERS = ("4/4", "3/4", "2/4")
+SCORE_BPM = 100
+PERFORMANCE_BPM = 120
+PPQ = 480
+
+
+def write_variable_length(value: int) -> bytes:
+    """
+    Encode a variable length quantity
+    :param value: int
+    :return: bytes
+    """
+    result = [value & 0x7F]
+    value >>= 7
+    while value:
+        result.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(result))
+
+
+def write_track(events: list) -> bytes:
+    """
+    Encode a MTrk chunk
+    :param events: list of (tick, order, bytes of the event), sorted in place by tick then order
+    :return: bytes
+    """
+    events.sort(key=lambda event: (event[0], event[1]))
+    data = bytearray()
+    tick = 0
+    for event_tick, _, event in events:
+        data += write_variable_length(event_tick - tick)
+        data += event
+        tick = event_tick
+    data += b"\x00\xff\x2f\x00"
+    return b"MTrk" + struct.pack(">I", len(data)) + bytes(data)
+
+
+def write_midi_file(midi_file_path: str, pitches: np.ndarray, onsets: np.ndarray, durations: np.ndarray,
+                    velocities: np.ndarray, meters: list[tuple[float, str]], bpm: float):
+    """
+    Write a format 1 MIDI file with a conductor track and a note track
+    :param midi_file_path:
+    :param pitches: MIDI pitch of each note
+    :param onsets: onset of each note in quarter length
+    :param durations: duration of each note in quarter length
+    :param velocities: velocity of each note
+    :param meters: list of (onset in quarter length, meter) of the time signatures
+    :param bpm: tempo of the file
+    :return: None
+    """
+    tempo = round(60000000 / bpm)
+    conductor = [(0, 0, b"\xff\x51\x03" + tempo.to_bytes(3, "big"))]
+    for onset, meter in meters:
+        numerator, denominator = (int(value) for value in meter.split("/"))
+        conductor.append((round(onset * PPQ), 1, bytes([0xFF, 0x58, 0x04, numerator,
+                                                        denominator.bit_length() - 1, 24, 8])))
+    starts = np.rint(np.asarray(onsets) * PPQ).astype(np.int64)
+    ends = np.maximum(np.rint((np.asarray(onsets) + np.asarray(durations)) * PPQ).astype(np.int64), starts + 1)
+    notes = []
+    for start, end, pitch, velocity in zip(starts.tolist(), ends.tolist(), np.asarray(pitches).tolist(),
+                                           np.asarray(velocities).tolist()):
+        # The note offs go before the note ons of the same tick
+        notes.append((start, 1, bytes([0x90, pitch, velocity])))
+        notes.append((end, 0, bytes([0x80, pitch, 0])))
+    with open(midi_file_path, "wb") as f:
+        f.write(b"MThd" + struct.pack(">IHHH", 6, 1, 2, PPQ))
+        f.write(write_track(conductor))
+        f.write(write_track(notes))
+
+
+def make_beats(nb_beats: int, rng: np.random.Generator, meter_change_every: int = 16,
+               key_change_every: int = 32) -> tuple[np.ndarray, list[str], list[tuple[float, str]]]:
+    """
+    Make the beats of the score, one beat per quarter, with a meter change every meter_change_every measures
+    and a key change every key_change_every measures
+    :param nb_beats: number of beats
+    :param rng: random generator
+    :param meter_change_every: number of measures between two meter changes
+    :param key_change_every: number of measures between two key changes
+    :return: onset of each beat in quarter length, label of each beat, list of (onset, meter) of the meter changes
+    """
+    labels = []
+    meter_changes = []
+    meter = METERS[0]
+    key = 0
+    measure = 0
+    while len(labels) < nb_beats:
+        label = "db"
+        if measure % meter_change_every == 0:
+            meter = METERS[int(rng.integers(len(METERS)))] if measure else meter
+            meter_changes.append((float(len(labels)), meter))
+            label = f"db,{meter}"
+        if measure % key_change_every == 0:
+            key = int(rng.integers(-6, 7)) if measure else key
+            label = f"db,{meter},{key}"
+        labels.append(label)
+        labels.extend(["b"] * (int(meter.split("/")[0]) - 1))
+        measure += 1
+    return np.arange(nb_beats, dtype=np.float64), labels[:nb_beats], meter_changes
+
+
+def make_notes(length: float, rng: np.random.Generator, nb_motifs: int = 6, repeat_probability: float = 0.7) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Make the notes of the score, a sequence of motifs, transposed or not, mixed with random notes and chords
+    :param length: length of the score in quarter length
+    :param rng: random generator
+    :param nb_motifs: number of distinct motifs
+    :param repeat_probability: probability to play a motif instead of a random note
+    :return: pitches, onsets, durations and velocities of the notes
+    """
+    motifs = [(rng.integers(60, 73, size=8), rng.choice([0.5, 1.0, 1.5], size=8)) for _ in range(nb_motifs)]
+    pitches = []
+    onsets = []
+    durations = []
+    onset = 0.0
+    while onset < length:
+        if rng.random() < repeat_probability:
+            motif_pitches, motif_durations = motifs[int(rng.integers(nb_motifs))]
+            transposition = int(rng.choice([0, 0, 2, 5, 7]))
+            phrase = zip((motif_pitches + transposition).tolist(), motif_durations.tolist())
+        else:
+            phrase = [(int(rng.integers(55, 81)), float(rng.choice([0.5, 1.0, 1.5, 2.0])))]
+        for pitch, duration in phrase:
+            if onset >= length:
+                break
+            duration = min(duration, length - onset)
+            chord = [pitch, pitch + 4] if rng.random() < 0.2 else [pitch]
+            for chord_pitch in chord:
+                pitches.append(chord_pitch)
+                onsets.append(onset)
+                durations.append(duration)
+            onset += duration
+    velocities = rng.integers(30, 111, size=len(pitches))
+    return np.array(pitches), np.array(onsets), np.array(durations), velocities
+
+
+def make_tempo_curve(nb_beats: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Make the performed onset of each beat, with phrase arcs and a random walk around the score tempo
+    :param nb_beats: number of beats
+    :param rng: random generator
+    :return: np.ndarray of onsets in seconds
+    """
+    beats = np.arange(nb_beats)
+    arcs = 0.15 * np.sin(2 * np.pi * beats / rng.integers(16, 48))
+    walk = np.clip(np.cumsum(rng.normal(0, 0.02, size=nb_beats)), -0.2, 0.2)
+    durations = 60 / SCORE_BPM * (1 + arcs + walk + rng.normal(0, 0.03, size=nb_beats))
+    return np.concatenate(([0.0], np.cumsum(durations)[:-1]))
+
+
+def write_annotations(annotation_path: str, onsets: np.ndarray, labels: list[str]):
+    """
+    Write an annotation file
+    :param annotation_path:
+    :param onsets: onset of each beat in seconds
+    :param labels: label of each beat
+    :return: None
+    """
+    with open(annotation_path, "w") as f:
+        f.writelines(f"{onset:.6f}\t{onset:.6f}\t{label}\n" for onset, label in zip(onsets.tolist(), labels))
+
+
+def make_piece(folder_path: str, nb_beats: int, nb_performances: int = 2, seed: int = 0):
+    """
+    Write a synthetic piece in the layout of the ASAP dataset
+    :param folder_path: path to the piece folder, created if needed
+    :param nb_beats: number of beats of the piece, the number of notes is about the same
+    :param nb_performances: number of performances
+    :param seed: seed of the random generator
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder_path, exist_ok=True)
+    beat_onsets, labels, meter_changes = make_beats(nb_beats, rng)
+    pitches, onsets, durations, velocities = make_notes(float(nb_beats), rng)
+    write_annotations(os.path.join(folder_path, "midi_score_annotations.txt"), beat_onsets * 60 / SCORE_BPM,
+                      labels)
+    write_midi_file(os.path.join(folder_path, "midi_score.mid"), pitches, onsets, durations, velocities,
+                    meter_changes, SCORE_BPM)
+    for performance in range(nb_performances):
+        performed_onsets = make_tempo_curve(nb_beats, rng)
+        write_annotations(os.path.join(folder_path, f"Perf{performance}_annotations.txt"), performed_onsets, labels)
+        # The notes are placed on the tempo curve, in quarter length at the tempo of the performance file
+        end = performed_onsets[-1] + 60 / SCORE_BPM
+        note_starts = np.interp(onsets, np.append(beat_onsets, nb_beats), np.append(performed_onsets, end))
+        note_ends = np.interp(onsets + durations, np.append(beat_onsets, nb_beats), np.append(performed_onsets, end))
+        played_velocities = np.clip(velocities + rng.integers(-10, 11, size=len(velocities)), 1, 127)
+        write_midi_file(os.path.join(folder_path, f"Perf{performance}.mid"), pitches,
+                        note_starts * PERFORMANCE_BPM / 60, (note_ends - note_starts) * PERFORMANCE_BPM / 60,
+                        played_velocities, [(0.0, "4/4")], PERFORMANCE_BPM)
+
+
+def make_corpus(root_path: str, sizes: tuple = (100, 1000), nb_pieces: int = 1, nb_performances: int = 2,
+                seed: int = 0) -> dict:
+    """
+    Write a synthetic corpus, one composer folder per size
+    :param root_path: path to the corpus, created if needed
+    :param sizes: number of beats of the pieces of each size
+    :param nb_pieces: number of pieces of each size
+    :param nb_performances: number of performances of each piece
+    :param seed: seed of the random generators
+    :return: dict of the dataset folder and the piece folders of each size
+    """
+    corpus = {}
+    for size in sizes:
+        dataset_path = os.path.join(root_path, f"Size_{size}").replace("\\", "/")
+        pieces = []
+        for piece in range(nb_pieces):
+            folder_path = f"{dataset_path}/Synthetic/piece_{piece}"
+            make_piece(folder_path, size, nb_performances, seed + 1000 * piece + size)
+            pieces.append(folder_path)
+        corpus[size] = {"dataset": dataset_path, "pieces": pieces}
+    return corpus
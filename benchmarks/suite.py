@@ -0,0 +1,226 @@
+"""
+This module contains the benchmark suite, the timing of every stage of tasks C1 and C3 on synthetic pieces
+of increasing size, the scaling exponent of each stage and the comparison with a stored baseline.
+
+Each stage is timed on the first piece of each size, the inputs of a stage are prepared outside of the timing.
+The whole dataset runners parse the MIDI files with music21, so they are only timed on the small sizes,
+with the feature cache warm. The cold start of a new Python process importing the tasks, and running the
+command line on the annotations only, is timed on the smallest size.
+"""
+import contextlib
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.corpus import make_corpus
+from src import feature_cache
+from src.annotations import load_annotations
+from src.feature_cache import load_note_table
+from src.manifest import load_manifest
+from src.task_c1 import fuse_boundaries_with_table, get_phrase_boundaries, get_tempo_map_db
+from src.task_c3 import extract_onset_groups, find_repeat_positions, run_on_whole_dataset
+from src.task_c4 import run_c1_whole_dataset
+from src.timing_for_one_piece import get_average_timing_statistics
+
+STAGES = ("load_annotations", "averaging", "tempo_map", "phrase_boundaries", "midi_extraction", "repeat_mining",
+          "fusion", "runner_c3", "runner_c1", "cold_start_import", "cold_start_cli")
+RUNNER_STAGES = ("runner_c3", "runner_c1")
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = (100, 1000, 10000, 100000)
+RUNNER_MAX_SIZE = 1000
+# A stage regresses when it is slower than tolerance times its baseline and slower by more than MIN_REGRESSION
+DEFAULT_TOLERANCE = 1.5
+MIN_REGRESSION = 0.005
+
+
+@contextlib.contextmanager
+def temporary_cache(cache_dir: str):
+    """
+    Use another feature cache directory
+    :param cache_dir: the cache directory
+    :return: None
+    """
+    previous = feature_cache.CACHE_DIR
+    feature_cache.CACHE_DIR = cache_dir
+    try:
+        yield
+    finally:
+        feature_cache.CACHE_DIR = previous
+
+
+def run_python(*args: str):
+    """
+    Run a new Python process from the root of the repository, without its output
+    :param args: the arguments of the interpreter, e.g. "-m", "src", "measures", path
+    :return: None
+    """
+    subprocess.run([sys.executable, *args], cwd=REPOSITORY_ROOT, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def get_stage_functions(dataset_path: str, piece_path: str, reader: str = "native", runners: bool = True,
+                        cold_start: bool = False) -> dict:
+    """
+    Prepare the inputs of each stage for a piece
+    :param dataset_path: path to the dataset of the piece, for the runners
+    :param piece_path: path to the piece folder
+    :param reader: MIDI reader of the stages working on a MIDI file, "native" or "music21"
+    :param runners: add the whole dataset runners
+    :param cold_start: add the start of a new process importing the tasks and running the command line
+    :return: dict of the function without argument timed for each stage
+    """
+    score_midi = piece_path + "/midi_score.mid"
+    performance_midi = piece_path + "/Perf0.mid"
+    average, _ = get_average_timing_statistics(piece_path)
+    _, boundaries_times = get_phrase_boundaries(piece_path)
+    groups = extract_onset_groups(score_midi, reader=reader)
+    performance_table = load_note_table(performance_midi, reader=reader)
+    stages = {
+        "load_annotations": lambda: load_annotations(piece_path + "/Perf0_annotations.txt"),
+        "averaging": lambda: get_average_timing_statistics(piece_path),
+        "tempo_map": lambda: get_tempo_map_db(average),
+        "phrase_boundaries": lambda: get_phrase_boundaries(piece_path),
+        "midi_extraction": lambda: load_note_table(score_midi, use_cache=False, reader=reader),
+        "repeat_mining": lambda: find_repeat_positions(groups),
+        "fusion": lambda: fuse_boundaries_with_table(boundaries_times, performance_table),
+    }
+    if runners:
+        manifest = load_manifest(dataset_path, manifest_path="")
+
+        def run_quietly(runner):
+            with contextlib.redirect_stdout(io.StringIO()):
+                runner(dataset_path, manifest=manifest)
+
+        stages["runner_c3"] = lambda: run_quietly(run_on_whole_dataset)
+        stages["runner_c1"] = lambda: run_quietly(run_c1_whole_dataset)
+    if cold_start:
+        stages["cold_start_import"] = lambda: run_python("-c", "import src.task_c1, src.task_c3, src.task_c4")
+        stages["cold_start_cli"] = lambda: run_python("-m", "src", "measures", dataset_path)
+    return stages
+
+
+def time_function(function, repeat: int = 3) -> float:
+    """
+    Time a function
+    :param function: function without argument
+    :param repeat: number of runs
+    :return: the shortest time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmarks(sizes: tuple = DEFAULT_SIZES, repeat: int = 3, reader: str = "native",
+                   runner_max_size: int = RUNNER_MAX_SIZE, work_dir: str = None, progress=None) -> dict:
+    """
+    Generate the synthetic corpus and time every stage for each size
+    :param sizes: number of beats of the pieces
+    :param repeat: number of runs of each stage, the shortest is kept
+    :param reader: MIDI reader of the stages working on a MIDI file, "native" or "music21"
+    :param runner_max_size: largest size for which the runners are timed
+    :param work_dir: directory of the corpus and of the feature cache, a temporary directory by default
+    :param progress: optional callback progress(size, stage, seconds) called when a stage is timed
+    :return: dict of the time in seconds of each stage for each size
+    """
+    with contextlib.ExitStack() as stack:
+        if work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(temporary_cache(os.path.join(work_dir, "cache")))
+        corpus = make_corpus(os.path.join(work_dir, "corpus"), tuple(sizes))
+        results = {stage: {} for stage in STAGES}
+        for size in sizes:
+            runners = size <= runner_max_size
+            stages = get_stage_functions(corpus[size]["dataset"], corpus[size]["pieces"][0], reader, runners,
+                                         size == min(sizes))
+            for stage, function in stages.items():
+                if stage in RUNNER_STAGES:
+                    # Warm the feature cache, the parse of the MIDI files is timed by midi_extraction
+                    function()
+                seconds = time_function(function, repeat)
+                results[stage][size] = seconds
+                if progress is not None:
+                    progress(size, stage, seconds)
+    return results
+
+
+def get_scaling_exponent(stage_results: dict) -> float:
+    """
+    Fit the time of a stage as c * size ** exponent
+    :param stage_results: dict of the time of the stage for each size
+    :return: the exponent, nan with less than two sizes
+    """
+    sizes = [size for size, seconds in stage_results.items() if seconds > 0]
+    if len(sizes) < 2:
+        return math.nan
+    slope, _ = np.polyfit(np.log([float(size) for size in sizes]),
+                          np.log([stage_results[size] for size in sizes]), 1)
+    return float(slope)
+
+
+def format_results(results: dict) -> str:
+    """
+    Format the results as a table of the time of each stage for each size, with its scaling exponent
+    :param results: dict from run_benchmarks
+    :return: str
+    """
+    sizes = sorted({size for stage_results in results.values() for size in stage_results})
+    lines = [f"{'stage':<18}" + "".join(f"{size:>12}" for size in sizes) + f"{'exponent':>10}"]
+    for stage, stage_results in results.items():
+        cells = "".join(f"{stage_results[size] * 1000:>10.2f}ms" if size in stage_results else f"{'-':>12}"
+                        for size in sizes)
+        lines.append(f"{stage:<18}{cells}{get_scaling_exponent(stage_results):>10.2f}")
+    return "\n".join(lines)
+
+
+def save_baseline(results: dict, baseline_path: str):
+    """
+    Store the results as the baseline
+    :param results: dict from run_benchmarks
+    :param baseline_path: path to the JSON file
+    :return: None
+    """
+    with open(baseline_path, "w") as f:
+        json.dump({stage: {str(size): seconds for size, seconds in stage_results.items()}
+                   for stage, stage_results in results.items()}, f, indent=2)
+
+
+def load_baseline(baseline_path: str) -> dict:
+    """
+    Load a baseline stored by save_baseline
+    :param baseline_path: path to the JSON file
+    :return: dict of the time in seconds of each stage for each size
+    """
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    return {stage: {int(size): seconds for size, seconds in stage_results.items()}
+            for stage, stage_results in baseline.items()}
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE,
+                     min_regression: float = MIN_REGRESSION) -> list[tuple[str, int, float, float]]:
+    """
+    Compare the results with a baseline
+    :param results: dict from run_benchmarks
+    :param baseline: dict from load_baseline
+    :param tolerance: a stage regresses when it is slower than tolerance times its baseline
+    :param min_regression: and slower than its baseline by more than min_regression seconds
+    :return: list of (stage, size, seconds, baseline seconds) of the regressions
+    """
+    regressions = []
+    for stage, stage_results in results.items():
+        for size, seconds in stage_results.items():
+            reference = baseline.get(stage, {}).get(size)
+            if reference is not None and seconds > reference * tolerance and seconds - reference > min_regression:
+                regressions.append((stage, size, seconds, reference))
+    return regressions
@@ -0,0 +1,204 @@
+"""
+Run the tasks in batch: python -m src COMMAND PATH [--format json|parquet] [--output PATH]
+The results are written as JSON on the standard output (or in --output), or as a ResultsStore directory of
+Parquet files with --format parquet. The messages of the runners go to the standard error.
+With --shard i/n, the c3, c4 and measures commands only run the pieces of a shard and write a partial file
+in the --output directory, and the merge command combines the partial files of all the shards.
+
+The task modules are imported by the command that needs them, and the plotting libraries and music21 are only
+imported by the render command and by a parse of a MIDI file missing from the feature cache.
+"""
+import argparse
+import contextlib
+import json
+import sys
+
+
+def run_c1(args) -> dict:
+    from src.task_c1 import get_fused_phrase_boundaries, get_phrase_boundaries
+    boundaries, boundaries_times = get_phrase_boundaries(args.path)
+    return {
+        "boundaries": boundaries,
+        "boundaries_times": boundaries_times,
+        "phrase_boundaries": get_fused_phrase_boundaries(args.path, args.threshold_similarity,
+                                                         args.threshold_closest,
+                                                         volume_threshold=args.volume_threshold)
+    }
+
+
+def run_c3(args) -> dict:
+    from src.task_c3 import run_on_whole_dataset
+    return run_on_whole_dataset(args.path, args.workers, args.chunksize, trace_path=args.trace,
+                                results_path=args.results_path, invalidate=args.invalidate,
+                                approximate=args.approximate, shard=args.shard)
+
+
+def run_c4(args) -> dict:
+    from src.task_c4 import run_c1_whole_dataset
+    return run_c1_whole_dataset(args.path, args.workers, args.chunksize, trace_path=args.trace,
+                                results_path=args.results_path, invalidate=args.invalidate, shard=args.shard)
+
+
+def run_measures(args) -> dict:
+    from src.task_c4 import count_measures_whole_dataset
+    return count_measures_whole_dataset(args.path, args.workers, args.chunksize, results_path=args.results_path,
+                                        shard=args.shard)
+
+
+def run_render(args) -> dict:
+    from src.figure_renderer import render_whole_dataset
+    return render_whole_dataset(args.path, args.figures, args.formats, args.workers, args.chunksize,
+                                dpi=args.dpi)
+
+
+def run_annotations(args) -> dict:
+    from src.annotation_corpus import compile_corpus
+    return compile_corpus(args.path)
+
+
+def run_evaluate(args) -> dict:
+    from src.evaluation import evaluate_task, summarize_evaluation
+    frame = evaluate_task(args.path, args.reference, args.task, args.tolerance, args.workers, args.chunksize)
+    return {
+        "summary": summarize_evaluation(frame),
+        "pieces": frame.set_index("piece").to_dict(orient="index")
+    }
+
+
+def run_merge(args) -> dict:
+    from src.sharding import merge_partials
+    results, average_ratio = merge_partials(args.path, args.task)
+    if average_ratio is not None:
+        print("AVERAGE RATIO:", average_ratio)
+    return results
+
+
+def shard_spec(spec: str) -> tuple[int, int]:
+    from src.sharding import parse_shard
+    try:
+        return parse_shard(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_shard_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("--shard", type=shard_spec,
+                        help="run only the pieces of the shard index/count (e.g. 3/16) and write a partial file "
+                             "in the --output directory")
+
+
+def add_output_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("--output", help="output file (JSON) or directory (Parquet), the standard output by default")
+
+
+def add_dataset_arguments(parser: argparse.ArgumentParser, runner: bool = True):
+    parser.add_argument("path", help="path to the dataset")
+    add_output_argument(parser)
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=1, help="number of pieces sent to a worker at once")
+    parser.add_argument("--format", choices=("json", "parquet"), default="json",
+                        help="JSON, or a ResultsStore directory of Parquet files given by --output")
+    if runner:
+        parser.add_argument("--trace", help="record the stages of every piece in this JSON Lines file")
+        parser.add_argument("--invalidate", action="store_true",
+                            help="recompute every piece instead of reusing the result cache")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m src", description=__doc__.strip().split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    c1 = commands.add_parser("c1", help="phrase boundaries of one piece")
+    c1.add_argument("path", help="path to the piece folder")
+    add_output_argument(c1)
+    c1.add_argument("--threshold-similarity", type=float, default=5,
+                    help="maximum distance in seconds between a tempo boundary and a volume split point")
+    c1.add_argument("--threshold-closest", type=float, default=2,
+                    help="minimum gap in quarter length between two volume split points")
+    c1.add_argument("--volume-threshold", type=float, default=0.15,
+                    help="minimum scaled volume change of a volume split point")
+    c1.set_defaults(function=run_c1, format="json")
+
+    c3 = commands.add_parser("c3", help="boundaries of the repeating patterns of every piece")
+    add_dataset_arguments(c3)
+    c3.add_argument("--approximate", action="store_true", help="use the approximate repeats")
+    add_shard_argument(c3)
+    c3.set_defaults(function=run_c3)
+
+    c4 = commands.add_parser("c4", help="number of phrases of every piece")
+    add_dataset_arguments(c4)
+    add_shard_argument(c4)
+    c4.set_defaults(function=run_c4)
+
+    measures = commands.add_parser("measures", help="number of measures of every piece, from the annotations")
+    add_dataset_arguments(measures, runner=False)
+    add_shard_argument(measures)
+    measures.set_defaults(function=run_measures)
+
+    render = commands.add_parser("render", help="figures of every piece in PNG or SVG files, without a display")
+    add_dataset_arguments(render, runner=False)
+    render.add_argument("--figures", required=True, help="directory of the figures")
+    render.add_argument("--formats", nargs="+", choices=("png", "svg", "pdf"), default=["png"],
+                        help="formats of the figures")
+    render.add_argument("--dpi", type=int, default=100, help="resolution of the figures")
+    render.set_defaults(function=run_render)
+
+    annotations = commands.add_parser("annotations",
+                                      help="compile the annotation files into the memory-mapped corpus used by "
+                                           "the c4 and measures commands")
+    annotations.add_argument("path", help="path to the dataset")
+    add_output_argument(annotations)
+    annotations.set_defaults(function=run_annotations, format="json")
+
+    evaluate = commands.add_parser("evaluate", help="precision, recall and F-measure of the boundaries of a task "
+                                                    "against reference boundaries")
+    evaluate.add_argument("path", help="path to the dataset")
+    add_output_argument(evaluate)
+    evaluate.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    evaluate.add_argument("--chunksize", type=int, default=1, help="number of pieces sent to a worker at once")
+    evaluate.add_argument("--reference", required=True,
+                          help='JSON file {"unit": "measures", "boundaries": {piece folder: [boundaries]}}')
+    evaluate.add_argument("--task", choices=("c1", "c3"), default="c3", help="task whose boundaries are scored")
+    evaluate.add_argument("--tolerance", type=float,
+                          help="maximum distance to a reference boundary, in the unit of the reference")
+    evaluate.set_defaults(function=run_evaluate, format="json")
+
+    merge = commands.add_parser("merge", help="combine the partial files of the shards of a run")
+    merge.add_argument("path", help="directory of the partial files")
+    add_output_argument(merge)
+    merge.add_argument("--task", choices=("c3", "c4", "measures"), required=True, help="command of the run")
+    merge.set_defaults(function=run_merge, format="json")
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = get_parser().parse_args(argv)
+    if args.format == "parquet" and args.output is None:
+        print("--format parquet needs the --output directory", file=sys.stderr)
+        return 2
+    shard = getattr(args, "shard", None)
+    if shard is not None and (args.format != "json" or args.output is None):
+        print("--shard needs the --output directory of the partial files, in JSON", file=sys.stderr)
+        return 2
+    args.results_path = args.output if args.format == "parquet" else None
+
+    # The runners print their progress, the standard output only receives the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = args.function(args)
+    if shard is not None:
+        from src.sharding import write_partial
+        print(f"Partial results stored in {write_partial(results, args.output, args.command, shard)}",
+              file=sys.stderr)
+    elif args.format == "parquet":
+        print(f"Results stored in {args.output}", file=sys.stderr)
+    elif args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+"""
+This module contains the compiled annotation corpus, the beat annotations of every piece of the dataset packed
+into a single binary file that the runners memory-map instead of parsing hundreds of annotation text files.
+
+The file starts with a magic number and the length of a JSON header, followed by the float64 onsets and the
+int8 beat type codes of all the annotation files, one after the other:
+- the header gives the beat type names shared by all the files and, for each annotation file, the range of its
+  beats, the mtime, size and content hash of the text file it was compiled from and its meter and key changes
+- the BeatAnnotations of a file are slices of the memory-mapped arrays, nothing is copied
+- a file whose text file changed (mtime or size) since the compilation is parsed again from its text file
+
+The corpus is enabled through an environment variable, so the worker processes of map_pieces use it as well.
+The result cache takes the content hash of the annotation files from the enabled corpus, so a run on the corpus
+does not read the text files at all.
+"""
+import contextlib
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from src import feature_cache
+from src.feature_cache import get_file_hash
+from src.manifest import get_path, load_manifest
+
+# Increase when the format of the corpus changes, the old corpora are then compiled again
+CORPUS_VERSION = 2
+CORPUS_ENV = "DM_ANNOTATION_CORPUS"
+MAGIC = b"DMBEATS\0"
+HEADER_LENGTH_SIZE = 8
+ALIGNMENT = 8
+
+_corpus_path = os.environ.get(CORPUS_ENV) or None
+_corpus = None
+
+
+def get_corpus_path(dataset_path: str, cache_dir: str = None) -> str:
+    """
+    Get the default path of the compiled annotation corpus of a dataset, next to its manifest
+    :param dataset_path: path to the dataset
+    :param cache_dir: the cache directory, CACHE_DIR by default
+    :return: str
+    """
+    cache_dir = feature_cache.CACHE_DIR if cache_dir is None else cache_dir
+    root_hash = hashlib.sha1(os.path.abspath(dataset_path).encode()).hexdigest()
+    return os.path.join(cache_dir, f"annotations-{root_hash}-v{CORPUS_VERSION}.bin")
+
+
+def get_file_key(annotation_path: str) -> str:
+    """
+    :param annotation_path: path to an annotation file
+    :return: the key of the file in the corpus, its absolute normalized path
+    """
+    return os.path.normcase(os.path.abspath(annotation_path))
+
+
+def get_file_stat(annotation_path: str) -> tuple[int, int] or None:
+    """
+    :param annotation_path: path to an annotation file
+    :return: (mtime_ns, size) of the file, None if it cannot be read
+    """
+    try:
+        stat = os.stat(annotation_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class AnnotationCorpus:
+    """
+    A compiled annotation corpus opened with a memory map
+    - path: path to the corpus file
+    - onsets, beat_types: the memory-mapped onsets and beat type codes of all the files
+    - beat_type_names: name of each beat type code, BEAT_TYPES first
+    - files: dict of the record of each annotation file, with its "start" and "end" beats, its "mtime_ns",
+      "size" and content "hash", and its "meter_starts", "meters", "key_starts" and "keys"
+    """
+    __slots__ = ("path", "onsets", "beat_types", "beat_type_names", "files")
+
+    def __init__(self, path: str):
+        """
+        :param path: path to the corpus file
+        :raise ValueError: if the file is not a corpus of this version
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not an annotation corpus: {path}")
+            header_length = int.from_bytes(f.read(HEADER_LENGTH_SIZE), "little")
+            header = json.loads(f.read(header_length).decode())
+        if header.get("version") != CORPUS_VERSION:
+            raise ValueError(f"Annotation corpus version {header.get('version')} instead of {CORPUS_VERSION}")
+        nb_beats = header["nb_beats"]
+        offset = len(MAGIC) + HEADER_LENGTH_SIZE + header_length
+        if nb_beats == 0:
+            self.onsets = np.zeros(0, dtype=np.float64)
+            self.beat_types = np.zeros(0, dtype=np.int8)
+        else:
+            # The memory maps stay valid when the file is replaced by a new compilation
+            self.onsets = np.memmap(path, dtype=np.float64, mode="r", offset=offset,
+                                    shape=(nb_beats,)).view(np.ndarray)
+            self.beat_types = np.memmap(path, dtype=np.int8, mode="r", offset=offset + 8 * nb_beats,
+                                        shape=(nb_beats,)).view(np.ndarray)
+        self.beat_type_names = tuple(header["beat_type_names"])
+        self.files = header["files"]
+
+    def __len__(self):
+        return len(self.files)
+
+    def get_record(self, annotation_path: str) -> dict or None:
+        """
+        :param annotation_path: path to an annotation file
+        :return: the record of the file, None if the file is not in the corpus or changed since the compilation
+        """
+        record = self.files.get(get_file_key(annotation_path))
+        if record is None or get_file_stat(annotation_path) != (record["mtime_ns"], record["size"]):
+            return None
+        return record
+
+    def get_annotations(self, annotation_path: str):
+        """
+        Get the annotations of a file as slices of the memory-mapped arrays
+        :param annotation_path: path to an annotation file
+        :return: BeatAnnotations, None if the file is not in the corpus or changed since the compilation
+        """
+        from src.annotations import BeatAnnotations
+
+        record = self.get_record(annotation_path)
+        if record is None:
+            return None
+        start, end = record["start"], record["end"]
+        return BeatAnnotations(self.onsets[start:end], self.beat_types[start:end], self.beat_type_names,
+                               np.array(record["meter_starts"], dtype=np.int32), list(record["meters"]),
+                               np.array(record["key_starts"], dtype=np.int32), list(record["keys"]))
+
+    def get_content_hash(self, annotation_path: str) -> str or None:
+        """
+        :param annotation_path: path to an annotation file
+        :return: the SHA-1 hash of the content of the file, see feature_cache.get_file_hash, None if the file is not
+        in the corpus or changed since the compilation
+        """
+        record = self.get_record(annotation_path)
+        return record["hash"] if record is not None else None
+
+    def count_downbeats(self, annotation_path: str) -> int or None:
+        """
+        :param annotation_path: path to an annotation file
+        :return: the number of downbeats of the file, None if the file is not in the corpus or changed since
+        the compilation
+        """
+        from src.annotations import DOWNBEAT
+
+        record = self.get_record(annotation_path)
+        if record is None:
+            return None
+        return int(np.count_nonzero(self.beat_types[record["start"]:record["end"]] == DOWNBEAT))
+
+    def get_stale_files(self) -> list[str]:
+        """
+        :return: the annotation files that changed or were removed since the compilation
+        """
+        return [key for key, record in self.files.items()
+                if get_file_stat(key) != (record["mtime_ns"], record["size"])]
+
+
+def list_annotation_files(manifest: dict, dataset_path: str) -> list[str]:
+    """
+    List the annotation files of the pieces of a manifest
+    :param manifest: dict from load_manifest
+    :param dataset_path: path to the dataset
+    :return: list of paths
+    """
+    return [get_path(dataset_path, relative_path) + "/" + name
+            for relative_path, piece in manifest["pieces"].items() for name in piece["annotations"]]
+
+
+def compile_corpus(dataset_path: str, corpus_path: str = None, manifest: dict = None) -> dict:
+    """
+    Compile the annotation files of every piece of the dataset into a corpus file.
+    The files that did not change since the previous compilation are copied from the previous corpus,
+    the others are parsed.
+    :param dataset_path: path to the dataset
+    :param corpus_path: path to the corpus file, get_corpus_path by default
+    :param manifest: manifest of the dataset, from load_manifest(dataset_path) by default
+    :return: dict with the number of "files", "parsed" files and "beats" of the corpus
+    """
+    from src.annotations import BEAT_TYPES, parse_annotations
+
+    corpus_path = get_corpus_path(dataset_path) if corpus_path is None else corpus_path
+    manifest = load_manifest(dataset_path) if manifest is None else manifest
+    try:
+        previous = AnnotationCorpus(corpus_path)
+    except (OSError, ValueError, KeyError):
+        previous = None
+
+    beat_type_names = list(BEAT_TYPES)
+    beat_type_codes = {name: code for code, name in enumerate(BEAT_TYPES)}
+    onsets = []
+    beat_types = []
+    files = {}
+    nb_beats = nb_parsed = 0
+    for annotation_path in list_annotation_files(manifest, dataset_path):
+        stat = get_file_stat(annotation_path)
+        if stat is None:
+            continue
+        annotations = previous.get_annotations(annotation_path) if previous is not None else None
+        if annotations is None:
+            annotations = parse_annotations(annotation_path)
+            content_hash = get_file_hash(annotation_path)
+            nb_parsed += 1
+        else:
+            content_hash = previous.get_content_hash(annotation_path)
+        # The codes of a file are mapped to the beat type names shared by the corpus
+        mapping = []
+        for name in annotations.beat_type_names:
+            if name not in beat_type_codes:
+                beat_type_codes[name] = len(beat_type_names)
+                beat_type_names.append(name)
+            mapping.append(beat_type_codes[name])
+        onsets.append(annotations.onsets)
+        beat_types.append(np.array(mapping, dtype=np.int8)[annotations.beat_types])
+        files[get_file_key(annotation_path)] = {
+            "start": nb_beats,
+            "end": nb_beats + len(annotations),
+            "mtime_ns": stat[0],
+            "size": stat[1],
+            "hash": content_hash,
+            "meter_starts": annotations.meter_starts.tolist(),
+            "meters": list(annotations.meters),
+            "key_starts": annotations.key_starts.tolist(),
+            "keys": list(annotations.keys)
+        }
+        nb_beats += len(annotations)
+
+    header = json.dumps({
+        "version": CORPUS_VERSION,
+        "root": os.path.abspath(dataset_path),
+        "nb_beats": nb_beats,
+        "beat_type_names": beat_type_names,
+        "files": files
+    }).encode()
+    # Pad the header so that the float64 onsets are aligned
+    header += b" " * (-(len(MAGIC) + HEADER_LENGTH_SIZE + len(header)) % ALIGNMENT)
+    os.makedirs(os.path.dirname(corpus_path) or ".", exist_ok=True)
+    # Write then rename so that concurrent readers never see a partial corpus
+    temporary_path = f"{corpus_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(HEADER_LENGTH_SIZE, "little"))
+        f.write(header)
+        f.write(np.concatenate(onsets).astype("<f8").tobytes() if onsets else b"")
+        f.write(np.concatenate(beat_types).astype(np.int8).tobytes() if beat_types else b"")
+    os.replace(temporary_path, corpus_path)
+    return {"files": len(files), "parsed": nb_parsed, "beats": nb_beats}
+
+
+def enable_corpus(corpus_path: str):
+    """
+    Use a compiled corpus in this process and in the worker processes started afterward
+    :param corpus_path: path to the corpus file
+    :return: None
+    """
+    global _corpus_path, _corpus
+    _corpus_path = corpus_path
+    _corpus = None
+    os.environ[CORPUS_ENV] = corpus_path
+
+
+def disable_corpus():
+    """
+    Stop using the compiled corpus, the annotation files are parsed again
+    :return: None
+    """
+    global _corpus_path, _corpus
+    _corpus_path = None
+    _corpus = None
+    os.environ.pop(CORPUS_ENV, None)
+
+
+def enable_dataset_corpus(dataset_path: str) -> bool:
+    """
+    Use the compiled corpus of a dataset if it was compiled at its default path
+    :param dataset_path: path to the dataset
+    :return: True if the corpus is used
+    """
+    corpus_path = get_corpus_path(dataset_path)
+    if not os.path.exists(corpus_path):
+        return False
+    enable_corpus(corpus_path)
+    return True
+
+
+@contextlib.contextmanager
+def dataset_corpus(dataset_path: str, use_corpus: bool = True):
+    """
+    Use the compiled corpus of a dataset during a run if it was compiled at its default path.
+    A corpus enabled before (by enable_corpus or CORPUS_ENV) is kept instead, and the state before the run,
+    corpus or no corpus, is restored at the end.
+    :param dataset_path: path to the dataset
+    :param use_corpus: if False, leave the enabled corpus, if any, as it is
+    :return: None
+    """
+    global _corpus_path, _corpus
+    if not use_corpus or _corpus_path is not None:
+        yield
+        return
+    previous_environment = os.environ.get(CORPUS_ENV)
+    try:
+        enable_dataset_corpus(dataset_path)
+        yield
+    finally:
+        _corpus_path = None
+        _corpus = None
+        if previous_environment is None:
+            os.environ.pop(CORPUS_ENV, None)
+        else:
+            os.environ[CORPUS_ENV] = previous_environment
+
+
+def get_active_corpus() -> AnnotationCorpus or None:
+    """
+    :return: the enabled corpus, opened at the first call, None if no corpus is enabled or it cannot be opened
+    """
+    global _corpus, _corpus_path
+    if _corpus is None and _corpus_path is not None:
+        try:
+            _corpus = AnnotationCorpus(_corpus_path)
+        except (OSError, ValueError, KeyError):
+            # Parse the text files rather than failing the run
+            _corpus_path = None
+    return _corpus
@@ -0,0 +1,206 @@
+"""
+This module contains a columnar loader for the ASAP beat annotation files.
+Each line of an annotation file is "onset onset beat_type[,meter[,key]]", the beats are stored
+as a float64 onset array and an int8 beat type array, and the meter and key changes are
+run-length encoded (start beat of each change and its value).
+
+The dicts of timing_for_one_piece are thin views over this structure. When the compiled annotation corpus
+of annotation_corpus is enabled, the arrays are slices of its memory map instead of being parsed.
+"""
+from collections.abc import Mapping
+
+import numpy as np
+
+BEAT_TYPES = ("db", "b", "bR")
+DOWNBEAT = 0
+
+
+class BeatAnnotations:
+    """
+    The beats of one annotation file
+    - onsets: float64 onset of each beat in seconds
+    - beat_types: int8 code of each beat type, index in beat_type_names
+    - meter_starts, meters: first beat and value of each meter change
+    - key_starts, keys: first beat and value of each key change
+    """
+    __slots__ = ("onsets", "beat_types", "beat_type_names", "meter_starts", "meters", "key_starts", "keys")
+
+    def __init__(self, onsets: np.ndarray, beat_types: np.ndarray, beat_type_names: tuple = BEAT_TYPES,
+                 meter_starts: np.ndarray = None, meters: list = None, key_starts: np.ndarray = None,
+                 keys: list = None):
+        self.onsets = onsets
+        self.beat_types = beat_types
+        self.beat_type_names = beat_type_names
+        self.meter_starts = np.zeros(0, dtype=np.int32) if meter_starts is None else meter_starts
+        self.meters = [] if meters is None else meters
+        self.key_starts = np.zeros(0, dtype=np.int32) if key_starts is None else key_starts
+        self.keys = [] if keys is None else keys
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def beat_type_at(self, beat: int) -> str:
+        """
+        :param beat: index of the beat
+        :return: the beat type ("db", "b"...) of the beat
+        """
+        return self.beat_type_names[self.beat_types[beat]]
+
+    def meter_at(self, beat: int) -> str or None:
+        """
+        :param beat: index of the beat
+        :return: the meter at the beat, None before the first meter change
+        """
+        change = int(np.searchsorted(self.meter_starts, beat, side="right")) - 1
+        return self.meters[change] if change >= 0 else None
+
+    def key_at(self, beat: int) -> str or None:
+        """
+        :param beat: index of the beat
+        :return: the key at the beat, None before the first key change
+        """
+        change = int(np.searchsorted(self.key_starts, beat, side="right")) - 1
+        return self.keys[change] if change >= 0 else None
+
+    def downbeat_indexes(self) -> np.ndarray:
+        """
+        :return: the indexes of the downbeats
+        """
+        return np.flatnonzero(self.beat_types == DOWNBEAT)
+
+
+def load_annotations(annotation_path: str) -> BeatAnnotations:
+    """
+    Load an ASAP annotation file, from the compiled annotation corpus when one is enabled and the file did not
+    change since its compilation, otherwise from the text file
+    :param annotation_path: path to the annotation file
+    :return: BeatAnnotations
+    """
+    from src.annotation_corpus import get_active_corpus
+
+    corpus = get_active_corpus()
+    if corpus is not None:
+        annotations = corpus.get_annotations(annotation_path)
+        if annotations is not None:
+            return annotations
+    return parse_annotations(annotation_path)
+
+
+def parse_annotations(annotation_path: str) -> BeatAnnotations:
+    """
+    Parse an ASAP annotation file
+    :param annotation_path: path to the annotation file
+    :return: BeatAnnotations
+    """
+    with open(annotation_path, "r") as f:
+        lines = f.read().split("\n")
+    onsets = []
+    beat_types = []
+    beat_type_names = list(BEAT_TYPES)
+    beat_type_codes = {name: code for code, name in enumerate(BEAT_TYPES)}
+    meter_starts = []
+    meters = []
+    key_starts = []
+    keys = []
+    for line in lines:
+        line_data = line.split()
+        if not line_data:
+            continue
+        beat = len(onsets)
+        onsets.append(line_data[0])
+        beat_key_meter = line_data[2].split(',')
+        code = beat_type_codes.get(beat_key_meter[0])
+        if code is None:
+            code = beat_type_codes[beat_key_meter[0]] = len(beat_type_names)
+            beat_type_names.append(beat_key_meter[0])
+        beat_types.append(code)
+        if len(beat_key_meter) >= 2:
+            meter_starts.append(beat)
+            meters.append(beat_key_meter[1])
+        if len(beat_key_meter) == 3:
+            key_starts.append(beat)
+            keys.append(beat_key_meter[2])
+    return BeatAnnotations(np.array(onsets, dtype=np.float64), np.array(beat_types, dtype=np.int8),
+                           tuple(beat_type_names), np.array(meter_starts, dtype=np.int32), meters,
+                           np.array(key_starts, dtype=np.int32), keys)
+
+
+class PerformedAttributesView(Mapping):
+    """
+    Read-only dict view {beat: {"key", "meter", "onset", "beat_type"}} over BeatAnnotations
+    """
+    __slots__ = ("annotations",)
+
+    def __init__(self, annotations: BeatAnnotations):
+        self.annotations = annotations
+
+    def __getitem__(self, beat):
+        if not isinstance(beat, (int, np.integer)) or not 0 <= beat < len(self.annotations):
+            raise KeyError(beat)
+        annotations = self.annotations
+        return {
+            "key": annotations.key_at(beat),
+            "meter": annotations.meter_at(beat),
+            "onset": float(annotations.onsets[beat]),
+            "beat_type": annotations.beat_type_at(beat)
+        }
+
+    def __iter__(self):
+        return iter(range(len(self.annotations)))
+
+    def __len__(self):
+        return len(self.annotations)
+
+
+class SymbolicAttributesView(Mapping):
+    """
+    Read-only dict view {beat: {"onset"}} over BeatAnnotations
+    """
+    __slots__ = ("annotations",)
+
+    def __init__(self, annotations: BeatAnnotations):
+        self.annotations = annotations
+
+    def __getitem__(self, beat):
+        if not isinstance(beat, (int, np.integer)) or not 0 <= beat < len(self.annotations):
+            raise KeyError(beat)
+        return {"onset": float(self.annotations.onsets[beat])}
+
+    def __iter__(self):
+        return iter(range(len(self.annotations)))
+
+    def __len__(self):
+        return len(self.annotations)
+
+
+class SymbolicToPerformedView(Mapping):
+    """
+    Read-only dict view {beat: {"symbolic": {"onset"}, "performed": {"onset", "key", "meter", "beat_type"}}}
+    over the symbolic onsets, the performed onsets and the annotations giving the meter, key and beat types
+    """
+    __slots__ = ("symbolic_onsets", "performed_onsets", "annotations")
+
+    def __init__(self, symbolic_onsets: np.ndarray, performed_onsets: np.ndarray, annotations: BeatAnnotations):
+        self.symbolic_onsets = symbolic_onsets
+        self.performed_onsets = performed_onsets
+        self.annotations = annotations
+
+    def __getitem__(self, beat):
+        if not isinstance(beat, (int, np.integer)) or not 0 <= beat < len(self.performed_onsets):
+            raise KeyError(beat)
+        annotations = self.annotations
+        return {
+            "symbolic": {"onset": float(self.symbolic_onsets[beat])},
+            "performed": {
+                "onset": float(self.performed_onsets[beat]),
+                "key": annotations.key_at(beat),
+                "meter": annotations.meter_at(beat),
+                "beat_type": annotations.beat_type_at(beat)
+            }
+        }
+
+    def __iter__(self):
+        return iter(range(len(self.performed_onsets)))
+
+    def __len__(self):
+        return len(self.performed_onsets)
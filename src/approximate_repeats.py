@@ -0,0 +1,238 @@
+"""
+This module contains the search of the approximate repeats of a sequence, used by task C3 to find the patterns
+that repeat with small edits (an interval changed, a note added or removed...).
+On the interval sequence, the search is transposition invariant and ignores the rhythmic variations.
+
+The sequence is cut into overlapping windows, each window is described by the set of its n-grams:
+- an inverted index of the n-grams gives their frequency, the n-grams found almost everywhere are ignored
+- the MinHash signature of each window estimates the Jaccard similarity of the n-gram sets, and the windows
+  sharing a band of their signature (LSH) are the candidate pairs, each window being linked to a bounded number
+  of windows per band, so the number of candidates grows linearly with the length of the sequence
+- the candidates are verified with the edit distance of their windows, computed for all the pairs at once
+- the verified pairs of windows following each other on the same diagonal are merged into repeats
+"""
+import numpy as np
+
+from src.repeats import MIN_PATTERN_DURATION
+
+NGRAM_SIZE = 2
+WINDOW_SIZE = 12
+NB_BANDS = 24
+BAND_ROWS = 3
+MAX_EDITS = 2
+MAX_LINKS = 4
+# An n-gram in more than this share of the positions (and more than MIN_STOP_COUNT times) is ignored
+MAX_NGRAM_SHARE = 0.05
+MIN_STOP_COUNT = 16
+MERSENNE_PRIME = (1 << 31) - 1
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class NgramIndex:
+    """
+    Inverted index of the n-grams of a sequence of int codes
+    - ngram_ids: id of the n-gram starting at each position
+    - postings: the positions sorted by n-gram id
+    - starts: the positions of n-gram k are postings[starts[k]:starts[k + 1]]
+    """
+    __slots__ = ("n", "ngram_ids", "postings", "starts")
+
+    def __init__(self, codes: np.ndarray, n: int = NGRAM_SIZE):
+        """
+        :param codes: np.ndarray of int codes
+        :param n: size of the n-grams
+        """
+        self.n = n
+        nb_ngrams = max(len(codes) - n + 1, 0)
+        if nb_ngrams == 0:
+            self.ngram_ids = np.zeros(0, dtype=np.int64)
+        else:
+            rows = np.lib.stride_tricks.sliding_window_view(np.asarray(codes, dtype=np.int64), n)
+            self.ngram_ids = np.unique(rows, axis=0, return_inverse=True)[1].reshape(-1).astype(np.int64)
+        self.postings = np.argsort(self.ngram_ids, kind="stable")
+        counts = np.bincount(self.ngram_ids) if nb_ngrams else np.zeros(0, dtype=np.int64)
+        self.starts = np.concatenate(([0], np.cumsum(counts)))
+
+    def __len__(self):
+        return len(self.ngram_ids)
+
+    def get_counts(self) -> np.ndarray:
+        """
+        :return: number of occurrences of each n-gram
+        """
+        return np.diff(self.starts)
+
+    def get_positions(self, ngram_id: int) -> np.ndarray:
+        """
+        :param ngram_id: id of an n-gram
+        :return: the sorted positions of the n-gram
+        """
+        return self.postings[self.starts[ngram_id]:self.starts[ngram_id + 1]]
+
+
+def get_minhash_signatures(index: NgramIndex, window: int, nb_hashes: int, seed: int = 0,
+                           max_share: float = MAX_NGRAM_SHARE) -> np.ndarray:
+    """
+    Get the MinHash signature of the n-gram set of each window
+    :param index: NgramIndex of the sequence
+    :param window: number of elements of a window
+    :param nb_hashes: number of hash functions
+    :param seed: seed of the hash functions
+    :param max_share: the n-grams more frequent than this share of the positions are ignored
+    :return: np.ndarray of shape (nb_hashes, number of windows)
+    """
+    nb_window_ngrams = window - index.n + 1
+    nb_windows = len(index) - nb_window_ngrams + 1
+    if nb_windows <= 0:
+        return np.zeros((nb_hashes, 0), dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=(nb_hashes, 1), dtype=np.int64)
+    b = rng.integers(0, MERSENNE_PRIME, size=(nb_hashes, 1), dtype=np.int64)
+    hashes = (a * index.ngram_ids[np.newaxis, :] + b) % MERSENNE_PRIME
+    # The frequent n-grams get a value above every hash, distinct per position so that they never match
+    counts = index.get_counts()
+    stop = counts[index.ngram_ids] > max(MIN_STOP_COUNT, max_share * len(index))
+    hashes[:, stop] = MERSENNE_PRIME + np.flatnonzero(stop)
+    return np.lib.stride_tricks.sliding_window_view(hashes, nb_window_ngrams, axis=1).min(axis=2)
+
+
+def get_band_keys(signatures: np.ndarray, band: int, rows: int) -> np.ndarray:
+    """
+    Hash the rows of a band of the signatures into one key per window, a collision of two different bands
+    only adds a candidate pair that the verification rejects
+    :param signatures: from get_minhash_signatures
+    :param band: index of the band
+    :param rows: number of hashes per band
+    :return: np.ndarray of uint64 keys
+    """
+    keys = np.zeros(signatures.shape[1], dtype=np.uint64)
+    for row in signatures[band * rows:(band + 1) * rows]:
+        keys = keys * np.uint64(HASH_MULTIPLIER) + row.astype(np.uint64)
+    return keys
+
+
+def find_candidate_pairs(signatures: np.ndarray, bands: int, rows: int, window: int,
+                         max_links: int = MAX_LINKS) -> np.ndarray:
+    """
+    Find the pairs of non overlapping windows sharing at least one band of their signature.
+    In a bucket, each window is linked to the next max_links windows starting at least one window later.
+    :param signatures: from get_minhash_signatures, with bands * rows hashes
+    :param bands: number of bands
+    :param rows: number of hashes per band
+    :param window: number of elements of a window
+    :param max_links: maximum number of pairs of a window per band
+    :return: np.ndarray of shape (number of pairs, 2), sorted, with first < second
+    """
+    nb_windows = signatures.shape[1]
+    if nb_windows == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    positions = np.arange(nb_windows, dtype=np.int64)
+    pairs = []
+    for band in range(bands):
+        band_keys = get_band_keys(signatures, band, rows)
+        order = np.lexsort((positions, band_keys))
+        new_bucket = np.ones(nb_windows, dtype=bool)
+        new_bucket[1:] = band_keys[order][1:] != band_keys[order][:-1]
+        # Key of the window in the sorted order: its bucket then its position
+        sorted_keys = (np.cumsum(new_bucket) - 1) * nb_windows + order
+        firsts = np.searchsorted(sorted_keys, sorted_keys + window, side="left")
+        bucket_ends = np.searchsorted(sorted_keys, (sorted_keys // nb_windows + 1) * nb_windows, side="left")
+        for link in range(max_links):
+            seconds = firsts + link
+            valid = seconds < bucket_ends
+            pairs.append(order[valid] * nb_windows + order[seconds[valid]])
+    pairs = np.unique(np.concatenate(pairs))
+    return np.stack((pairs // nb_windows, pairs % nb_windows), axis=1)
+
+
+def get_edit_distances(codes: np.ndarray, firsts: np.ndarray, seconds: np.ndarray, window: int,
+                       max_edits: int = MAX_EDITS) -> np.ndarray:
+    """
+    Levenshtein distance between the windows of each pair, the dynamic programming runs on all the pairs at once
+    and only on the cells within max_edits of the diagonal
+    :param codes: np.ndarray of int codes, non negative
+    :param firsts: start of the first window of each pair
+    :param seconds: start of the second window of each pair
+    :param window: number of elements of a window
+    :param max_edits: the distances above max_edits are returned as max_edits + 1
+    :return: np.ndarray of the distance of each pair
+    """
+    too_far = max_edits + 1
+    diagonals = np.arange(-max_edits, max_edits + 1)
+    steps = np.arange(window)
+    a = codes[firsts[:, np.newaxis] + steps]
+    # The second window is padded with a value that no code takes, the padding cells are masked below
+    b = np.full((len(firsts), window + 2 * max_edits), -1, dtype=codes.dtype)
+    b[:, max_edits:max_edits + window] = codes[seconds[:, np.newaxis] + steps]
+    # Cell (i, i + d) of the row i is at index max_edits + d
+    previous = np.broadcast_to(np.where(diagonals >= 0, diagonals, too_far), (len(firsts), len(diagonals))).copy()
+    for i in range(1, window + 1):
+        columns = i + diagonals
+        current = previous + (a[:, i - 1:i] != b[:, i - 1:i + 2 * max_edits])
+        current[:, :-1] = np.minimum(current[:, :-1], previous[:, 1:] + 1)
+        if i <= max_edits:
+            current[:, max_edits - i] = i
+        for d in range(1, len(diagonals)):
+            current[:, d] = np.minimum(current[:, d], current[:, d - 1] + 1)
+        current[:, (columns < 0) | (columns > window)] = too_far
+        previous = np.minimum(current, too_far)
+    return previous[:, max_edits]
+
+
+def merge_diagonals(firsts: np.ndarray, seconds: np.ndarray, window: int) -> list[tuple[int, int, int]]:
+    """
+    Merge the verified pairs of windows following each other on the same diagonal into repeats
+    :param firsts: start of the first window of each pair
+    :param seconds: start of the second window of each pair
+    :param window: number of elements of a window
+    :return: list of (first start, second start, length), the first occurrence never overlaps the second
+    """
+    order = np.lexsort((firsts, seconds - firsts))
+    repeats = []
+    current = None
+    for first, second in zip(firsts[order].tolist(), seconds[order].tolist()):
+        if current is not None and second - first == current[1] - current[0] and first <= current[2]:
+            current[2] = first + window
+            continue
+        if current is not None:
+            repeats.append(current)
+        current = [first, second, first + window]
+    if current is not None:
+        repeats.append(current)
+    return [(first, second, min(end - first, second - first)) for first, second, end in repeats]
+
+
+def find_approximate_repeats(codes: np.ndarray, durations: list, min_duration: float = MIN_PATTERN_DURATION,
+                             window: int = WINDOW_SIZE, max_edits: int = MAX_EDITS, n: int = NGRAM_SIZE,
+                             bands: int = NB_BANDS, rows: int = BAND_ROWS, max_links: int = MAX_LINKS,
+                             seed: int = 0) -> list[tuple]:
+    """
+    Find the approximate repeats of a sequence
+    :param codes: np.ndarray of int codes, e.g. from encode_array
+    :param durations: list of the durations of each element
+    :param min_duration: minimum total duration of the first occurrence of a repeat
+    :param window: number of elements of the windows compared
+    :param max_edits: maximum edit distance between two windows of a repeat
+    :param n: size of the n-grams
+    :param bands: number of LSH bands
+    :param rows: number of MinHash values per band
+    :param max_links: maximum number of candidate pairs of a window per band
+    :param seed: seed of the hash functions, the result is deterministic for a seed
+    :return: list of (length, [first start, second start]) sorted by decreasing length, as find_maximal_repeats
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    if len(codes) < 2 * window:
+        return []
+    index = NgramIndex(codes, n)
+    signatures = get_minhash_signatures(index, window, bands * rows, seed)
+    pairs = find_candidate_pairs(signatures, bands, rows, window, max_links)
+    if len(pairs) == 0:
+        return []
+    distances = get_edit_distances(codes, pairs[:, 0], pairs[:, 1], window, max_edits)
+    verified = pairs[distances <= max_edits]
+    prefix_durations = np.concatenate(([0.0], np.cumsum(np.asarray(durations, dtype=np.float64))))
+    repeats = [(length, [first, second]) for first, second, length in merge_diagonals(verified[:, 0],
+                                                                                       verified[:, 1], window)
+               if prefix_durations[first + length] - prefix_durations[first] >= min_duration]
+    repeats.sort(key=lambda repeat: (-repeat[0], repeat[1]))
+    return repeats
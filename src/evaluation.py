@@ -0,0 +1,236 @@
+"""
+This module contains the evaluation of the detected phrase boundaries against reference boundaries, with the
+precision, recall and F-measure of each piece and of the whole dataset.
+
+A detected boundary is a hit when it lies within the tolerance of a reference boundary, each reference matching
+at most one detected boundary. The boundaries of all the pieces are scored at once:
+- the boundaries of each piece are sorted and the pieces are shifted apart, so the whole dataset is one sorted
+  array of detected boundaries and one sorted array of reference boundaries
+- the references within the tolerance of each detected boundary are found with searchsorted
+- each detected boundary takes the first reference of its window not taken by the previous one, which is an
+  optimal matching since the windows are sorted, the matches are a cumulative maximum over the pieces
+
+The boundaries are in beats or seconds (task_c1.get_phrase_boundaries) or in measure numbers
+(task_c3.get_boundaries), the reference must be in the same unit. The beats of task C1 are converted to measure
+numbers with the downbeats of the score annotations to score them against a reference in measures.
+"""
+import json
+
+import numpy as np
+
+from src.manifest import SCORE_ANNOTATIONS, get_piece_key, list_pieces, load_manifest
+from src.parallel import map_pieces
+
+UNITS = ("beats", "measures", "seconds")
+DEFAULT_TOLERANCES = {"beats": 2, "measures": 1, "seconds": 3.0}
+
+
+def get_boundary_values(output, unit: str = "measures") -> np.ndarray:
+    """
+    Get the boundaries of a detector output in a unit
+    :param output: the boundaries, the (beats, times) of task_c1.get_phrase_boundaries, or the dict of a piece
+    from task_c3.run_on_whole_dataset with its "boundaries"
+    :param unit: "beats", "measures" or "seconds", the beats or the times are taken from the output of task C1
+    :return: sorted np.ndarray of float64
+    """
+    if unit not in UNITS:
+        raise ValueError(f"Unknown unit: {unit}")
+    if isinstance(output, dict):
+        output = output["boundaries"]
+    if isinstance(output, tuple) and len(output) == 2 and all(np.ndim(values) == 1 for values in output):
+        output = output[1] if unit == "seconds" else output[0]
+    return np.sort(np.asarray(output, dtype=np.float64).reshape(-1))
+
+
+def beats_to_measures(beats, annotations) -> np.ndarray:
+    """
+    Convert beat indexes to measure numbers, the measure of a beat being the number of downbeats up to it,
+    so the beats before the first downbeat are in measure 0 as a pickup measure
+    :param beats: indexes of the beats
+    :param annotations: BeatAnnotations of the score
+    :return: np.ndarray of int64
+    """
+    return np.searchsorted(annotations.downbeat_indexes(), np.asarray(beats, dtype=np.int64), side="right")
+
+
+def count_hits(detected_list: list, reference_list: list, tolerance: float) -> np.ndarray:
+    """
+    Count the detected boundaries matching a reference boundary of each piece
+    :param detected_list: sorted np.ndarray of the detected boundaries of each piece
+    :param reference_list: sorted np.ndarray of the reference boundaries of each piece
+    :param tolerance: maximum distance between a detected boundary and its reference
+    :return: np.ndarray of the number of hits of each piece
+    """
+    nb_pieces = len(detected_list)
+    detected_counts = np.array([len(values) for values in detected_list], dtype=np.int64)
+    reference_counts = np.array([len(values) for values in reference_list], dtype=np.int64)
+    if detected_counts.sum() == 0 or reference_counts.sum() == 0:
+        return np.zeros(nb_pieces, dtype=np.int64)
+    detected = np.concatenate(detected_list)
+    reference = np.concatenate(reference_list)
+    low = min(detected.min(), reference.min())
+    # The pieces are shifted apart so that no window reaches the boundaries of another piece
+    stride = np.ceil(max(detected.max(), reference.max()) - low + 2 * tolerance + 1)
+    detected_pieces = np.repeat(np.arange(nb_pieces), detected_counts)
+    detected = detected - low + detected_pieces * stride
+    reference = reference - low + np.repeat(np.arange(nb_pieces), reference_counts) * stride
+    starts = np.searchsorted(reference, detected - tolerance, side="left")
+    ends = np.searchsorted(reference, detected + tolerance, side="right")
+
+    # The match of the k-th kept boundary of a piece is max(its first reference, match of the previous one + 1),
+    # that is k + the cumulative maximum of first reference - k, restarted for each piece by the piece offset
+    kept = starts < ends
+    piece_offset = len(reference) + len(detected) + 1
+    while True:
+        indexes = np.flatnonzero(kept)
+        ranks = np.arange(len(indexes))
+        offsets = detected_pieces[indexes] * piece_offset
+        matches = np.maximum.accumulate(starts[indexes] - ranks + offsets) - offsets + ranks
+        failed = np.flatnonzero(matches >= ends[indexes])
+        if len(failed) == 0:
+            break
+        # Only the first failure of a piece is certain, the next ones may come from the references it took
+        _, firsts = np.unique(detected_pieces[indexes[failed]], return_index=True)
+        kept[indexes[failed[firsts]]] = False
+    return np.bincount(detected_pieces[kept], minlength=nb_pieces)
+
+
+def c1_boundaries_to_measures(detected: dict) -> dict:
+    """
+    Convert the boundaries of task C1 to measure numbers, the beats of task C1 being the beats of the score
+    annotations of the piece
+    :param detected: dict of the (beats, times) of each piece folder from detect_c1_boundaries, "Error" for the
+    pieces that failed
+    :return: dict of the np.ndarray of the measure numbers of each piece, "Error" for the pieces that failed
+    """
+    from src.annotations import load_annotations
+
+    return {path: output if isinstance(output, str)
+            else beats_to_measures(output[0], load_annotations(f"{path}/{SCORE_ANNOTATIONS}"))
+            for path, output in detected.items()}
+
+
+def evaluate_boundaries(detected: dict, reference: dict, unit: str = "measures", tolerance: float = None,
+                        dataset_path: str = None):
+    """
+    Score the detected boundaries of the pieces against their reference boundaries
+    :param detected: dict of the detector output of each piece, see get_boundary_values
+    :param reference: dict of the reference boundaries of each piece, in the same unit
+    :param unit: "beats", "measures" or "seconds"
+    :param tolerance: maximum distance between a detected boundary and its reference, DEFAULT_TOLERANCES by default
+    :param dataset_path: path to the dataset, to match the paths of the outputs with the keys of the reference
+    :return: pd.DataFrame with a row per piece present in both, its "nb_detected", "nb_reference", "nb_hits",
+    "precision", "recall" and "f_measure", the scores of a piece without detected or reference boundary are 0
+    """
+    import pandas as pd
+
+    tolerance = DEFAULT_TOLERANCES[unit] if tolerance is None else tolerance
+    detected = {get_piece_key(piece, dataset_path): output for piece, output in detected.items()
+                if not isinstance(output, str)}
+    reference = {get_piece_key(piece, dataset_path): output for piece, output in reference.items()}
+    pieces = [piece for piece in detected if piece in reference]
+    detected_list = [get_boundary_values(detected[piece], unit) for piece in pieces]
+    reference_list = [get_boundary_values(reference[piece], unit) for piece in pieces]
+    nb_hits = count_hits(detected_list, reference_list, tolerance)
+    nb_detected = np.array([len(values) for values in detected_list], dtype=np.int64)
+    nb_reference = np.array([len(values) for values in reference_list], dtype=np.int64)
+    precision, recall, f_measure = get_scores(nb_hits, nb_detected, nb_reference)
+    return pd.DataFrame({"piece": pieces, "nb_detected": nb_detected, "nb_reference": nb_reference,
+                         "nb_hits": nb_hits, "precision": precision, "recall": recall, "f_measure": f_measure})
+
+
+def get_scores(nb_hits, nb_detected, nb_reference) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param nb_hits: number of hits
+    :param nb_detected: number of detected boundaries
+    :param nb_reference: number of reference boundaries
+    :return: precision, recall and F-measure, 0 when undefined
+    """
+    nb_hits = np.asarray(nb_hits, dtype=np.float64)
+    precision = np.divide(nb_hits, nb_detected, out=np.zeros_like(nb_hits), where=np.asarray(nb_detected) > 0)
+    recall = np.divide(nb_hits, nb_reference, out=np.zeros_like(nb_hits), where=np.asarray(nb_reference) > 0)
+    total = precision + recall
+    f_measure = np.divide(2 * precision * recall, total, out=np.zeros_like(nb_hits), where=total > 0)
+    return precision, recall, f_measure
+
+
+def summarize_evaluation(frame) -> dict:
+    """
+    Scores of the whole dataset
+    :param frame: pd.DataFrame from evaluate_boundaries
+    :return: dict with the "precision", "recall" and "f_measure" of the hits of all the pieces pooled together,
+    the "mean_f_measure" of the pieces and the number of pieces
+    """
+    precision, recall, f_measure = get_scores(frame["nb_hits"].sum(), frame["nb_detected"].sum(),
+                                              frame["nb_reference"].sum())
+    return {
+        "precision": float(precision),
+        "recall": float(recall),
+        "f_measure": float(f_measure),
+        "mean_f_measure": float(frame["f_measure"].mean()) if len(frame) else 0.0,
+        "nb_pieces": len(frame)
+    }
+
+
+def load_reference(reference_path: str) -> tuple[str, dict]:
+    """
+    Load reference boundaries stored as JSON {"unit": "measures", "boundaries": {piece folder: [boundaries]}}
+    :param reference_path: path to the JSON file
+    :return: the unit and the dict of the boundaries of each piece
+    """
+    with open(reference_path, "r") as f:
+        reference = json.load(f)
+    return reference.get("unit", "measures"), reference["boundaries"]
+
+
+def detect_c1_boundaries(dataset_path: str, workers: int = 1, chunksize: int = 1, progress=None,
+                         manifest: dict = None) -> dict:
+    """
+    Detect the tempo phrase boundaries of task C1 of every piece
+    :param dataset_path: path to the dataset
+    :param workers: number of worker processes
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, path)
+    :param manifest: manifest of the dataset, from load_manifest(dataset_path) by default
+    :return: dict of the (beats, times) of each piece folder, "Error" for the pieces that failed
+    """
+    from src.task_c1 import get_phrase_boundaries
+
+    manifest = load_manifest(dataset_path) if manifest is None else manifest
+    results = {}
+    for path, boundaries, error in map_pieces(get_phrase_boundaries,
+                                              [path for path, _ in list_pieces(manifest, dataset_path)],
+                                              workers, chunksize, progress):
+        if error is not None:
+            print(f"Error for {path}: {error}")
+        results[path] = "Error" if error is not None else tuple(boundaries)
+    return results
+
+
+def evaluate_task(dataset_path: str, reference_path: str, task: str = "c3", tolerance: float = None,
+                  workers: int = 1, chunksize: int = 1, manifest: dict = None):
+    """
+    Run a task on the whole dataset and score its boundaries against a reference
+    :param dataset_path: path to the dataset
+    :param reference_path: path to the JSON file of the reference, see load_reference
+    :param task: "c1" for the tempo phrase boundaries, "c3" for the boundaries of the repeating patterns
+    :param tolerance: maximum distance between a detected boundary and its reference, in the unit of the reference
+    :param workers: number of worker processes
+    :param chunksize: number of pieces sent to a worker at once
+    :param manifest: manifest of the dataset, from load_manifest(dataset_path) by default
+    :return: pd.DataFrame from evaluate_boundaries
+    """
+    unit, reference = load_reference(reference_path)
+    manifest = load_manifest(dataset_path) if manifest is None else manifest
+    if task == "c1":
+        detected = detect_c1_boundaries(dataset_path, workers, chunksize, manifest=manifest)
+        if unit == "measures":
+            detected = c1_boundaries_to_measures(detected)
+    elif task == "c3":
+        if unit != "measures":
+            raise ValueError("The boundaries of task C3 are in measures")
+        from src.task_c3 import run_on_whole_dataset
+        detected = run_on_whole_dataset(dataset_path, workers, chunksize, manifest=manifest)
+    else:
+        raise ValueError(f"Unknown task: {task}")
+    return evaluate_boundaries(detected, reference, unit, tolerance, dataset_path)
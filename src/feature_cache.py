@@ -0,0 +1,337 @@
+"""
+This module contains a persistent cache of the note features extracted from the MIDI files.
+Parsing a MIDI file with music21 is the slowest step of tasks C1 and C3, so the features used
+by both tasks are extracted in a single parse and stored as NumPy arrays in a .npz file.
+
+The entries are keyed by the hash of the MIDI file content and the extractor version,
+and the least recently used entries are removed when the cache grows over its maximum size.
+The dataset runners preload the note tables of the next pieces in a thread, the last preloaded tables are kept
+in memory and returned by load_note_table without reading the cache again.
+"""
+import hashlib
+import io
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from fractions import Fraction
+
+import numpy as np
+
+from src.midi_reader import read_midi_file
+
+# Increase when the extracted features change, the old entries are then ignored
+EXTRACTOR_VERSION = 2
+CACHE_DIR = os.environ.get("DM_FEATURE_CACHE_DIR",
+                           os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                        ".feature_cache"))
+MAX_CACHE_SIZE = 512 * 1024 * 1024
+# Number of note tables loaded ahead by preload_note_table and kept in memory
+MAX_PRELOADED_TABLES = 8
+
+_preloaded_tables = OrderedDict()
+_preloaded_lock = threading.Lock()
+
+
+def split_fractions(values: list) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Split quarter lengths (float or Fraction) into exact numerators and denominators
+    :param values: list of quarter lengths
+    :return: np.ndarray of numerators, np.ndarray of denominators
+    """
+    fractions = [Fraction(value) for value in values]
+    return (np.array([f.numerator for f in fractions], dtype=np.int64),
+            np.array([f.denominator for f in fractions], dtype=np.int64))
+
+
+def join_fractions(numerators: np.ndarray, denominators: np.ndarray) -> list:
+    """
+    Rebuild the quarter lengths as music21 gives them: float if exact in binary, Fraction otherwise
+    :param numerators: np.ndarray of numerators
+    :param denominators: np.ndarray of denominators
+    :return: list of quarter lengths
+    """
+    return [n / d if d & (d - 1) == 0 else Fraction(n, d)
+            for n, d in zip(numerators.tolist(), denominators.tolist())]
+
+
+def get_file_hash(file_path: str) -> str:
+    """
+    Get the SHA-1 hash of a file content
+    :param file_path:
+    :return: str
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _events_to_arrays(prefix: str, events: list) -> dict:
+    """
+    Convert a list of (onset, measure, velocity, duration, pitches) events to columns
+    :param prefix: prefix of the column names
+    :param events: list of events
+    :return: dict of np.ndarray
+    """
+    onset_num, onset_den = split_fractions([event[0] for event in events])
+    duration_num, duration_den = split_fractions([event[3] for event in events])
+    pitch_counts = [len(event[4]) for event in events]
+    return {
+        prefix + "onset_num": onset_num,
+        prefix + "onset_den": onset_den,
+        prefix + "measure": np.array([-1 if event[1] is None else event[1] for event in events], dtype=np.int32),
+        prefix + "velocity": np.array([-1 if event[2] is None else event[2] for event in events], dtype=np.int16),
+        prefix + "duration_num": duration_num,
+        prefix + "duration_den": duration_den,
+        prefix + "pitch_start": np.concatenate(([0], np.cumsum(pitch_counts, dtype=np.int64))),
+        prefix + "pitches": np.array([pitch for event in events for pitch in event[4]], dtype=np.int8),
+    }
+
+
+def extract_note_table(midi_file_path: str) -> dict:
+    """
+    Parse a MIDI file with music21 and extract the features used by tasks C1 and C3
+    - "notes_*": the notes and chords of each part in time order, onsets in quarter length from the start
+    - "score_*": the notes and chords in score order (music21 recurse), onsets relative to their measure
+    - "metronome_marks": (start, end, bpm) of each tempo region
+    - "nb_measures": number of measures of the first part
+    :param midi_file_path:
+    :return: dict of np.ndarray
+    """
+    import music21
+
+    midi_data = music21.converter.parse(midi_file_path)
+    notes = []
+    for part in midi_data.parts:
+        for element in part.flatten().notesAndRests:
+            if isinstance(element, music21.note.Note):
+                pitches = [element.pitch.midi]
+            elif isinstance(element, music21.chord.Chord):
+                pitches = [p.midi for p in element.pitches]
+            else:
+                continue
+            notes.append((element.offset, element.measureNumber, element.volume.velocity,
+                          element.duration.quarterLength, pitches))
+    score = []
+    for n in midi_data.recurse().notes:
+        if n.isNote:
+            pitches = [n.pitch.midi]
+        elif n.isChord:
+            pitches = [p.midi for p in n.pitches]
+        else:
+            continue
+        score.append((n.offset, n.measureNumber, n.volume.velocity, n.duration.quarterLength, pitches))
+
+    table = _events_to_arrays("notes_", notes)
+    table.update(_events_to_arrays("score_", score))
+    table["metronome_marks"] = np.array(
+        [(start, end, np.nan if mark.number is None else mark.number)
+         for start, end, mark in midi_data.metronomeMarkBoundaries()], dtype=np.float64).reshape(-1, 3)
+    table["nb_measures"] = np.array(len(midi_data.parts[0].getElementsByClass('Measure')), dtype=np.int64)
+    table["extractor_version"] = np.array(EXTRACTOR_VERSION, dtype=np.int64)
+    return table
+
+
+def extract_note_table_native(midi_file_path: str) -> dict:
+    """
+    Read a MIDI file with the lightweight reader of midi_reader and build the same note table as
+    extract_note_table, without music21
+    :param midi_file_path:
+    :return: dict of np.ndarray
+    """
+    notes, info = read_midi_file(midi_file_path)
+    max_denominator = max(info["ppq"], 12)
+    # The notes of a part sharing their onset and their duration make a chord, as in music21
+    notes = notes[np.lexsort((notes["pitch"], notes["duration"], notes["onset"], notes["track"]))]
+    keys = np.stack((notes["track"], notes["onset"], notes["duration"]), axis=1)
+    new_event = np.ones(len(notes), dtype=bool)
+    new_event[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    starts = np.flatnonzero(new_event)
+    ends = np.append(starts[1:], len(notes))
+    pitches = notes["pitch"].tolist()
+    velocities = notes["velocity"].tolist()
+
+    def to_quarter_length(value):
+        return Fraction(value).limit_denominator(max_denominator)
+
+    notes_events = []
+    score_events = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        note = notes[start]
+        # The velocity of a chord is the mean of the velocities of its notes, as music21 gives it
+        velocity = round(sum(velocities[start:end]) / (end - start))
+        event = (int(note["measure"]), velocity, to_quarter_length(note["duration"]), pitches[start:end])
+        notes_events.append((to_quarter_length(note["onset"]),) + event)
+        score_events.append((to_quarter_length(note["measure_offset"]),) + event)
+
+    table = _events_to_arrays("notes_", notes_events)
+    table.update(_events_to_arrays("score_", score_events))
+    table["metronome_marks"] = info["metronome_marks"]
+    table["nb_measures"] = np.array(info["nb_measures"], dtype=np.int64)
+    table["extractor_version"] = np.array(EXTRACTOR_VERSION, dtype=np.int64)
+    return table
+
+
+def check_native_reader(midi_file_path: str) -> bool:
+    """
+    Check that the lightweight reader gives the same note table as music21 for a MIDI file
+    :param midi_file_path:
+    :return: True if every column is equal
+    """
+    music21_table = extract_note_table(midi_file_path)
+    native_table = extract_note_table_native(midi_file_path)
+    return music21_table.keys() == native_table.keys() and all(
+        np.array_equal(music21_table[key], native_table[key]) for key in music21_table)
+
+
+EXTRACTORS = {
+    "music21": extract_note_table,
+    "native": extract_note_table_native,
+}
+
+
+def evict_cache(cache_dir: str = None, max_size: int = None):
+    """
+    Remove the least recently used entries until the cache is smaller than max_size
+    :param cache_dir: the cache directory, CACHE_DIR by default
+    :param max_size: maximum size in bytes, MAX_CACHE_SIZE by default
+    :return: None
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_size = MAX_CACHE_SIZE if max_size is None else max_size
+    entries = []
+    for file in os.listdir(cache_dir):
+        if file.endswith(".npz"):
+            try:
+                stat = os.stat(os.path.join(cache_dir, file))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, file in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, file))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def clear_cache(cache_dir: str = None):
+    """
+    Remove every entry of the cache
+    :param cache_dir: the cache directory, CACHE_DIR by default
+    :return: None
+    """
+    evict_cache(cache_dir, 0)
+
+
+def load_note_table(midi_file_path: str, use_cache: bool = True, cache_dir: str = None,
+                    max_size: int = None, reader: str = "music21") -> dict:
+    """
+    Get the note table of a MIDI file from the cache, or extract it and store it in the cache
+    :param midi_file_path:
+    :param use_cache: if False, always parse the file and do not touch the cache
+    :param cache_dir: the cache directory, CACHE_DIR by default
+    :param max_size: maximum size of the cache in bytes, MAX_CACHE_SIZE by default
+    :param reader: "music21" to parse the file with music21, "native" to use the lightweight reader of midi_reader
+    :return: dict of np.ndarray, see extract_note_table
+    """
+    if reader not in EXTRACTORS:
+        raise ValueError(f"Unknown MIDI reader: {reader}")
+    if use_cache:
+        with _preloaded_lock:
+            preloaded = _preloaded_tables.get(get_preload_key(midi_file_path, reader))
+        if preloaded is not None:
+            return dict(preloaded)
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    if not use_cache or not cache_dir:
+        return EXTRACTORS[reader](midi_file_path)
+    entry_path = os.path.join(cache_dir, f"{get_file_hash(midi_file_path)}-{reader}-v{EXTRACTOR_VERSION}.npz")
+    try:
+        with np.load(entry_path) as entry:
+            table = {key: entry[key] for key in entry.files}
+        # Mark the entry as recently used
+        os.utime(entry_path)
+        return table
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        pass
+
+    table = EXTRACTORS[reader](midi_file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **table)
+    # Write then rename so that concurrent readers never see a partial entry
+    temporary_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(temporary_path, entry_path)
+    evict_cache(cache_dir, max_size)
+    return table
+
+
+def get_preload_key(midi_file_path: str, reader: str) -> tuple or None:
+    """
+    :param midi_file_path:
+    :param reader: "music21" or "native"
+    :return: the key of a preloaded note table, with the mtime and size of the file so that a changed file
+    is loaded again, None if the file cannot be read
+    """
+    try:
+        stat = os.stat(midi_file_path)
+    except OSError:
+        return None
+    return os.path.abspath(midi_file_path), reader, stat.st_mtime_ns, stat.st_size
+
+
+def preload_note_table(midi_file_path: str, reader: str = "music21"):
+    """
+    Load the note table of a MIDI file and keep it in memory for the next calls of load_note_table,
+    used to read and parse the next pieces in a thread while the current one is analysed.
+    Only the last MAX_PRELOADED_TABLES tables are kept.
+    :param midi_file_path:
+    :param reader: "music21" or "native"
+    :return: None
+    """
+    key = get_preload_key(midi_file_path, reader)
+    if key is None:
+        return
+    with _preloaded_lock:
+        if key in _preloaded_tables:
+            _preloaded_tables.move_to_end(key)
+            return
+    table = load_note_table(midi_file_path, reader=reader)
+    with _preloaded_lock:
+        _preloaded_tables[key] = table
+        while len(_preloaded_tables) > MAX_PRELOADED_TABLES:
+            _preloaded_tables.popitem(last=False)
+
+
+def get_events(table: dict, prefix: str) -> tuple[list, list, list, list, list]:
+    """
+    Get the events of a note table as lists of Python values
+    :param table: note table from load_note_table
+    :param prefix: "notes_" or "score_"
+    :return: onsets, measure numbers, velocities, durations, pitches of each event
+    """
+    onsets = join_fractions(table[prefix + "onset_num"], table[prefix + "onset_den"])
+    durations = join_fractions(table[prefix + "duration_num"], table[prefix + "duration_den"])
+    measures = [None if measure == -1 else measure for measure in table[prefix + "measure"].tolist()]
+    velocities = [None if velocity == -1 else velocity for velocity in table[prefix + "velocity"].tolist()]
+    pitch_start = table[prefix + "pitch_start"].tolist()
+    all_pitches = table[prefix + "pitches"].tolist()
+    pitches = [all_pitches[pitch_start[i]:pitch_start[i + 1]] for i in range(len(onsets))]
+    return onsets, measures, velocities, durations, pitches
+
+
+def get_first_tempo(table: dict) -> float:
+    """
+    Get the tempo in BPM of the first metronome mark
+    :param table: note table from load_note_table
+    :return: float
+    """
+    return float(table["metronome_marks"][0][2])
@@ -0,0 +1,238 @@
+"""
+This module contains the offscreen rendering of the figures of every piece of the dataset in PNG or SVG files.
+For each piece, the tempo curve with the phrase boundaries and, when the piece has a performance MIDI,
+the scaled volume differences with the volume split points are drawn.
+
+The curves are decimated to the width of the figure in pixels, keeping the minimum and the maximum of the samples
+of each pixel column so that the peaks stay visible, and the boundary lines of a figure are a single collection.
+The figures are drawn on matplotlib Figure objects without pyplot, so the worker processes need no display.
+"""
+import os
+from functools import partial
+
+import numpy as np
+
+from src.manifest import list_pieces, load_manifest
+from src.parallel import map_pieces
+
+FIGURE_SIZE = (10, 4)
+DPI = 100
+FORMATS = ("png",)
+
+
+def decimate_min_max(x, y, nb_pixels: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the minimum and the maximum of the samples falling in each pixel column, and the samples of the lowest
+    and highest x
+    :param x: x of the samples, not necessarily increasing, e.g. the onsets of several parts one after the other
+    :param y: y of the samples
+    :param nb_pixels: number of pixel columns
+    :return: the kept x and y, sorted by x, in the order of the samples for the same x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if len(x) <= 2 * nb_pixels + 2:
+        order = np.argsort(x, kind="stable")
+        return x[order], y[order]
+    low = x.min()
+    extent = x.max() - low
+    if extent > 0:
+        columns = np.minimum(((x - low) / extent * nb_pixels).astype(np.int64), nb_pixels - 1)
+    else:
+        columns = np.zeros(len(x), dtype=np.int64)
+    # Sorted by column then y, the first sample of a column is its minimum and the last one its maximum
+    order = np.lexsort((y, columns))
+    sorted_columns = columns[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_columns[1:] != sorted_columns[:-1])))
+    ends = np.append(starts[1:], len(x))
+    kept = np.unique(np.concatenate(([np.argmin(x), np.argmax(x)], order[starts], order[ends - 1])))
+    kept = kept[np.argsort(x[kept], kind="stable")]
+    return x[kept], y[kept]
+
+
+def check_decimate_min_max(nb_samples: int = 10000, nb_pixels: int = 500, nb_parts: int = 2, seed: int = 0) -> bool:
+    """
+    Check that the decimation keeps the minimum and the maximum of every pixel column of random samples made of
+    several parts, each with increasing x, one after the other like the onsets of a multi-part performance.
+    The samples are checked at nb_samples per part and at a size below 2 * nb_pixels + 2, where they are all kept.
+    :param nb_samples: number of samples of each part
+    :param nb_pixels: number of pixel columns
+    :param nb_parts: number of parts
+    :param seed: seed of the random samples
+    :return: True if every column keeps its extrema and the kept samples are sorted by x, at both sizes
+    """
+    rng = np.random.default_rng(seed)
+    for size in (nb_samples, max(nb_pixels // nb_parts, 2)):
+        x = np.concatenate([np.sort(rng.uniform(0, 100, size)) for _ in range(nb_parts)])
+        y = rng.normal(size=len(x))
+        kept_x, kept_y = decimate_min_max(x, y, nb_pixels)
+        columns = np.minimum(((x - x.min()) / (x.max() - x.min()) * nb_pixels).astype(np.int64), nb_pixels - 1)
+        kept_columns = np.minimum(((kept_x - x.min()) / (x.max() - x.min()) * nb_pixels).astype(np.int64),
+                                  nb_pixels - 1)
+        for column in np.unique(columns):
+            values, kept_values = y[columns == column], kept_y[kept_columns == column]
+            if len(kept_values) == 0 or kept_values.min() != values.min() or kept_values.max() != values.max():
+                return False
+        if not (np.all(np.diff(kept_x) >= 0) and kept_x[0] == x.min() and kept_x[-1] == x.max()):
+            return False
+    return True
+
+
+def add_boundary_lines(ax, positions, **style):
+    """
+    Draw vertical lines over the whole height of the axes as a single LineCollection
+    :param ax: matplotlib Axes
+    :param positions: x of the lines
+    :param style: color, linestyle, linewidth... of the lines
+    :return: the LineCollection
+    """
+    return ax.vlines(np.asarray(positions, dtype=np.float64), 0, 1, transform=ax.get_xaxis_transform(), **style)
+
+
+def get_nb_pixels(figure) -> int:
+    """
+    :param figure: matplotlib Figure
+    :return: the width of the figure in pixels
+    """
+    return max(int(figure.get_figwidth() * figure.dpi), 1)
+
+
+def draw_curve(x, y, boundaries, title: str, xlabel: str, ylabel: str, figsize: tuple = FIGURE_SIZE,
+               dpi: int = DPI, boundary_style: dict = None):
+    """
+    Draw a decimated curve with its boundaries on a new offscreen figure
+    :param x: x of the samples
+    :param y: y of the samples
+    :param boundaries: x of the boundary lines
+    :param title: title of the axes
+    :param xlabel: label of the x axis
+    :param ylabel: label of the y axis
+    :param figsize: size of the figure in inches
+    :param dpi: resolution of the figure
+    :param boundary_style: style of the boundary lines, red dashed lines by default
+    :return: matplotlib Figure
+    """
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=figsize, dpi=dpi)
+    ax = figure.add_subplot()
+    ax.plot(*decimate_min_max(x, y, get_nb_pixels(figure)), linewidth=0.8)
+    add_boundary_lines(ax, boundaries, **(boundary_style or {"color": "r", "linestyle": "--", "linewidth": 0.5}))
+    ax.set(xlabel=xlabel, ylabel=ylabel, title=title)
+    ax.grid(True)
+    return figure
+
+
+def show_or_save(figure, output_path: str = None):
+    """
+    Show a pyplot figure, or write it in a file and close it
+    :param figure: matplotlib Figure created with pyplot
+    :param output_path: path to the file, the format is given by its extension, None to show the figure
+    :return: None
+    """
+    import matplotlib.pyplot as plt
+    if output_path is None:
+        plt.show()
+    else:
+        figure.savefig(output_path)
+        plt.close(figure)
+
+
+def get_figure_name(path: str, dataset_path: str) -> str:
+    """
+    :param path: path to the piece folder
+    :param dataset_path: path to the dataset
+    :return: the name of the piece in the figure file names, e.g. Bach_Fugue_bwv_846
+    """
+    return os.path.relpath(path, dataset_path).replace(os.sep, "_")
+
+
+def save_figure(figure, output_dir: str, name: str, formats: tuple = FORMATS) -> list[str]:
+    """
+    Write a figure in each format
+    :param figure: matplotlib Figure
+    :param output_dir: directory of the files
+    :param name: file name without extension
+    :param formats: e.g. ("png", "svg")
+    :return: the paths of the files
+    """
+    paths = []
+    for file_format in formats:
+        path = os.path.join(output_dir, f"{name}.{file_format}")
+        # Write then rename so that a crash never leaves a partial figure
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        figure.savefig(temporary_path, format=file_format)
+        os.replace(temporary_path, path)
+        paths.append(path)
+    return paths
+
+
+def render_piece(piece: tuple[str, str], dataset_path: str, output_dir: str, formats: tuple = FORMATS,
+                 figsize: tuple = FIGURE_SIZE, dpi: int = DPI) -> list[str]:
+    """
+    Render the figures of one piece
+    :param piece: path to the piece folder and path to its performance MIDI, from list_pieces
+    :param dataset_path: path to the dataset, to name the files
+    :param output_dir: directory of the files
+    :param formats: e.g. ("png", "svg")
+    :param figsize: size of the figures in inches
+    :param dpi: resolution of the figures
+    :return: the paths of the files
+    """
+    from src.feature_cache import get_first_tempo, load_note_table
+    from src.note_table import NoteTable
+    from src.task_c1 import VOLUME_THRESHOLD, filter_close_times, get_phrase_boundaries, get_tempo_ratios, \
+        get_timing_arrays, offset_to_seconds
+    from src.timing_for_one_piece import get_average_timing_one_piece
+
+    path, midi_path = piece
+    name = get_figure_name(path, dataset_path)
+    symbolic_onsets, performed_onsets, _ = get_timing_arrays(get_average_timing_one_piece(path))
+    tempo_ratios = get_tempo_ratios(symbolic_onsets, performed_onsets)
+    boundaries, _ = get_phrase_boundaries(path)
+    figure = draw_curve(np.arange(len(tempo_ratios)), tempo_ratios, boundaries, f"Tempo curve of {name}", "Beats",
+                        "Tempo Ratio", figsize, dpi)
+    paths = save_figure(figure, output_dir, f"{name}_tempo", formats)
+    if midi_path == "":
+        return paths
+
+    table = load_note_table(midi_path)
+    tempo = get_first_tempo(table)
+    notes = NoteTable(table, "notes_")
+    scaled_differences = notes.get_scaled_volume_differences()
+    split_points = filter_close_times(notes.get_volume_change_times(VOLUME_THRESHOLD, scaled_differences).tolist())
+    figure = draw_curve(offset_to_seconds(notes.get_onsets()[:-1], tempo), scaled_differences,
+                        [offset_to_seconds(x, tempo) for x in split_points], f"Volume differences of {name}",
+                        "Time[s]", "Volume Differences Scaled", figsize, dpi,
+                        {"color": "y", "linestyle": "--", "linewidth": 0.8})
+    return paths + save_figure(figure, output_dir, f"{name}_volume", formats)
+
+
+def render_whole_dataset(folder_path: str, output_dir: str, formats: tuple = FORMATS, workers: int = 1,
+                         chunksize: int = 1, progress=None, manifest: dict = None, figsize: tuple = FIGURE_SIZE,
+                         dpi: int = DPI) -> dict:
+    """
+    Render the figures of every piece of the dataset
+    :param folder_path: path to the dataset
+    :param output_dir: directory of the files, created if needed
+    :param formats: e.g. ("png", "svg")
+    :param workers: number of worker processes
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, (path, midi_path))
+    :param manifest: manifest of the dataset, from load_manifest(folder_path) by default
+    :param figsize: size of the figures in inches
+    :param dpi: resolution of the figures
+    :return: a dictionary with the paths of the files of each piece, "Error" for the pieces that failed
+    """
+    manifest = load_manifest(folder_path) if manifest is None else manifest
+    os.makedirs(output_dir, exist_ok=True)
+    render = partial(render_piece, dataset_path=folder_path, output_dir=output_dir, formats=tuple(formats),
+                     figsize=figsize, dpi=dpi)
+    results = {}
+    for (path, _), paths, error in map_pieces(render, list_pieces(manifest, folder_path), workers, chunksize,
+                                              progress):
+        if error is not None:
+            print(f"Error for {path}: {error}")
+            results[path] = "Error"
+        else:
+            results[path] = paths
+    return results
@@ -0,0 +1,192 @@
+"""
+This module contains the opt-in instrumentation of the dataset runners.
+When the tracing is enabled, every stage of every piece records its wall time, CPU time, peak memory
+and input sizes (notes, beats, patterns...), and the records are appended to a JSON Lines file.
+When it is disabled, trace_stage returns a shared no-op context and add_sizes does nothing.
+
+The tracing is enabled through environment variables, so the worker processes of map_pieces trace as well.
+"""
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+TRACE_ENV = "DM_TRACE_FILE"
+MEMORY_ENV = "DM_TRACE_MEMORY"
+
+_trace_path = os.environ.get(TRACE_ENV) or None
+_stack = []
+_piece = None
+_piece_records = None
+_NO_STAGE = contextlib.nullcontext()
+
+if _trace_path is not None and os.environ.get(MEMORY_ENV) == "1" and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+def enable_tracing(trace_path: str, memory: bool = False):
+    """
+    Enable the tracing in this process and in the worker processes started afterward
+    :param trace_path: path to the JSON Lines file, the records are appended to it
+    :param memory: record the peak memory of each stage with tracemalloc, which slows down the stages
+    :return: None
+    """
+    global _trace_path
+    _trace_path = trace_path
+    os.environ[TRACE_ENV] = trace_path
+    os.environ[MEMORY_ENV] = "1" if memory else "0"
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_tracing():
+    """
+    Disable the tracing
+    :return: None
+    """
+    global _trace_path
+    _trace_path = None
+    os.environ.pop(TRACE_ENV, None)
+    if os.environ.pop(MEMORY_ENV, None) == "1" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_tracing() -> bool:
+    """
+    :return: True if the tracing is enabled
+    """
+    return _trace_path is not None
+
+
+def write_records(records: list[dict]):
+    """
+    Append records to the trace file, in a single write so that the processes do not interleave their lines
+    :param records: list of dict
+    :return: None
+    """
+    if records and _trace_path is not None:
+        with open(_trace_path, "a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+class Stage:
+    """
+    Context manager recording the wall time, CPU time and peak memory of a stage
+    """
+    __slots__ = ("record", "wall", "cpu", "peak")
+
+    def __init__(self, stage: str, sizes: dict):
+        self.record = {"piece": _piece, "stage": stage, "sizes": sizes}
+        self.peak = 0
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            # The peak so far belongs to the enclosing stage
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        _stack.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = self.record
+        record["wall"] = time.perf_counter() - self.wall
+        record["cpu"] = time.process_time() - self.cpu
+        record["peak_memory"] = None
+        _stack.pop()
+        if tracemalloc.is_tracing():
+            record["peak_memory"] = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, record["peak_memory"])
+        if exc_type is not None:
+            record["error"] = str(exc_value)
+        if _piece_records is not None:
+            _piece_records.append(record)
+        else:
+            write_records([record])
+        return False
+
+
+def trace_stage(stage: str, **sizes):
+    """
+    Record a stage, e.g. with trace_stage("parse", notes=n): ...
+    :param stage: name of the stage
+    :param sizes: input sizes known before the stage, the others can be given with add_sizes
+    :return: context manager
+    """
+    if _trace_path is None:
+        return _NO_STAGE
+    return Stage(stage, sizes)
+
+
+def add_sizes(**sizes):
+    """
+    Add input sizes to the current stage
+    :param sizes: e.g. notes=n, patterns=p
+    :return: None
+    """
+    if _stack:
+        _stack[-1].record["sizes"].update(sizes)
+
+
+@contextlib.contextmanager
+def trace_piece(piece: str):
+    """
+    Record the stages of a piece, written together with its "total" stage when the piece is done
+    :param piece: name of the piece, e.g. its path
+    :return: context manager
+    """
+    global _piece, _piece_records
+    if _trace_path is None:
+        yield
+        return
+    _piece, _piece_records = piece, []
+    try:
+        with Stage("total", {}):
+            yield
+    finally:
+        records, _piece, _piece_records = _piece_records, None, None
+        write_records(records)
+
+
+def load_trace(trace_path: str) -> list[dict]:
+    """
+    Load the records of a trace file
+    :param trace_path: path to the JSON Lines file
+    :return: list of dict
+    """
+    with open(trace_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_trace(records: list[dict], nb_pieces: int = 10) -> str:
+    """
+    Summarize a trace as a table of the slowest pieces and a table of the stages
+    :param records: list of dict from load_trace
+    :param nb_pieces: number of pieces in the first table
+    :return: str
+    """
+    pieces = sorted((record for record in records if record["stage"] == "total"),
+                    key=lambda record: record["wall"], reverse=True)
+    lines = [f"{'slowest pieces':<60}{'wall':>10}{'cpu':>10}"]
+    for record in pieces[:nb_pieces]:
+        lines.append(f"{str(record['piece'])[-60:]:<60}{record['wall']:>10.3f}{record['cpu']:>10.3f}")
+
+    stages = {}
+    for record in records:
+        if record["stage"] != "total":
+            stages.setdefault(record["stage"], []).append(record)
+    lines.append("")
+    lines.append(f"{'stage':<20}{'count':>8}{'total wall':>12}{'total cpu':>12}{'max wall':>10}"
+                 f"{'max memory':>14}{'errors':>8}  slowest piece")
+    for stage, stage_records in sorted(stages.items(), key=lambda item: -sum(r["wall"] for r in item[1])):
+        slowest = max(stage_records, key=lambda record: record["wall"])
+        memories = [record["peak_memory"] for record in stage_records if record.get("peak_memory") is not None]
+        memory = f"{max(memories) / 2 ** 20:.1f}MB" if memories else "-"
+        lines.append(f"{stage:<20}{len(stage_records):>8}{sum(r['wall'] for r in stage_records):>12.3f}"
+                     f"{sum(r['cpu'] for r in stage_records):>12.3f}{slowest['wall']:>10.3f}{memory:>14}"
+                     f"{sum('error' in record for record in stage_records):>8}  {slowest['piece']}")
+    return "\n".join(lines)
@@ -0,0 +1,221 @@
+"""
+This module contains the manifest of the dataset, the list of the pieces with their score MIDI, performance MIDIs
+and annotation files, built with a single traversal of the dataset tree.
+
+The manifest records the mtime of every directory and the mtime and size of every file. It is stored as JSON
+in the feature cache directory and refreshed incrementally: a directory whose mtime did not change is not
+listed again, only its mtime is read.
+"""
+import hashlib
+import json
+import os
+
+from src import feature_cache
+
+# Increase when the format of the manifest changes, the old manifests are then rebuilt
+MANIFEST_VERSION = 1
+SCORE_ANNOTATIONS = "midi_score_annotations.txt"
+SCORE_MIDIS = ("midi_score.mid", "midi_score.midi")
+MIDI_EXTENSIONS = (".mid", ".midi")
+
+
+def get_manifest_path(dataset_path: str, cache_dir: str = None) -> str:
+    """
+    Get the default path of the manifest of a dataset
+    :param dataset_path: path to the dataset
+    :param cache_dir: the cache directory, CACHE_DIR by default
+    :return: str
+    """
+    cache_dir = feature_cache.CACHE_DIR if cache_dir is None else cache_dir
+    root_hash = hashlib.sha1(os.path.abspath(dataset_path).encode()).hexdigest()
+    return os.path.join(cache_dir, f"manifest-{root_hash}-v{MANIFEST_VERSION}.json")
+
+
+def scan_directory(dataset_path: str, relative_path: str, previous: dict, directories: dict, check_files: bool):
+    """
+    Record a directory and its subdirectories, top-down as os.walk
+    :param dataset_path: path to the dataset
+    :param relative_path: path of the directory relative to the dataset, "" for the dataset itself
+    :param previous: the directories of the previous manifest, reused when their mtime did not change
+    :param directories: dict filled with the record of each directory
+    :param check_files: read the mtime and size of the files of the unchanged directories again
+    :return: None
+    """
+    path = os.path.join(dataset_path, relative_path) if relative_path else dataset_path
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return
+    record = previous.get(relative_path)
+    if record is None or record["mtime_ns"] != mtime_ns:
+        record = {"mtime_ns": mtime_ns, "subdirs": [], "files": {}}
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            # Symbolic links to directories are listed but not followed, as os.walk does
+                            if not entry.is_symlink():
+                                record["subdirs"].append(entry.name)
+                        else:
+                            stat = entry.stat()
+                            record["files"][entry.name] = [stat.st_mtime_ns, stat.st_size]
+                    except OSError:
+                        continue
+        except OSError:
+            return
+    elif check_files:
+        files = {}
+        for name in record["files"]:
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            files[name] = [stat.st_mtime_ns, stat.st_size]
+        record = dict(record, files=files)
+    directories[relative_path] = record
+    for name in record["subdirs"]:
+        scan_directory(dataset_path, relative_path + "/" + name if relative_path else name, previous, directories,
+                       check_files)
+
+
+def get_pieces(directories: dict) -> dict:
+    """
+    Get the pieces of the dataset, the directories with a score annotation file
+    :param directories: the directories of the manifest
+    :return: dict of the score MIDI, the performance MIDIs and the annotation files of each piece directory
+    """
+    pieces = {}
+    for relative_path, record in directories.items():
+        files = record["files"]
+        if not any(name.endswith(SCORE_ANNOTATIONS) for name in files):
+            continue
+        pieces[relative_path] = {
+            "score_midi": next((name for name in files if name in SCORE_MIDIS), None),
+            "performance_midis": [name for name in files if name.endswith(".mid") and name != "midi_score.mid"],
+            "annotations": [name for name in files if name.endswith("annotations.txt")]
+        }
+    return pieces
+
+
+def build_manifest(dataset_path: str, previous: dict = None, check_files: bool = False) -> dict:
+    """
+    Build the manifest of a dataset
+    :param dataset_path: path to the dataset
+    :param previous: a previous manifest of the same dataset, its unchanged directories are not listed again
+    :param check_files: read the mtime and size of the files of the unchanged directories again
+    :return: dict with the "directories" (mtime, subdirectories and files with their mtime and size)
+    and the "pieces"
+    """
+    directories = {}
+    scan_directory(dataset_path, "", {} if previous is None else previous["directories"], directories, check_files)
+    return {
+        "version": MANIFEST_VERSION,
+        "root": os.path.abspath(dataset_path),
+        "directories": directories,
+        "pieces": get_pieces(directories)
+    }
+
+
+def load_manifest(dataset_path: str, manifest_path: str = None, refresh: bool = True,
+                  check_files: bool = False) -> dict:
+    """
+    Get the manifest of a dataset from its file, refreshed incrementally, or build it and store it
+    :param dataset_path: path to the dataset
+    :param manifest_path: path to the manifest file, get_manifest_path by default, "" to not store the manifest
+    :param refresh: refresh the stored manifest, if False it is used as it is
+    :param check_files: read the mtime and size of the files of the unchanged directories again
+    :return: dict, see build_manifest
+    """
+    manifest_path = get_manifest_path(dataset_path) if manifest_path is None else manifest_path
+    previous = None
+    if manifest_path:
+        try:
+            with open(manifest_path, "r") as f:
+                previous = json.load(f)
+            if previous.get("version") != MANIFEST_VERSION:
+                previous = None
+        except (OSError, ValueError):
+            previous = None
+    if previous is not None and not refresh:
+        return previous
+
+    manifest = build_manifest(dataset_path, previous, check_files)
+    if manifest_path and manifest != previous:
+        os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+        # Write then rename so that concurrent readers never see a partial manifest
+        temporary_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temporary_path, manifest_path)
+    return manifest
+
+
+def get_path(dataset_path: str, relative_path: str) -> str:
+    """
+    Join a path of the manifest to the dataset path, as os.walk joins its directories
+    :param dataset_path: path to the dataset
+    :param relative_path: path relative to the dataset, "" for the dataset itself
+    :return: str with "/" separators
+    """
+    path = os.path.join(dataset_path, *relative_path.split("/")) if relative_path else dataset_path
+    return path.replace("\\", "/")
+
+
+def list_pieces(manifest: dict, dataset_path: str) -> list[tuple[str, str]]:
+    """
+    List the pieces of a manifest in the order of os.walk
+    :param manifest: dict from load_manifest
+    :param dataset_path: path to the dataset
+    :return: list of (piece folder, first performance MIDI or "" if the piece has none)
+    """
+    pieces = []
+    for relative_path, piece in manifest["pieces"].items():
+        path = get_path(dataset_path, relative_path)
+        performance_midis = piece["performance_midis"]
+        pieces.append((path, path + "/" + performance_midis[0] if performance_midis else ""))
+    return pieces
+
+
+def list_score_midis(manifest: dict, dataset_path: str) -> list[str]:
+    """
+    List the score MIDI files of a manifest in the order of os.walk
+    :param manifest: dict from load_manifest
+    :param dataset_path: path to the dataset
+    :return: list of paths
+    """
+    return [get_path(dataset_path, relative_path + "/" + name if relative_path else name)
+            for relative_path, record in manifest["directories"].items()
+            for name in record["files"] if name in SCORE_MIDIS]
+
+
+def find_performance_midi(piece_path: str) -> str:
+    """
+    Find the first performance MIDI of a piece folder, when the piece is not taken from a manifest
+    :param piece_path: path to the piece folder
+    :return: path to the MIDI file or "" if the piece has none
+    """
+    manifest = build_manifest(piece_path)
+    for relative_path, record in manifest["directories"].items():
+        for name in record["files"]:
+            if name.endswith(".mid") and name != "midi_score.mid":
+                return get_path(piece_path, relative_path) + "/" + name
+    return ""
+
+
+def get_piece_key(piece: str, dataset_path: str = None) -> str:
+    """
+    Get the key of a piece shared by the outputs of the tasks, the path of its folder relative to the dataset
+    :param piece: path to the piece folder or to its score MIDI, or a key already relative to the dataset
+    :param dataset_path: path to the dataset, the pieces outside of it are kept as they are
+    :return: str with "/" separators
+    """
+    piece = piece.replace("\\", "/")
+    if piece.endswith(MIDI_EXTENSIONS):
+        piece = piece.rsplit("/", 1)[0]
+    if dataset_path is not None:
+        root = os.path.abspath(dataset_path)
+        path = os.path.abspath(piece)
+        if os.path.commonpath([root, path]) == root:
+            piece = os.path.relpath(path, root).replace("\\", "/")
+    return piece.rstrip("/")
@@ -0,0 +1,184 @@
+"""
+This module contains an array-backed view of the notes of a MIDI file, shared by tasks C1 and C3.
+The columns are the ones of the feature cache: exact onsets and durations as numerator and denominator,
+measure, velocity, and the pitches of each event (note or chord) as a flat array with the start of each event.
+
+The derived features are computed with NumPy on the columns, without a Python object per note:
+- task C3: the events sharing a (measure, offset) are grouped, with the root and the melodic interval of each onset
+- task C1: the scaled volume differences between consecutive notes and the times where they cross a threshold
+"""
+import numpy as np
+
+from src.feature_cache import join_fractions, load_note_table
+
+
+class NoteTable:
+    """
+    The events of one note table of the feature cache
+    - onset_num, onset_den: exact onset of each event in quarter length
+    - measure: measure number of each event, -1 if unknown
+    - velocity: velocity of each event, -1 if unknown
+    - duration_num, duration_den: exact duration of each event in quarter length
+    - pitch_start, pitches: the MIDI pitches of event i are pitches[pitch_start[i]:pitch_start[i + 1]]
+    """
+    __slots__ = ("onset_num", "onset_den", "measure", "velocity", "duration_num", "duration_den", "pitch_start",
+                 "pitches")
+
+    def __init__(self, table: dict, prefix: str = "notes_"):
+        """
+        :param table: note table from load_note_table, the arrays are shared, not copied
+        :param prefix: "notes_" for the notes in time order, "score_" for the notes in score order
+        """
+        self.onset_num = table[prefix + "onset_num"]
+        self.onset_den = table[prefix + "onset_den"]
+        self.measure = table[prefix + "measure"]
+        self.velocity = table[prefix + "velocity"]
+        self.duration_num = table[prefix + "duration_num"]
+        self.duration_den = table[prefix + "duration_den"]
+        self.pitch_start = table[prefix + "pitch_start"]
+        self.pitches = table[prefix + "pitches"]
+
+    def __len__(self):
+        return len(self.onset_num)
+
+    def get_onsets(self) -> np.ndarray:
+        """
+        :return: float64 onset of each event, the same floats as float() of the onsets of get_events
+        """
+        return self.onset_num / self.onset_den
+
+    def get_lowest_pitches(self) -> np.ndarray:
+        """
+        :return: the lowest MIDI pitch of each event
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.minimum.reduceat(self.pitches.astype(np.int64), self.pitch_start[:-1])
+
+    def group_onsets(self) -> "OnsetGroups":
+        """
+        Group the events by (measure, offset), as get_intervals of task_c3 does
+        The root of an onset is the lowest pitch of its events and its duration the one of its first event.
+        The interval is the difference with the root of the previous onset in the order of first appearance,
+        and is unknown for the first onset and for the onset (1, 0).
+        :return: OnsetGroups, sorted by measure and offset
+        """
+        keys = np.stack((self.measure.astype(np.int64), self.onset_num, self.onset_den), axis=1)
+        if len(keys) == 0:
+            return OnsetGroups(keys[:, 0], keys[:, 1], keys[:, 2], keys[:, 1], keys[:, 2],
+                               np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool))
+        _, first_events, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        # Number the onsets in the order of their first event
+        appearance = np.argsort(first_events, kind="stable")
+        group_numbers = np.empty(len(first_events), dtype=np.int64)
+        group_numbers[appearance] = np.arange(len(first_events))
+        event_groups = group_numbers[inverse.reshape(-1)]
+        first_events = first_events[appearance]
+
+        roots = np.full(len(first_events), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(roots, event_groups, self.get_lowest_pitches())
+        intervals = np.zeros(len(roots), dtype=np.int64)
+        intervals[1:] = np.diff(roots)
+        has_interval = np.ones(len(roots), dtype=bool)
+        has_interval[0] = False
+        has_interval &= ~((keys[first_events, 0] == 1) & (keys[first_events, 1] == 0))
+
+        measures = keys[first_events, 0]
+        order = np.lexsort((self.get_onsets()[first_events], measures))
+        first_events = first_events[order]
+        return OnsetGroups(measures[order], self.onset_num[first_events], self.onset_den[first_events],
+                           self.duration_num[first_events], self.duration_den[first_events], roots[order],
+                           intervals[order], has_interval[order])
+
+    def get_scaled_volume_differences(self) -> np.ndarray:
+        """
+        Squared differences of velocity between consecutive events, scaled to [0, 1],
+        the same values as get_scaled_differences_in_volumes of task_c1
+        :return: float64 array of len(self) - 1 values
+        """
+        differences = np.diff(self.velocity.astype(np.float64)) ** 2
+        if len(differences) == 0:
+            raise ValueError("max() arg is an empty sequence")
+        max_difference = differences.max()
+        if max_difference == 0:
+            raise ZeroDivisionError("division by zero")
+        return differences / max_difference
+
+    def get_volume_change_times(self, threshold: float, scaled_differences: np.ndarray = None) -> np.ndarray:
+        """
+        Onsets of the events followed by a volume change above a threshold, as get_times_threshold of task_c1
+        :param threshold: minimum scaled volume difference
+        :param scaled_differences: from get_scaled_volume_differences, computed if None
+        :return: float64 array of onsets
+        """
+        if scaled_differences is None:
+            scaled_differences = self.get_scaled_volume_differences()
+        return self.get_onsets()[:-1][scaled_differences > threshold]
+
+
+class OnsetGroups:
+    """
+    The onsets of a note table, from NoteTable.group_onsets
+    - measure, onset_num, onset_den: position (measure, offset) of each onset
+    - duration_num, duration_den: exact duration of each onset
+    - root: lowest pitch of each onset
+    - interval, has_interval: melodic interval with the previous onset, valid where has_interval is True
+    """
+    __slots__ = ("measure", "onset_num", "onset_den", "duration_num", "duration_den", "root", "interval",
+                 "has_interval")
+
+    def __init__(self, measure: np.ndarray, onset_num: np.ndarray, onset_den: np.ndarray,
+                 duration_num: np.ndarray, duration_den: np.ndarray, root: np.ndarray, interval: np.ndarray,
+                 has_interval: np.ndarray):
+        self.measure = measure
+        self.onset_num = onset_num
+        self.onset_den = onset_den
+        self.duration_num = duration_num
+        self.duration_den = duration_den
+        self.root = root
+        self.interval = interval
+        self.has_interval = has_interval
+
+    def __len__(self):
+        return len(self.measure)
+
+    def get_positions(self) -> list[tuple]:
+        """
+        :return: list of (measure, offset) of each onset, with the offsets as music21 gives them
+        """
+        measures = [None if measure == -1 else measure for measure in self.measure.tolist()]
+        return list(zip(measures, join_fractions(self.onset_num, self.onset_den)))
+
+    def get_durations(self) -> list:
+        """
+        :return: list of the exact durations of each onset, float if exact in binary, Fraction otherwise
+        """
+        return join_fractions(self.duration_num, self.duration_den)
+
+    def get_feature(self, feature: str) -> np.ndarray:
+        """
+        Get a feature as an array of values, equal values are equal rows
+        :param feature: "interval", "root" or "duration"
+        :return: np.ndarray with one row per onset
+        """
+        if feature == "interval":
+            # The unknown intervals share a value that no interval can take
+            return np.where(self.has_interval, self.interval, np.iinfo(np.int64).min)
+        if feature == "root":
+            return self.root
+        if feature == "duration":
+            return np.stack((self.duration_num, self.duration_den), axis=1)
+        raise ValueError(f"Unknown feature: {feature}")
+
+
+def load_notes(midi_file_path: str, prefix: str = "notes_", use_cache: bool = True, reader: str = "music21") \
+        -> NoteTable:
+    """
+    Get the NoteTable of a MIDI file from the feature cache
+    :param midi_file_path:
+    :param prefix: "notes_" for the notes in time order, "score_" for the notes in score order
+    :param use_cache: read the note table from the feature cache, the file is only parsed on a cache miss
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
+    :return: NoteTable
+    """
+    return NoteTable(load_note_table(midi_file_path, use_cache, reader=reader), prefix)
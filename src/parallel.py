@@ -0,0 +1,122 @@
+"""
+This module contains the helper used to run a function on every piece of the dataset,
+serially or on a pool of worker processes.
+
+The number of chunks submitted to the pool and not yielded yet is bounded, so the memory used by the pending
+results does not grow with the size of the dataset. An optional prefetch function (reading and parsing the
+files of a piece) runs in a thread on the next pieces while the current one is analysed. A worker only prefetches
+the items of its own chunk, so the chunks hold up to PREFETCH_CHUNK_FACTOR * (prefetch_depth + 1) items when
+there is a prefetch, otherwise each item of a chunk of one item would wait for its own prefetch.
+"""
+import itertools
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+DEFAULT_PREFETCH_DEPTH = 2
+# A chunk holds up to this number of times prefetch_depth + 1 items when there is a prefetch
+PREFETCH_CHUNK_FACTOR = 2
+
+
+def iter_prefetched(items: list, prefetch=None, prefetch_depth: int = DEFAULT_PREFETCH_DEPTH):
+    """
+    Iterate over the items while a thread runs the prefetch function on the next prefetch_depth items.
+    An item is yielded once its prefetch is done, so that it is never read twice at the same time.
+    :param items: the items
+    :param prefetch: function taking one item, its result is ignored and its errors are left to the function
+    that runs on the item afterward, None to not prefetch
+    :param prefetch_depth: number of items prefetched ahead of the current one
+    :return: generator of the items
+    """
+    if prefetch is None or prefetch_depth <= 0:
+        yield from items
+        return
+    iterator = iter(items)
+    # A single thread, so that the parsers are never run concurrently by the prefetch
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque((item, executor.submit(prefetch, item)) for item in itertools.islice(iterator, prefetch_depth))
+        while pending:
+            item, future = pending.popleft()
+            future.exception()
+            for next_item in itertools.islice(iterator, 1):
+                pending.append((next_item, executor.submit(prefetch, next_item)))
+            yield item
+
+
+def run_chunk(function, items: list, prefetch=None, prefetch_depth: int = DEFAULT_PREFETCH_DEPTH) -> list[tuple]:
+    """
+    Run a function on each item of a chunk, isolating the failures
+    :param function: module level function taking one item
+    :param items: the items of the chunk
+    :param prefetch: optional module level function run in a thread on the next items, see iter_prefetched
+    :param prefetch_depth: number of items prefetched ahead of the current one
+    :return: list of (result, error message) for each item, the error message is None on success
+    """
+    results = []
+    for item in iter_prefetched(items, prefetch, prefetch_depth):
+        try:
+            results.append((function(item), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def map_pieces(function, items: list, workers: int = 1, chunksize: int = 1, progress=None, prefetch=None,
+               prefetch_depth: int = DEFAULT_PREFETCH_DEPTH, max_in_flight: int = None, ordered: bool = True):
+    """
+    Run a function on every item, in the order of the items whatever the number of workers
+    :param function: module level function taking one item (it must be picklable when workers > 1)
+    :param items: the items, e.g. the paths of the pieces
+    :param workers: number of worker processes, 1 to run in the current process
+    :param chunksize: number of items sent to a worker at once, higher values save IPC for short pieces,
+    raised up to PREFETCH_CHUNK_FACTOR * (prefetch_depth + 1) with a prefetch so that it overlaps the items of a chunk
+    :param progress: optional callback progress(nb_done, nb_items, item) called when an item is done
+    :param prefetch: optional module level function run in a thread on the next items of the process
+    (or of the chunk of a worker) while the function runs on the current one, see iter_prefetched
+    :param prefetch_depth: number of items prefetched ahead of the current one
+    :param max_in_flight: maximum number of chunks submitted to the workers and not yielded yet,
+    2 * workers by default
+    :param ordered: yield the items in their order, if False a chunk is yielded as soon as it is done
+    :return: generator of (item, result, error message), the error message is None on success
+    """
+    items = list(items)
+    if workers is None or workers <= 1:
+        for done, item in enumerate(iter_prefetched(items, prefetch, prefetch_depth), start=1):
+            (result, error), = run_chunk(function, [item])
+            if progress is not None:
+                progress(done, len(items), item)
+            yield item, result, error
+        return
+
+    if prefetch is not None and prefetch_depth > 0:
+        # Without leaving workers idle on a small dataset
+        chunksize = max(chunksize, min(PREFETCH_CHUNK_FACTOR * (prefetch_depth + 1), -(-len(items) // workers)))
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), max(chunksize, 1))]
+    max_in_flight = 2 * workers if max_in_flight is None else max(max_in_flight, 1)
+    chunk_results = {}
+    next_chunk = 0
+    nb_submitted = 0
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        while next_chunk < len(chunks):
+            # Submit the chunks following the last one yielded, without more than max_in_flight pending
+            while nb_submitted < len(chunks) and nb_submitted - next_chunk < max_in_flight:
+                future = executor.submit(run_chunk, function, chunks[nb_submitted], prefetch, prefetch_depth)
+                futures[future] = nb_submitted
+                nb_submitted += 1
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                k = futures.pop(future)
+                chunk_results[k] = future.result()
+                for item in chunks[k]:
+                    done += 1
+                    if progress is not None:
+                        progress(done, len(items), item)
+            if ordered:
+                ready = itertools.takewhile(lambda k: k in chunk_results, itertools.count(next_chunk))
+            else:
+                ready = sorted(chunk_results)
+            for k in list(ready):
+                for item, (result, error) in zip(chunks[k], chunk_results.pop(k)):
+                    yield item, result, error
+                next_chunk += 1
@@ -0,0 +1,267 @@
+"""
+This module contains a suffix array based engine to find the repeating patterns of a sequence.
+It is used by task C3 instead of trying every (start, length) pair of the sequence.
+
+The engine works on integer codes: every distinct value of the sequence is mapped to an int,
+the suffix array and the LCP array are built on these codes, and the repeats are read
+from the LCP intervals (the internal nodes of the suffix tree).
+"""
+import bisect
+
+import numpy as np
+
+MIN_PATTERN_DURATION = 6.0
+
+
+def encode_sequence(sequence: list) -> np.ndarray:
+    """
+    Map each value of the sequence to an int code, equal values share the same code
+    :param sequence: list of hashable values (int, float, None, tuple...)
+    :return: np.ndarray of int64 codes
+    """
+    codes = {}
+    return np.fromiter((codes.setdefault(value, len(codes)) for value in sequence), dtype=np.int64,
+                       count=len(sequence))
+
+
+def encode_array(values: np.ndarray) -> np.ndarray:
+    """
+    Map each value (or row of a 2-D array) to an int code, the codes are numbered in order of first appearance
+    as in encode_sequence
+    :param values: np.ndarray of shape (n,) or (n, k)
+    :return: np.ndarray of int64 codes
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    _, first_indexes, inverse = np.unique(values, axis=0, return_index=True, return_inverse=True)
+    codes = np.empty(len(first_indexes), dtype=np.int64)
+    codes[np.argsort(first_indexes, kind="stable")] = np.arange(len(first_indexes))
+    return codes[inverse.reshape(-1)]
+
+
+def build_suffix_array(codes: np.ndarray) -> np.ndarray:
+    """
+    Build the suffix array of a sequence of int codes by prefix doubling
+    :param codes: np.ndarray of int codes
+    :return: np.ndarray, the start of each suffix in lexicographic order
+    """
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    rank = np.unique(codes, return_inverse=True)[1].astype(np.int64)
+    suffix_array = np.argsort(rank, kind="stable")
+    k = 1
+    while k < n:
+        # A suffix shorter than k is smaller than every suffix sharing its prefix
+        second = np.full(n, -1, dtype=np.int64)
+        second[:n - k] = rank[k:]
+        suffix_array = np.lexsort((second, rank))
+        first_sorted = rank[suffix_array]
+        second_sorted = second[suffix_array]
+        changed = np.empty(n, dtype=np.int64)
+        changed[0] = 0
+        changed[1:] = (first_sorted[1:] != first_sorted[:-1]) | (second_sorted[1:] != second_sorted[:-1])
+        rank = np.empty(n, dtype=np.int64)
+        rank[suffix_array] = np.cumsum(changed)
+        if rank[suffix_array[-1]] == n - 1:
+            break
+        k *= 2
+    return suffix_array.astype(np.int64)
+
+
+def build_lcp_array(codes: np.ndarray, suffix_array: np.ndarray) -> list[int]:
+    """
+    Build the LCP array with Kasai's algorithm
+    :param codes: np.ndarray of int codes
+    :param suffix_array: suffix array of the codes
+    :return: list where lcp[i] is the longest common prefix of the suffixes suffix_array[i - 1] and suffix_array[i]
+    """
+    n = len(suffix_array)
+    codes = codes.tolist()
+    suffix_array = suffix_array.tolist()
+    rank = [0] * n
+    for i, start in enumerate(suffix_array):
+        rank[start] = i
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        r = rank[i]
+        if r == 0:
+            h = 0
+            continue
+        j = suffix_array[r - 1]
+        while i + h < n and j + h < n and codes[i + h] == codes[j + h]:
+            h += 1
+        lcp[r] = h
+        if h > 0:
+            h -= 1
+    return lcp
+
+
+def iter_lcp_intervals(suffix_array: list[int], lcp: list[int]):
+    """
+    Iterate over the LCP intervals (internal nodes of the suffix tree) bottom-up
+    Each interval gathers the suffixes suffix_array[lb:rb + 1], which share their first `length` codes.
+    :param suffix_array: suffix array as a list
+    :param lcp: LCP array as a list
+    :return: generator of (length, parent_length, lb, rb, first_start, last_start)
+    """
+    n = len(suffix_array)
+    # Each entry: [length, lb, smallest start, largest start]
+    stack = [[0, 0, n, -1]]
+    for i in range(1, n + 1):
+        h = lcp[i] if i < n else 0
+        lb = i - 1
+        first_start = last_start = suffix_array[i - 1]
+        while h < stack[-1][0]:
+            top = stack.pop()
+            top[2] = min(top[2], first_start)
+            top[3] = max(top[3], last_start)
+            yield top[0], max(h, stack[-1][0]), top[1], i - 1, top[2], top[3]
+            lb, first_start, last_start = top[1], top[2], top[3]
+        if h > stack[-1][0]:
+            stack.append([h, lb, first_start, last_start])
+        else:
+            stack[-1][2] = min(stack[-1][2], first_start)
+            stack[-1][3] = max(stack[-1][3], last_start)
+
+
+def find_maximal_repeats(codes: np.ndarray, durations: list,
+                         min_duration: float = MIN_PATTERN_DURATION) -> list[tuple]:
+    """
+    Find the repeating patterns of a sequence of codes, with the semantics of the exhaustive search of task C3:
+    - a pattern is kept if it occurs again after its first occurrence without overlapping it
+    - the durations of its first occurrence must sum to at least min_duration
+    - the patterns contained in a longer kept pattern are removed
+    :param codes: np.ndarray of int codes (the last element is never part of a pattern)
+    :param durations: list of the durations of each element
+    :param min_duration: minimum total duration of a pattern
+    :return: list of (length, occurrences) sorted as the exhaustive search does, the occurrences being
+    the first occurrence followed by all the non overlapping ones
+    """
+    return find_maximal_repeats_multi([codes], durations, min_duration)[0]
+
+
+def find_maximal_repeats_multi(code_streams: list[np.ndarray], durations: list,
+                               min_duration: float = MIN_PATTERN_DURATION) -> list[list[tuple]]:
+    """
+    Find the repeating patterns of several sequences of the same length with a single suffix array.
+    The streams are concatenated with disjoint codes and a unique separator between them,
+    so no pattern can match across two streams.
+    :param code_streams: list of np.ndarray of int codes, one per feature
+    :param durations: list of the durations of each element, shared by all the streams
+    :param min_duration: minimum total duration of a pattern
+    :return: list with the output of find_maximal_repeats for each stream
+    """
+    return find_repeats_in_index(build_repeat_index(code_streams, durations), min_duration)
+
+
+class RepeatIndex:
+    """
+    The suffix array of the concatenated streams and its LCP intervals, which do not depend on the minimum
+    duration, so that find_repeats_in_index can be called for several minimum durations
+    - suffix_array: list of the start of each suffix in sorted order
+    - text_durations, prefix_durations: the duration of each element of the text and their prefix sums
+    - stream_starts: start of each stream in the text
+    - first_starts, lengths, lbs, rbs: first occurrence, longest non overlapping length and suffix array range
+      of each interval that can give a candidate
+    - interval_durations: total duration of the first occurrence of each of these intervals, from the prefix sums
+    """
+    __slots__ = ("nb_streams", "n", "suffix_array", "text_durations", "prefix_durations", "stream_starts",
+                 "first_starts", "lengths", "lbs", "rbs", "interval_durations")
+
+
+def build_repeat_index(code_streams: list[np.ndarray], durations: list) -> RepeatIndex:
+    """
+    Build the suffix array of several sequences of the same length and read its LCP intervals
+    :param code_streams: list of np.ndarray of int codes, one per feature
+    :param durations: list of the durations of each element, shared by all the streams
+    :return: RepeatIndex
+    """
+    index = RepeatIndex()
+    index.nb_streams = len(code_streams)
+    index.first_starts = index.lengths = index.lbs = index.rbs = np.zeros(0, dtype=np.int64)
+    index.interval_durations = np.zeros(0)
+    index.n = 0
+    # The exhaustive search never includes the last element in a pattern
+    m = max(len(durations) - 1, 0)
+    if m < 2:
+        return index
+    stream_durations = list(durations[:m])
+    parts = []
+    text_durations = []
+    stream_starts = []
+    code_offset = 0
+    for k, codes in enumerate(code_streams):
+        if k > 0:
+            parts.append(np.array([-k], dtype=np.int64))
+            text_durations.append(0)
+        stream_starts.append(sum(len(part) for part in parts))
+        parts.append(codes[:m] + code_offset)
+        text_durations.extend(stream_durations)
+        code_offset += int(codes.max()) + 1 if len(codes) else 0
+    text = np.concatenate(parts)
+    suffix_array = build_suffix_array(text)
+    lcp = build_lcp_array(text, suffix_array)
+    index.n = len(text)
+    index.suffix_array = suffix_array.tolist()
+    index.text_durations = text_durations
+    index.prefix_durations = np.concatenate(([0.0], np.cumsum(np.asarray(text_durations, dtype=np.float64))))
+    index.stream_starts = stream_starts
+
+    # The strings of an interval share their occurrences, only the longest valid one can be kept
+    intervals = []
+    for length, parent_length, lb, rb, first_start, last_start in iter_lcp_intervals(index.suffix_array, lcp):
+        longest = min(length, last_start - first_start)
+        if longest > parent_length:
+            intervals.append((first_start, longest, lb, rb))
+    if intervals:
+        index.first_starts, index.lengths, index.lbs, index.rbs = np.array(intervals, dtype=np.int64).T
+        index.interval_durations = (index.prefix_durations[index.first_starts + index.lengths]
+                                    - index.prefix_durations[index.first_starts])
+    return index
+
+
+def find_repeats_in_index(index: RepeatIndex, min_duration: float = MIN_PATTERN_DURATION) -> list[list[tuple]]:
+    """
+    Find the repeating patterns of the streams of an index for a minimum duration
+    :param index: RepeatIndex from build_repeat_index
+    :param min_duration: minimum total duration of a pattern
+    :return: list with the output of find_maximal_repeats for each stream
+    """
+    repeats = [[] for _ in range(index.nb_streams)]
+    if index.n == 0:
+        return repeats
+    n = index.n
+    suffix_array = index.suffix_array
+    text_durations = index.text_durations
+    reached = index.interval_durations >= min_duration
+    # Too close to the threshold for the prefix sums, use the same sum as the exhaustive search
+    for k in np.flatnonzero(np.abs(index.interval_durations - min_duration) <= 1e-6).tolist():
+        start = int(index.first_starts[k])
+        reached[k] = sum(text_durations[start:start + int(index.lengths[k])]) >= min_duration
+    selected = np.flatnonzero(reached)
+    candidates = list(zip(index.first_starts[selected].tolist(), index.lengths[selected].tolist(),
+                          index.lbs[selected].tolist(), index.rbs[selected].tolist()))
+
+    # A candidate is removed if one of its occurrences lies in the first occurrence of a longer candidate.
+    # Candidates never span a separator, so the streams cannot remove each other's candidates.
+    reach_from = [-1] * n
+    for first_start, length, _, _ in candidates:
+        reach_from[first_start] = max(reach_from[first_start], first_start + length)
+    reach_before = [-1] * n
+    for i in range(1, n):
+        reach_before[i] = max(reach_before[i - 1], reach_from[i - 1])
+
+    for first_start, length, lb, rb in candidates:
+        occurrences = sorted(suffix_array[lb:rb + 1])
+        if any(reach_before[start] >= start + length or reach_from[start] > start + length
+               for start in occurrences):
+            continue
+        k = bisect.bisect_right(index.stream_starts, first_start) - 1
+        offset = index.stream_starts[k]
+        repeats[k].append((length, [first_start - offset] + [start - offset for start in occurrences
+                                                             if start >= first_start + length]))
+    for stream_repeats in repeats:
+        stream_repeats.sort(key=lambda repeat: (-repeat[0], repeat[1][1]))
+    return repeats
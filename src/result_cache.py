@@ -0,0 +1,159 @@
+"""
+This module contains the memoization of the results of the detectors, so that a new run of the dataset
+only recomputes the pieces whose input files, parameters or detector changed.
+
+A result is stored as JSON in the "results" folder of the feature cache, keyed by the hash of the detector name,
+its version, the content hash of each input file and the parameters. The content hash of an annotation file is
+taken from the compiled annotation corpus when it is enabled, without reading the file.
+"""
+import hashlib
+import json
+import os
+
+from src import feature_cache
+from src.annotation_corpus import get_active_corpus
+from src.feature_cache import get_file_hash
+
+# Increase the version of a detector when its output changes, its old results are then ignored
+DETECTOR_VERSIONS = {
+    "boundaries": 1,
+    "phrase_boundaries": 1,
+    "number_of_phrases": 1,
+}
+
+_reuse_counts = {"reused": 0, "computed": 0}
+
+
+def get_result_cache_dir(cache_dir: str = None) -> str:
+    """
+    :param cache_dir: the feature cache directory, CACHE_DIR by default
+    :return: the directory of the results
+    """
+    return os.path.join(feature_cache.CACHE_DIR if cache_dir is None else cache_dir, "results")
+
+
+def get_input_hash(input_path: str) -> str:
+    """
+    :param input_path: a file read by a detector
+    :return: the content hash of the file, from the enabled annotation corpus when it holds the unchanged file
+    """
+    corpus = get_active_corpus()
+    content_hash = corpus.get_content_hash(input_path) if corpus is not None else None
+    return get_file_hash(input_path) if content_hash is None else content_hash
+
+
+def get_result_key(name: str, input_paths: list[str], parameters: dict) -> str:
+    """
+    Get the key of a result
+    :param name: name of the detector, a key of DETECTOR_VERSIONS
+    :param input_paths: the files read by the detector, their names and contents are hashed, not their folders
+    :param parameters: the parameters of the detector, JSON serializable
+    :return: str
+    """
+    key = {
+        "name": name,
+        "version": DETECTOR_VERSIONS[name],
+        "extractor_version": feature_cache.EXTRACTOR_VERSION,
+        "inputs": sorted((os.path.basename(path), get_input_hash(path)) for path in input_paths),
+        "parameters": parameters
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_entry_path(name: str, input_paths: list[str], parameters: dict, cache_dir: str = None) -> str:
+    """
+    :param name: name of the detector, a key of DETECTOR_VERSIONS
+    :param input_paths: the files read by the detector
+    :param parameters: the parameters of the detector, JSON serializable
+    :param cache_dir: the feature cache directory, CACHE_DIR by default
+    :return: the path to the entry of the result
+    """
+    return os.path.join(get_result_cache_dir(cache_dir), f"{name}-{get_result_key(name, input_paths, parameters)}.json")
+
+
+def has_cached_result(name: str, input_paths: list[str], parameters: dict, cache_dir: str = None) -> bool:
+    """
+    Check if a result is in the cache without reading it, e.g. to skip the prefetch of the pieces already done
+    :param name: name of the detector, a key of DETECTOR_VERSIONS
+    :param input_paths: the files read by the detector
+    :param parameters: the parameters of the detector, JSON serializable
+    :param cache_dir: the feature cache directory, CACHE_DIR by default
+    :return: bool
+    """
+    try:
+        return os.path.exists(get_entry_path(name, input_paths, parameters, cache_dir))
+    except OSError:
+        return False
+
+
+def get_cached_result(name: str, input_paths: list[str], parameters: dict, compute, use_cache: bool = True,
+                      cache_dir: str = None):
+    """
+    Get a result from the cache, or compute it and store it
+    :param name: name of the detector, a key of DETECTOR_VERSIONS
+    :param input_paths: the files read by the detector
+    :param parameters: the parameters of the detector, JSON serializable
+    :param compute: function without argument computing the result, JSON serializable
+    :param use_cache: if False, always compute the result and do not touch the cache
+    :param cache_dir: the feature cache directory, CACHE_DIR by default
+    :return: the result, the tuples are returned as lists when the result comes from the cache
+    """
+    if not use_cache:
+        return compute()
+    result_dir = get_result_cache_dir(cache_dir)
+    entry_path = get_entry_path(name, input_paths, parameters, cache_dir)
+    try:
+        with open(entry_path, "r") as f:
+            result = json.load(f)["result"]
+        _reuse_counts["reused"] += 1
+        return result
+    except (OSError, ValueError, KeyError):
+        pass
+
+    result = compute()
+    _reuse_counts["computed"] += 1
+    os.makedirs(result_dir, exist_ok=True)
+    # Write then rename so that concurrent readers never see a partial entry
+    temporary_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump({"name": name, "parameters": parameters, "result": result}, f)
+    os.replace(temporary_path, entry_path)
+    return result
+
+
+def invalidate_results(cache_dir: str = None):
+    """
+    Remove every stored result, the next run recomputes all the pieces
+    :param cache_dir: the feature cache directory, CACHE_DIR by default
+    :return: None
+    """
+    result_dir = get_result_cache_dir(cache_dir)
+    if not os.path.isdir(result_dir):
+        return
+    for file in os.listdir(result_dir):
+        if file.endswith(".json"):
+            try:
+                os.remove(os.path.join(result_dir, file))
+            except FileNotFoundError:
+                pass
+
+
+def get_reuse_counts() -> tuple[int, int]:
+    """
+    :return: the number of results reused from the cache and computed by this process
+    """
+    return _reuse_counts["reused"], _reuse_counts["computed"]
+
+
+def count_reuse(function, item) -> tuple:
+    """
+    Call a function and count the results it reused, to get the counts back from the worker processes
+    Use it with map_pieces as functools.partial(count_reuse, function)
+    :param function: module level function taking one item
+    :param item: the item
+    :return: the result of the function, the number of results reused and computed
+    """
+    reused, computed = get_reuse_counts()
+    result = function(item)
+    new_reused, new_computed = get_reuse_counts()
+    return result, new_reused - reused, new_computed - computed
@@ -0,0 +1,193 @@
+"""
+This module contains the columnar store of the results of the dataset runners.
+A store is a directory of Parquet part files with one row per piece, written by pandas as the pieces are done,
+so a crash only loses the rows that were not flushed yet. The boundaries are stored as list columns and a failed
+piece has its error message in the "error" column.
+
+Every part file costs a pandas and pyarrow write and a read per query, so the runners buffer RUNNER_BATCH_SIZE
+rows per part, losing at most that many rows on a crash, and compact the store into a single part at the end
+of a run.
+
+The queries read only the columns they need. pandas is imported when a store is written or read, so that the
+runners do not pay its import when they do not store their results.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+C3_COLUMNS = (("piece", "string"), ("boundaries", "list<int64>"), ("nb_boundaries", "int64"),
+              ("nb_measures", "int64"), ("approx_ratio", "float64"), ("error", "string"))
+C1_COLUMNS = (("piece", "string"), ("nb_phrases", "int64"), ("nb_measures", "int64"), ("approx_ratio", "float64"),
+              ("error", "string"))
+MEASURE_COLUMNS = (("piece", "string"), ("nb_measures", "int64"), ("error", "string"))
+# Number of rows of a part file written by the runners, a crash loses at most the rows of a batch
+RUNNER_BATCH_SIZE = 64
+
+
+def get_arrow_schema(columns: tuple):
+    """
+    Build the Arrow schema of the part files, so that the parts with only errors have the same column types
+    :param columns: tuple of (name, type), the type is an Arrow alias or "list<alias>"
+    :return: pyarrow.Schema
+    :raise ImportError: if pyarrow is missing or does not match the installed numpy
+    """
+    try:
+        import pyarrow as pa
+    except ImportError as e:
+        raise ImportError(f"The results store writes Parquet with pyarrow, install the version of requirements.txt: "
+                          f"{e}") from e
+    fields = []
+    for name, alias in columns:
+        if alias.startswith("list<"):
+            fields.append((name, pa.list_(pa.type_for_alias(alias[5:-1]))))
+        else:
+            fields.append((name, pa.type_for_alias(alias)))
+    return pa.schema(fields)
+
+
+class ResultsStore:
+    """
+    Directory of Parquet part files, one row per piece
+    """
+    __slots__ = ("path", "columns", "batch_size", "rows", "nb_parts")
+
+    def __init__(self, path: str, columns: tuple = C3_COLUMNS, batch_size: int = 1):
+        """
+        :param path: path to the directory of the store, created if needed
+        :param columns: tuple of (name, type) of the rows
+        :param batch_size: number of rows written together in a part file
+        """
+        self.path = path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows = []
+        os.makedirs(path, exist_ok=True)
+        self.nb_parts = len(self.get_parts())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+    def get_parts(self) -> list[str]:
+        """
+        :return: the paths of the part files, in the order they were written
+        """
+        return [os.path.join(self.path, file) for file in sorted(os.listdir(self.path)) if file.endswith(".parquet")]
+
+    def append(self, row: dict):
+        """
+        Add the row of a piece, written when batch_size rows are waiting
+        :param row: dict with the columns of the store, the missing ones are null
+        :return: None
+        """
+        self.rows.append({name: row.get(name) for name, _ in self.columns})
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the waiting rows in a new part file
+        :return: None
+        """
+        if not self.rows:
+            return
+        import pandas as pd
+        part_path = os.path.join(self.path, f"part-{self.nb_parts:06d}.parquet")
+        # Write then rename so that a crash never leaves a partial part
+        temporary_path = f"{part_path}.{os.getpid()}.tmp"
+        pd.DataFrame(self.rows).to_parquet(temporary_path, index=False, schema=get_arrow_schema(self.columns))
+        os.replace(temporary_path, part_path)
+        self.nb_parts += 1
+        self.rows = []
+
+    def clear(self):
+        """
+        Remove every row of the store
+        :return: None
+        """
+        for part_path in self.get_parts():
+            os.remove(part_path)
+        self.rows = []
+        self.nb_parts = 0
+
+    def compact(self):
+        """
+        Rewrite the rows of the store in a single part file, the stores written one row at a time
+        have one part file per piece
+        :return: None
+        """
+        self.flush()
+        parts = self.get_parts()
+        if len(parts) <= 1:
+            return
+        self.rows = self.load().to_dict("records")
+        # The old parts are removed once the new one is written
+        self.flush()
+        for part_path in parts:
+            os.remove(part_path)
+
+    def load(self, columns: list = None, errors: bool = True) -> "pd.DataFrame":
+        """
+        Read the rows of the store
+        :param columns: the columns to read, all of them by default
+        :param errors: keep the rows of the pieces that failed
+        :return: pd.DataFrame with a row per piece, in the order they were appended
+        """
+        import pandas as pd
+        parts = self.get_parts()
+        names = [name for name, _ in self.columns] if columns is None else list(columns)
+        read_columns = names if errors or "error" in names else names + ["error"]
+        if not parts:
+            return pd.DataFrame({name: [] for name in names})
+        # The nullable dtypes keep the integer columns as integers when the rows of the errors are null
+        frame = pd.concat([pd.read_parquet(part_path, columns=read_columns, dtype_backend="numpy_nullable")
+                           for part_path in parts], ignore_index=True)
+        if not errors:
+            frame = frame[frame["error"].isna()].reset_index(drop=True)
+        return frame[names]
+
+    def get_errors(self) -> "pd.DataFrame":
+        """
+        :return: pd.DataFrame of the pieces that failed with their error message
+        """
+        frame = self.load(["piece", "error"])
+        return frame[frame["error"].notna()].reset_index(drop=True)
+
+    def get_average_ratio(self, count_column: str) -> float:
+        """
+        Average of count_column / approx_ratio over the pieces that did not fail
+        :param count_column: "nb_boundaries" for task C3, "nb_phrases" for task C1
+        :return: float
+        """
+        frame = self.load([count_column, "approx_ratio"], errors=False)
+        return float((frame[count_column] / frame["approx_ratio"]).mean())
+
+
+def check_round_trip() -> bool:
+    """
+    Check that the rows written in a store are read back unchanged, with a failed piece among them
+    :return: True if the rows, the errors and the average ratio are read back
+    """
+    import pandas as pd
+    rows = [
+        {"piece": "a", "boundaries": [1, 5, 9], "nb_boundaries": 3, "nb_measures": 20, "approx_ratio": 2.5},
+        {"piece": "b", "error": "Error"},
+        {"piece": "c", "boundaries": [], "nb_boundaries": 0, "nb_measures": 8, "approx_ratio": 1.0}
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        store = ResultsStore(directory, C3_COLUMNS, batch_size=2)
+        for row in rows:
+            store.append(row)
+        store.flush()
+        frame = store.load()
+        loaded = [{name: None if np.ndim(value) == 0 and pd.isna(value) else value
+                   for name, value in frame.iloc[k].items()} for k in range(len(frame))]
+        loaded = [{**row, "boundaries": None if row["boundaries"] is None else [int(x) for x in row["boundaries"]]}
+                  for row in loaded]
+        expected = [{name: row.get(name) for name, _ in C3_COLUMNS} for row in rows]
+        return (loaded == expected and store.get_errors()["piece"].tolist() == ["b"]
+                and store.get_average_ratio("nb_boundaries") == (3 / 2.5 + 0 / 1.0) / 2)
@@ -0,0 +1,149 @@
+"""
+This module contains the sharding of the dataset runners over several processes or machines sharing a directory.
+
+A shard spec "3/16" selects the third of 16 shards. A piece belongs to the shard given by the hash of the path of
+its folder relative to the dataset, so the partition does not depend on the machine, on the location of the
+dataset or on the order of the directory listings, and the tasks of a piece always run on the same shard.
+Each shard writes its results in its own partial file of the shared directory, and merge_partials checks that
+every shard of the run is there and combines them into the results of the whole dataset, sorted by piece.
+
+Launched locally: python -m src c3 DATASET --shard $i/4 --output parts/ for i in 1..4, then
+python -m src merge parts/ --task c3.
+"""
+import hashlib
+import json
+import os
+import re
+
+from src.manifest import get_piece_key
+
+# Increase when the format of the partial files changes
+PARTIAL_VERSION = 1
+PARTIAL_PATTERN = re.compile(r"^(?P<task>[\w-]+)-shard-(?P<index>\d+)-of-(?P<count>\d+)\.json$")
+# Key of the number of boundaries of the results of each task, for the average ratio
+RATIO_KEYS = {"c3": "nb_boundaries", "c4": "nb_phrases"}
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """
+    :param spec: shard spec "index/count", the index starting at 1
+    :return: (index, count)
+    :raise ValueError: if the spec is not valid
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", spec)
+    if match is None:
+        raise ValueError(f"Invalid shard spec {spec!r}, expected index/count such as 3/16")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard spec {spec!r}, the index must be between 1 and {count}")
+    return index, count
+
+
+def get_shard_index(piece: str, dataset_path: str, count: int) -> int:
+    """
+    :param piece: path to the piece folder or to a file of the piece folder
+    :param dataset_path: path to the dataset
+    :param count: number of shards
+    :return: the shard of the piece, between 1 and count
+    """
+    key = get_piece_key(piece, dataset_path)
+    return int(hashlib.sha1(key.encode()).hexdigest()[:16], 16) % count + 1
+
+
+def select_shard(items: list, dataset_path: str, shard: tuple[int, int] = None, key=None) -> list:
+    """
+    Keep the items of the pieces of a shard
+    :param items: the items of the runner, e.g. the paths of the score MIDIs or the (piece folder, MIDI) of
+    list_pieces
+    :param dataset_path: path to the dataset
+    :param shard: (index, count) from parse_shard, None to keep every item
+    :param key: function giving the path of the piece of an item, the item itself by default
+    :return: list of the items of the shard, in their order
+    """
+    if shard is None:
+        return list(items)
+    index, count = shard
+    key = (lambda item: item) if key is None else key
+    return [item for item in items if get_shard_index(key(item), dataset_path, count) == index]
+
+
+def get_partial_path(directory: str, task: str, shard: tuple[int, int]) -> str:
+    """
+    :param directory: the shared directory of the partial files
+    :param task: name of the runner, e.g. "c3"
+    :param shard: (index, count)
+    :return: path to the partial file of the shard
+    """
+    index, count = shard
+    return os.path.join(directory, f"{task}-shard-{index:04d}-of-{count:04d}.json")
+
+
+def write_partial(results: dict, directory: str, task: str, shard: tuple[int, int]) -> str:
+    """
+    Write the results of a shard in its partial file
+    :param results: dict of the result of each piece of the shard
+    :param directory: the shared directory of the partial files, created if needed
+    :param task: name of the runner, e.g. "c3"
+    :param shard: (index, count)
+    :return: path to the partial file
+    """
+    os.makedirs(directory, exist_ok=True)
+    partial_path = get_partial_path(directory, task, shard)
+    # Write then rename so that the merge never reads a partial file being written
+    temporary_path = f"{partial_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump({"version": PARTIAL_VERSION, "task": task, "shard": list(shard), "results": results}, f)
+    os.replace(temporary_path, partial_path)
+    return partial_path
+
+
+def get_average_ratio(results: dict, task: str) -> float or None:
+    """
+    Average over the pieces of the number of boundaries divided by the approximate number of phrases,
+    the AVERAGE RATIO printed by the runners
+    :param results: dict of the result of each piece, "Error" for the pieces that failed
+    :param task: name of the runner, "c3" or "c4"
+    :return: float, None if the task has no ratio or no piece succeeded
+    """
+    if task not in RATIO_KEYS:
+        return None
+    ratios = [result[RATIO_KEYS[task]] / result["approx_ratio"] for result in results.values()
+              if isinstance(result, dict)]
+    return sum(ratios) / len(ratios) if ratios else None
+
+
+def merge_partials(directory: str, task: str) -> tuple[dict, float or None]:
+    """
+    Combine the partial files of the shards of a run
+    :param directory: the shared directory of the partial files
+    :param task: name of the runner, e.g. "c3"
+    :return: the results of every piece sorted by piece, and their average ratio
+    :raise ValueError: if the partial files do not come from a single complete run
+    """
+    partials = {}
+    for file in sorted(os.listdir(directory)):
+        match = PARTIAL_PATTERN.match(file)
+        if match is None or match.group("task") != task:
+            continue
+        with open(os.path.join(directory, file), "r") as f:
+            partial = json.load(f)
+        if partial.get("version") != PARTIAL_VERSION:
+            raise ValueError(f"{file} has the version {partial.get('version')} instead of {PARTIAL_VERSION}")
+        partials[tuple(partial["shard"])] = partial["results"]
+    counts = {count for _, count in partials}
+    if len(counts) != 1:
+        raise ValueError(f"Expected the partial files of one run of {task} in {directory}, "
+                         f"found shard counts {sorted(counts)}")
+    count = counts.pop()
+    missing = [index for index in range(1, count + 1) if (index, count) not in partials]
+    if missing:
+        raise ValueError(f"Missing the shards {missing} of {count} of {task} in {directory}")
+
+    results = {}
+    for shard in sorted(partials):
+        for piece, result in partials[shard].items():
+            if piece in results:
+                raise ValueError(f"{piece} is in several shards")
+            results[piece] = result
+    results = {piece: results[piece] for piece in sorted(results)}
+    return results, get_average_ratio(results, task)
@@ -0,0 +1,134 @@
+"""
+This module contains an online version of the phrase boundary detection of task C1.
+The beats of a performance are given one at a time, and the boundaries are emitted as soon as they
+are known, with at most one measure of latency. Only the running tempo change of the current measure
+and the mean tempo change of the previous measure are kept in memory.
+
+On a complete annotation file, the boundaries are the same as get_tempo_map_db and get_phrase_boundaries.
+"""
+from src.annotations import load_annotations
+
+
+class StreamingPhraseDetector:
+    """
+    Online phrase boundary detector
+    A downbeat is a boundary if it is the first or the last one, or if the mean tempo change of its measure
+    is positive while the one of the previous measure is negative.
+    """
+    __slots__ = ("symbolic_onsets", "nb_beats", "last_onset", "last_symbolic_onset", "last_tempo_ratio",
+                 "first_downbeat", "last_downbeat", "last_downbeat_onset", "measure_change_sum",
+                 "last_measure_change")
+
+    def __init__(self, symbolic_onsets=None):
+        """
+        :param symbolic_onsets: symbolic onset of each beat of the score, if they are not given to push
+        """
+        self.symbolic_onsets = symbolic_onsets
+        self.nb_beats = 0
+        self.last_onset = None
+        self.last_symbolic_onset = None
+        self.last_tempo_ratio = None
+        self.first_downbeat = None
+        self.last_downbeat = None
+        self.last_downbeat_onset = None
+        self.measure_change_sum = 0
+        self.last_measure_change = None
+
+    def push(self, onset: float, beat_type: str, symbolic_onset: float = None) -> list[tuple[int, float]]:
+        """
+        Add the next beat of the performance
+        :param onset: performed onset of the beat in seconds
+        :param beat_type: "db", "b"... (the meter and key suffixes are ignored)
+        :param symbolic_onset: symbolic onset of the beat, taken from symbolic_onsets if None
+        :return: list of the (beat, time) boundaries confirmed by this beat
+        """
+        beat = self.nb_beats
+        onset = float(onset)
+        symbolic_onset = float(self.symbolic_onsets[beat] if symbolic_onset is None else symbolic_onset)
+        boundaries = []
+        if beat > 0:
+            # Tempo ratio of the previous beat
+            duration_performed = onset - self.last_onset
+            if duration_performed == 0:
+                raise ZeroDivisionError("float division by zero")
+            tempo_ratio = (symbolic_onset - self.last_symbolic_onset) / duration_performed
+            if self.last_downbeat is not None and beat - 1 > self.last_downbeat:
+                self.measure_change_sum += tempo_ratio - self.last_tempo_ratio
+            self.last_tempo_ratio = tempo_ratio
+            # The first downbeat is a boundary once it has a tempo ratio
+            if beat - 1 == self.first_downbeat:
+                boundaries.append((self.first_downbeat, self.last_downbeat_onset))
+
+        if beat_type.split(",")[0] == "db":
+            if self.last_downbeat is not None:
+                # The measure of the last downbeat is complete
+                measure_change = self.measure_change_sum / (beat - self.last_downbeat)
+                if self.last_measure_change is not None and self.last_measure_change * measure_change < 0 \
+                        and measure_change > 0:
+                    boundaries.append((self.last_downbeat, self.last_downbeat_onset))
+                self.last_measure_change = measure_change
+            else:
+                self.first_downbeat = beat
+            self.last_downbeat = beat
+            self.last_downbeat_onset = onset
+            self.measure_change_sum = 0
+
+        self.nb_beats += 1
+        self.last_onset = onset
+        self.last_symbolic_onset = symbolic_onset
+        return boundaries
+
+    def finish(self) -> list[tuple[int, float]]:
+        """
+        End the performance
+        :return: list of the (beat, time) boundaries confirmed by the end, the last downbeat if it has a tempo ratio
+        """
+        if self.last_downbeat is not None and self.last_downbeat != self.first_downbeat \
+                and self.last_downbeat < self.nb_beats - 1:
+            return [(self.last_downbeat, self.last_downbeat_onset)]
+        return []
+
+
+def iter_annotation_beats(annotation_path: str):
+    """
+    Read the beats of an annotation file one line at a time
+    :param annotation_path: path to the annotation file
+    :return: generator of (onset, beat_type)
+    """
+    with open(annotation_path, "r") as f:
+        for line in f:
+            line_data = line.split()
+            if line_data:
+                yield float(line_data[0]), line_data[2]
+
+
+def detect_phrase_boundaries_stream(beats, symbolic_onsets=None):
+    """
+    Detect the phrase boundaries of a stream of beats
+    :param beats: iterable of (onset, beat_type) or (onset, beat_type, symbolic_onset)
+    :param symbolic_onsets: symbolic onset of each beat, needed if the beats have no symbolic onset
+    :return: generator of the (beat, time) boundaries, in the order of the beats
+    """
+    detector = StreamingPhraseDetector(symbolic_onsets)
+    for beat in beats:
+        yield from detector.push(*beat)
+    yield from detector.finish()
+
+
+def check_streaming_detector(symbolic_path: str, performed_path: str) -> bool:
+    """
+    Check that the streaming detector gives the same boundaries as the batch detector of task C1 for a performance.
+    :param symbolic_path: path to the annotation file with the symbolic times
+    :param performed_path: path to the annotation file with the performed times
+    :return: True if the boundaries and their times are equal
+    """
+    from src.task_c1 import detect_phrase_boundaries_batch, get_tempo_ratios, get_timing_arrays
+    from src.timing_for_one_piece import get_piece_symbolic_to_performed_times
+
+    symbolic_onsets, performed_onsets, downbeats = get_timing_arrays(
+        get_piece_symbolic_to_performed_times(symbolic_path, performed_path))
+    boundaries, = detect_phrase_boundaries_batch([get_tempo_ratios(symbolic_onsets, performed_onsets)],
+                                                 [downbeats.nonzero()[0]])
+    streamed = list(detect_phrase_boundaries_stream(iter_annotation_beats(performed_path),
+                                                    load_annotations(symbolic_path).onsets))
+    return streamed == list(zip(boundaries.tolist(), performed_onsets[boundaries].tolist()))
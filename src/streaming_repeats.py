@@ -0,0 +1,367 @@
+"""
+This module contains an online version of the repeating pattern detection of task C3.
+The notes are given one at a time in the order of their position (measure, offset), the notes sharing a position
+make an onset with its root, interval and duration as in get_intervals of task_c3, and the repeat-start boundaries
+are emitted as soon as a repeat reaches the minimum duration, with one onset of latency.
+
+Each feature stream has an online suffix automaton of its recent onsets, where every state records the first end
+of its strings. The longest suffix of the stream having an earlier occurrence that does not overlap it is followed
+as the matching statistics of the stream: it grows by at most one onset per note and only shrinks along suffix
+links, so the work is amortized constant per note. A repeat is confirmed when this suffix lasts at least
+min_duration, and the start of its earlier occurrence and its own start are emitted as boundaries, merged with
+the boundaries emitted less than merge_gap measures away.
+
+The memory is bounded by the history window: the automaton covers the last window to 2 * window onsets, a second
+automaton is built from the last window onsets along the first one and replaces it when it reaches that size.
+
+Unlike get_boundaries, a repeat is reported when it is first confirmed, not as a maximal repeat of the whole piece,
+and a repeat starting inside the occurrence of the last repeat reported on a stream is taken as a part of it.
+"""
+from collections import Counter, deque
+
+from src.repeats import MIN_PATTERN_DURATION
+from src.task_c3 import FEATURES, MERGE_GAP
+
+HISTORY_WINDOW = 4096
+# The durations are summed exactly when their prefix sums are this close to the minimum duration
+DURATION_TOLERANCE = 1e-6
+
+
+class SuffixAutomaton:
+    """
+    Online suffix automaton of a sequence of hashable symbols
+    - offset: index in the stream of the first symbol of the automaton
+    - transitions, links, lengths: transitions, suffix link and length of the longest string of each state
+    - first_ends: index in the stream of the end of the first occurrence of the strings of each state
+    - last: state of the whole sequence
+    """
+    __slots__ = ("offset", "size", "transitions", "links", "lengths", "first_ends", "last")
+
+    def __init__(self, offset: int = 0):
+        """
+        :param offset: index in the stream of the first symbol that will be added
+        """
+        self.offset = offset
+        self.size = 0
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+        self.first_ends = [-1]
+        self.last = 0
+
+    def add_state(self, length: int, link: int, first_end: int, transitions: dict) -> int:
+        """
+        :return: the new state
+        """
+        self.transitions.append(transitions)
+        self.links.append(link)
+        self.lengths.append(length)
+        self.first_ends.append(first_end)
+        return len(self.lengths) - 1
+
+    def extend(self, symbol):
+        """
+        Add a symbol at the end of the sequence, amortized constant time
+        :param symbol: hashable value
+        :return: None
+        """
+        transitions, links, lengths = self.transitions, self.links, self.lengths
+        current = self.add_state(lengths[self.last] + 1, 0, self.offset + self.size, {})
+        state = self.last
+        while state != -1 and symbol not in transitions[state]:
+            transitions[state][symbol] = current
+            state = links[state]
+        if state != -1:
+            target = transitions[state][symbol]
+            if lengths[state] + 1 == lengths[target]:
+                links[current] = target
+            else:
+                clone = self.add_state(lengths[state] + 1, links[target], self.first_ends[target],
+                                       dict(transitions[target]))
+                while state != -1 and transitions[state].get(symbol) == target:
+                    transitions[state][symbol] = clone
+                    state = links[state]
+                links[target] = links[current] = clone
+        self.last = current
+        self.size += 1
+
+    def find_suffix_state(self, length: int) -> int:
+        """
+        :param length: length of a suffix of the sequence, at most its size
+        :return: the state of the suffix
+        """
+        state = self.last
+        while self.lengths[self.links[state]] >= length:
+            state = self.links[state]
+        return state
+
+
+class RepeatStream:
+    """
+    Longest suffix of a feature stream with an earlier non overlapping occurrence in the history window
+    - automaton: automaton of the last window to 2 * window onsets, shadow: automaton of the onsets since the
+      automaton reached window onsets, None before
+    - state, length: state of the suffix in the automaton and its length
+    - covered_end: last onset of the occurrence of the last repeat reported, -1 before
+    """
+    __slots__ = ("window", "automaton", "shadow", "state", "length", "covered_end")
+
+    def __init__(self, window: int = HISTORY_WINDOW):
+        """
+        :param window: minimum number of past onsets in which the earlier occurrences are searched
+        """
+        self.window = window
+        self.automaton = SuffixAutomaton()
+        self.shadow = None
+        self.state = 0
+        self.length = 0
+        self.covered_end = -1
+
+    def push(self, symbol) -> tuple[int, int]:
+        """
+        Add the next onset of the stream
+        :param symbol: feature of the onset
+        :return: (length of the suffix, end of its earliest non overlapping occurrence), length 0 if there is none
+        """
+        automaton = self.automaton
+        index = automaton.offset + automaton.size
+        automaton.extend(symbol)
+        if self.shadow is not None:
+            self.shadow.extend(symbol)
+        # A state split by the extension keeps the longest strings, the shorter ones moved to its suffix link
+        lengths, links = automaton.lengths, automaton.links
+        state = self.state
+        while lengths[links[state]] >= self.length and state != 0:
+            state = links[state]
+        # The previous suffix followed by the symbol is a suffix of the stream, so the transition exists
+        self.state = automaton.transitions[state][symbol]
+        self.length += 1
+
+        if self.shadow is not None and self.shadow.size >= self.window:
+            self.automaton, self.shadow = self.shadow, None
+            self.length = min(self.length, self.automaton.size)
+            self.state = self.automaton.find_suffix_state(self.length)
+        elif self.shadow is None and automaton.size >= self.window:
+            self.shadow = SuffixAutomaton(index + 1)
+        return self.shrink(index)
+
+    def shrink(self, index: int) -> tuple[int, int]:
+        """
+        Shorten the suffix until its earliest occurrence ends before it starts
+        :param index: index of the last onset
+        :return: (length of the suffix, end of its earliest occurrence)
+        """
+        automaton = self.automaton
+        lengths, links, first_ends = automaton.lengths, automaton.links, automaton.first_ends
+        state, length = self.state, self.length
+        while length > 0:
+            longest = index - first_ends[state]
+            if longest >= length:
+                break
+            if longest > lengths[links[state]]:
+                length = longest
+                break
+            state = links[state]
+            length = lengths[state]
+        self.state, self.length = state, length
+        return length, first_ends[state]
+
+
+def get_order(position: tuple) -> tuple:
+    """
+    :param position: (measure, offset), the measure is None for the notes outside of a measure
+    :return: sort key of the position, the notes outside of a measure first
+    """
+    measure, offset = position
+    return -1 if measure is None else measure, offset
+
+
+class StreamingRepeatDetector:
+    """
+    Online repeat-start boundary detector
+    The notes of an onset are gathered until a note with a later position arrives, the onset is then added to the
+    stream of each feature, and the measures of the two starts of a confirmed repeat are emitted.
+    """
+    __slots__ = ("keys", "min_duration", "merge_gap", "window", "streams", "history", "nb_onsets", "measures",
+                 "durations", "prefix_durations", "current_position", "current_root", "current_duration",
+                 "last_root", "emitted", "emitted_expiry")
+
+    def __init__(self, keys=FEATURES, min_duration: float = MIN_PATTERN_DURATION, merge_gap: int = MERGE_GAP,
+                 window: int = HISTORY_WINDOW):
+        """
+        :param keys: the features, "interval", "root" or "duration", a tuple of features is a joint feature
+        :param min_duration: minimum total duration of a repeat in quarter length
+        :param merge_gap: minimum number of measures between two boundaries
+        :param window: number of past onsets in which the repeats are searched, the memory grows with it
+        """
+        if window < 1:
+            raise ValueError("The history window must hold at least one onset")
+        self.keys = tuple(keys)
+        self.min_duration = min_duration
+        self.merge_gap = merge_gap
+        self.window = window
+        self.streams = [RepeatStream(window) for _ in self.keys]
+        # Measure, duration and prefix sum of the durations of the onsets of the window, in ring buffers
+        self.history = 2 * window + 2
+        self.nb_onsets = 0
+        self.measures = [0] * self.history
+        self.durations = [0.0] * self.history
+        self.prefix_durations = [0.0] * self.history
+        self.current_position = None
+        self.current_root = None
+        self.current_duration = None
+        self.last_root = None
+        # Number of times each measure was emitted in the window, and when each emission leaves the window
+        self.emitted = Counter()
+        self.emitted_expiry = deque()
+
+    def push(self, measure: int, offset, duration, pitches) -> list[int]:
+        """
+        Add the next note or chord
+        :param measure: measure number of the note, None outside of a measure
+        :param offset: offset of the note in its measure
+        :param duration: duration of the note in quarter length
+        :param pitches: MIDI pitches of the note
+        :return: list of the measures of the boundaries confirmed by the onset completed by this note
+        :raise ValueError: if the note comes before the previous one
+        """
+        position = (measure, offset)
+        if position == self.current_position:
+            self.current_root = min(self.current_root, min(pitches))
+            return []
+        if self.current_position is not None and get_order(position) < get_order(self.current_position):
+            raise ValueError(f"The note at {position} comes before the previous note at {self.current_position}")
+        boundaries = self.finish()
+        self.current_position = position
+        self.current_root = min(pitches)
+        self.current_duration = duration
+        return boundaries
+
+    def finish(self) -> list[int]:
+        """
+        Complete the current onset, at the end of the stream
+        :return: list of the measures of the boundaries confirmed by the onset
+        """
+        if self.current_position is None:
+            return []
+        measure, offset = self.current_position
+        root, duration = self.current_root, self.current_duration
+        self.current_position = None
+        interval = None if self.last_root is None or (measure, offset) == (1, 0) else root - self.last_root
+        self.last_root = root
+        features = {"interval": interval, "root": root, "duration": duration}
+        return self.add_onset(measure, duration, [tuple(features[name] for name in key) if isinstance(key, tuple)
+                                                  else features[key] for key in self.keys])
+
+    def get_duration(self, start: int, end: int) -> float:
+        """
+        :param start: index of the first onset, in the window
+        :param end: index of the last onset
+        :return: total duration of the onsets
+        """
+        history = self.history
+        total = self.prefix_durations[end % history] - self.prefix_durations[start % history] \
+            + self.durations[start % history]
+        if abs(total - self.min_duration) <= DURATION_TOLERANCE:
+            # Too close to the threshold for the prefix sums, use the same sum as get_boundaries
+            total = sum(self.durations[k % history] for k in range(start, end + 1))
+        return total
+
+    def add_onset(self, measure: int, duration, symbols: list) -> list[int]:
+        """
+        Add an onset to the streams and report the repeats it confirms
+        :param measure: measure number of the onset
+        :param duration: duration of the onset
+        :param symbols: feature of the onset for each key
+        :return: list of the measures of the new boundaries
+        """
+        index = self.nb_onsets
+        history = self.history
+        previous_prefix = self.prefix_durations[(index - 1) % history] if index > 0 else 0.0
+        self.measures[index % history] = measure
+        self.durations[index % history] = duration
+        self.prefix_durations[index % history] = previous_prefix + float(duration)
+        self.nb_onsets += 1
+        while self.emitted_expiry and self.emitted_expiry[0][0] <= index:
+            _, expired = self.emitted_expiry.popleft()
+            self.emitted[expired] -= 1
+            if self.emitted[expired] == 0:
+                del self.emitted[expired]
+
+        boundaries = []
+        for stream, symbol in zip(self.streams, symbols):
+            length, earlier_end = stream.push(symbol)
+            if length == 0:
+                continue
+            start = index - length + 1
+            if self.get_duration(start, index) < self.min_duration:
+                continue
+            if start > stream.covered_end:
+                for repeat_start in (earlier_end - length + 1, start):
+                    boundary = self.measures[repeat_start % history]
+                    if self.emit(boundary, index):
+                        boundaries.append(boundary)
+            stream.covered_end = index
+        return boundaries
+
+    def emit(self, boundary: int, index: int) -> bool:
+        """
+        Emit a boundary unless a boundary less than merge_gap measures away was emitted in the window
+        :param boundary: measure number, None outside of a measure
+        :param index: index of the current onset
+        :return: True if the boundary is emitted
+        """
+        if boundary is None or any(boundary + gap in self.emitted for gap in range(1 - self.merge_gap, self.merge_gap)):
+            return False
+        self.emitted[boundary] += 1
+        self.emitted_expiry.append((index + 2 * self.window, boundary))
+        return True
+
+
+def iter_note_table_events(table: dict, prefix: str = "score_"):
+    """
+    Replay the notes of a note table in the order of their position, as a live stream would give them
+    :param table: note table from load_note_table
+    :param prefix: "score_" for the positions in measures, as get_boundaries
+    :return: generator of (measure, offset, duration, pitches)
+    """
+    from src.feature_cache import get_events
+
+    offsets, measures, _, durations, pitches = get_events(table, prefix)
+    order = sorted(range(len(offsets)), key=lambda k: get_order((measures[k], offsets[k])))
+    for k in order:
+        yield measures[k], offsets[k], durations[k], pitches[k]
+
+
+def detect_repeat_boundaries_stream(notes, keys=FEATURES, min_duration: float = MIN_PATTERN_DURATION,
+                                    merge_gap: int = MERGE_GAP, window: int = HISTORY_WINDOW):
+    """
+    Detect the repeat-start boundaries of a stream of notes
+    :param notes: iterable of (measure, offset, duration, pitches) in the order of the positions
+    :param keys: the features of the repeats
+    :param min_duration: minimum total duration of a repeat in quarter length
+    :param merge_gap: minimum number of measures between two boundaries
+    :param window: number of past onsets in which the repeats are searched
+    :return: generator of the measures of the boundaries, as soon as they are confirmed
+    """
+    detector = StreamingRepeatDetector(keys, min_duration, merge_gap, window)
+    for note in notes:
+        yield from detector.push(*note)
+    yield from detector.finish()
+
+
+def get_streaming_boundaries(midi_file_path: str, reader: str = "music21", min_duration: float = MIN_PATTERN_DURATION,
+                             merge_gap: int = MERGE_GAP, window: int = HISTORY_WINDOW) -> list[int]:
+    """
+    Replay a MIDI file through the streaming detector, to compare its boundaries with get_boundaries
+    :param midi_file_path:
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
+    :param min_duration: minimum total duration of a repeat in quarter length
+    :param merge_gap: minimum number of measures between two boundaries
+    :param window: number of past onsets in which the repeats are searched
+    :return: sorted list of measure numbers
+    """
+    from src.feature_cache import load_note_table
+
+    notes = iter_note_table_events(load_note_table(midi_file_path, reader=reader))
+    return sorted(detect_repeat_boundaries_stream(notes, FEATURES, min_duration, merge_gap, window))
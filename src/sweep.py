@@ -0,0 +1,198 @@
+"""
+This module contains the parameter sweep of tasks C1 and C3.
+The features of a piece are extracted once and only the stages that depend on a threshold are run for each
+setting of the grid:
+- task C3: the repeat index of the piece is built once, the patterns are selected for each minimum duration
+  and merged for each merge gap.
+- task C1: the tempo boundaries and the scaled volume differences are computed once and sorted, the volume split
+  points of each volume threshold are a prefix of the sorted differences.
+
+The result is a tidy table with one row per piece and setting.
+"""
+import itertools
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from src.feature_cache import get_first_tempo, load_note_table
+from src.manifest import list_pieces, load_manifest
+from src.note_table import NoteTable
+from src.parallel import map_pieces
+from src.repeats import MIN_PATTERN_DURATION, build_repeat_index, find_repeats_in_index
+from src.task_c1 import VOLUME_THRESHOLD, filter_close_times, fuse_boundaries, get_phrase_boundaries, \
+    offset_to_seconds
+from src.task_c3 import FEATURES, MERGE_GAP, extract_onset_groups, get_feature_codes, get_number_of_measures, \
+    list_midi_files, merge_boundaries
+from src.task_c4 import get_number_of_measures as get_number_of_measures_c1
+
+DEFAULT_C3_GRID = {
+    "min_duration": (4.0, MIN_PATTERN_DURATION, 8.0, 12.0),
+    "merge_gap": (1, MERGE_GAP, 4),
+}
+DEFAULT_C1_GRID = {
+    "volume_threshold": (0.05, 0.1, VOLUME_THRESHOLD, 0.2, 0.3),
+    "threshold_closest": (1, 2, 4),
+    "threshold_similarity": (2, 5, 10),
+}
+COLUMNS = ["piece", "task", "min_duration", "merge_gap", "volume_threshold", "threshold_closest",
+           "threshold_similarity", "nb_boundaries", "nb_measures", "approx_ratio", "ratio", "error"]
+
+
+def get_settings(grid: dict, default_grid: dict) -> list[dict]:
+    """
+    Expand a grid into the list of its settings
+    :param grid: dict of the values of each parameter, the missing parameters take the values of default_grid
+    :param default_grid: DEFAULT_C3_GRID or DEFAULT_C1_GRID
+    :return: list of dict, the last parameter changes the fastest
+    """
+    unknown = set(grid) - set(default_grid)
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}, expected {list(default_grid)}")
+    grid = {name: tuple(grid.get(name, values)) for name, values in default_grid.items()}
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def sweep_c3_piece(midi_file: str, grid: dict = None) -> list[dict]:
+    """
+    Get the boundaries of one piece for every setting of a task C3 grid, the MIDI file is parsed once
+    and the repeat index is built once
+    :param midi_file: path to the midi_score.mid of the piece
+    :param grid: dict of the values of "min_duration" and "merge_gap", DEFAULT_C3_GRID by default
+    :return: list of dict with the setting, "boundaries" and "nb_measures"
+    """
+    settings = get_settings(grid or {}, DEFAULT_C3_GRID)
+    groups = extract_onset_groups(midi_file)
+    positions = groups.get_positions()
+    index = build_repeat_index(get_feature_codes(groups, FEATURES), groups.get_durations())
+    nb_measures = get_number_of_measures(midi_file)
+
+    rows = []
+    starts = {}
+    for setting in settings:
+        min_duration = setting["min_duration"]
+        if min_duration not in starts:
+            # Same order as compute_boundaries, the greedy merge depends on it
+            starts[min_duration] = [positions[start] for key_repeats in find_repeats_in_index(index, min_duration)
+                                    for _, pattern_starts in key_repeats for start in pattern_starts]
+        rows.append(dict(setting, boundaries=merge_boundaries(starts[min_duration], setting["merge_gap"]),
+                         nb_measures=nb_measures))
+    return rows
+
+
+def get_volume_split_times(notes: NoteTable, thresholds: list) -> dict:
+    """
+    Get the times when the volume changes exceed each threshold, as NoteTable.get_volume_change_times does
+    for one threshold. The differences are sorted once, the changes above a threshold are a prefix of the sorted order.
+    :param notes: NoteTable of the performance
+    :param thresholds: the volume thresholds
+    :return: dict of the list of times for each threshold
+    """
+    differences = notes.get_scaled_volume_differences()
+    onsets = notes.get_onsets()
+    order = np.argsort(-differences, kind="stable")
+    descending = -differences[order]
+    times = {}
+    for threshold in thresholds:
+        nb_above = int(np.searchsorted(descending, -threshold, side="left"))
+        times[threshold] = onsets[np.sort(order[:nb_above])].tolist()
+    return times
+
+
+def sweep_c1_piece(piece: tuple[str, str], grid: dict = None) -> list[dict]:
+    """
+    Get the number of phrases of one piece for every setting of a task C1 grid, the annotations and the
+    performance MIDI are read once
+    :param piece: path to the piece folder and path to its performance MIDI, from list_pieces
+    :param grid: dict of the values of "volume_threshold", "threshold_closest" and "threshold_similarity",
+    DEFAULT_C1_GRID by default
+    :return: list of dict with the setting, "nb_boundaries", "nb_measures" and "error" when a setting failed
+    """
+    path, midi_path = piece
+    settings = get_settings(grid or {}, DEFAULT_C1_GRID)
+    nb_measures = get_number_of_measures_c1(path)
+    _, boundaries_times = get_phrase_boundaries(path)
+    if midi_path == "":
+        return [dict(setting, nb_boundaries=0, nb_measures=nb_measures) for setting in settings]
+
+    table = load_note_table(midi_path)
+    tempo = get_first_tempo(table)
+    split_times = get_volume_split_times(NoteTable(table, "notes_"),
+                                         sorted({setting["volume_threshold"] for setting in settings}))
+    rows = []
+    split_points = {}
+    for setting in settings:
+        row = dict(setting, nb_measures=nb_measures)
+        key = (setting["volume_threshold"], setting["threshold_closest"])
+        try:
+            if key not in split_points:
+                split_points[key] = [offset_to_seconds(x, tempo)
+                                     for x in filter_close_times(split_times[key[0]], key[1])]
+            row["nb_boundaries"] = len(fuse_boundaries(boundaries_times, split_points[key],
+                                                       setting["threshold_similarity"]))
+        except Exception as e:
+            row["error"] = str(e)
+        rows.append(row)
+    return rows
+
+
+def run_sweep(dataset_path: str, c3_grid: dict = None, c1_grid: dict = None, tasks: tuple = ("c3", "c1"),
+              workers: int = 1, chunksize: int = 1, progress=None, manifest: dict = None) -> pd.DataFrame:
+    """
+    Run the parameter sweep of tasks C1 and C3 on the whole dataset
+    :param dataset_path: path to the dataset
+    :param c3_grid: dict of the values of the task C3 parameters, DEFAULT_C3_GRID by default
+    :param c1_grid: dict of the values of the task C1 parameters, DEFAULT_C1_GRID by default
+    :param tasks: the tasks to sweep
+    :param workers: number of worker processes, the results are the same as with 1
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, piece)
+    :param manifest: manifest of the dataset, from load_manifest(dataset_path) by default
+    :return: pd.DataFrame with a row per piece and setting, the parameters of the other task are null
+    and the rows of a piece that failed only have its error message
+    """
+    manifest = load_manifest(dataset_path) if manifest is None else manifest
+    rows = []
+    if "c3" in tasks:
+        for midi_file, piece_rows, error in map_pieces(partial(sweep_c3_piece, grid=c3_grid),
+                                                       list_midi_files(dataset_path, manifest), workers, chunksize,
+                                                       progress):
+            if error is not None:
+                rows.append({"piece": midi_file, "task": "c3", "error": error})
+                continue
+            for row in piece_rows:
+                boundaries = row.pop("boundaries")
+                rows.append(dict(row, piece=midi_file, task="c3", nb_boundaries=len(boundaries)))
+    if "c1" in tasks:
+        for (path, _), piece_rows, error in map_pieces(partial(sweep_c1_piece, grid=c1_grid),
+                                                       list_pieces(manifest, dataset_path), workers, chunksize,
+                                                       progress):
+            piece = path.replace("asap-dataset/", "")
+            if error is not None:
+                rows.append({"piece": piece, "task": "c1", "error": error})
+                continue
+            rows.extend(dict(row, piece=piece, task="c1") for row in piece_rows)
+
+    frame = pd.DataFrame(rows, columns=COLUMNS)
+    frame["approx_ratio"] = frame["nb_measures"] / 8
+    frame["ratio"] = frame["nb_boundaries"] / frame["approx_ratio"]
+    return frame
+
+
+def summarize_sweep(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Average ratio of each setting over the pieces, as the AVERAGE RATIO printed by the runners
+    :param frame: pd.DataFrame from run_sweep
+    :return: pd.DataFrame with a row per task and setting
+    """
+    parameters = [name for name in COLUMNS[2:7] if frame[name].notna().any()]
+    frame = frame[frame["error"].isna()]
+    summary = []
+    for task, task_frame in frame.groupby("task"):
+        names = [name for name in parameters if task_frame[name].notna().all()]
+        grouped = task_frame.groupby(names)["ratio"].agg(["mean", "count"]).reset_index()
+        summary.append(grouped.rename(columns={"mean": "average_ratio", "count": "nb_pieces"}).assign(task=task))
+    columns = ["task"] + parameters + ["average_ratio", "nb_pieces"]
+    if not summary:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(summary, ignore_index=True)[columns]
@@ -6,12 +6,51 @@ by averaging the timing attributes for each beat of a meter.
 @Date: 2024-03-26
 """
 import os
+from collections.abc import Mapping
 
-import matplotlib.pyplot as plt
-import music21
+import numpy as np
 
+from src.annotations import DOWNBEAT, SymbolicToPerformedView
+from src.feature_cache import get_events, get_first_tempo, load_note_table
+from src.instrumentation import add_sizes, trace_stage
+from src.manifest import find_performance_midi
+from src.note_table import NoteTable
+from src.result_cache import get_cached_result
 from src.timing_for_one_piece import get_average_timing_one_piece
 
+# Minimum scaled volume change of a volume split point
+VOLUME_THRESHOLD = 0.15
+
+
+def get_timing_arrays(symbolic_to_performed_times: Mapping) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the symbolic onsets, the performed onsets and the downbeat mask of each beat as arrays
+    :param symbolic_to_performed_times: dict from get_average_timing_one_piece
+    :return: np.ndarray, np.ndarray, np.ndarray of bool
+    """
+    if isinstance(symbolic_to_performed_times, SymbolicToPerformedView):
+        nb_beats = len(symbolic_to_performed_times)
+        return (symbolic_to_performed_times.symbolic_onsets[:nb_beats],
+                symbolic_to_performed_times.performed_onsets[:nb_beats],
+                symbolic_to_performed_times.annotations.beat_types[:nb_beats] == DOWNBEAT)
+    beats = [symbolic_to_performed_times[i] for i in range(len(symbolic_to_performed_times))]
+    return (np.array([float(beat["symbolic"]["onset"]) for beat in beats]),
+            np.array([float(beat["performed"]["onset"]) for beat in beats]),
+            np.array([beat["performed"]["beat_type"] == "db" for beat in beats], dtype=bool))
+
+
+def get_tempo_ratios(symbolic_onsets: np.ndarray, performed_onsets: np.ndarray) -> np.ndarray:
+    """
+    Compute the tempo ratio (symbolic duration / performed duration) of each beat but the last one
+    :param symbolic_onsets:
+    :param performed_onsets:
+    :return: np.ndarray
+    """
+    durations_performed = np.diff(performed_onsets)
+    if np.any(durations_performed == 0):
+        raise ZeroDivisionError("float division by zero")
+    return np.diff(symbolic_onsets) / durations_performed
+
 
 def get_tempo_map_db(symbolic_to_performed_times: dict) -> dict and list[int]:
     """
@@ -20,63 +59,115 @@ def get_tempo_map_db(symbolic_to_performed_times: dict) -> dict and list[int]:
     :param symbolic_to_performed_times:
     :return: dict
     """
-    result = {}
-    indexes = []
-    for i in range(len(symbolic_to_performed_times) - 1):
-        beat_type = symbolic_to_performed_times[i]["performed"]["beat_type"]
-        if beat_type == "db":
-            indexes.append(i)
-        onset = symbolic_to_performed_times[i]["performed"]["onset"]
-        next_onset = symbolic_to_performed_times[i + 1]["performed"]["onset"]
-        duration_performed = float(next_onset) - float(onset)
-        onset_symbolic = symbolic_to_performed_times[i]["symbolic"]["onset"]
-        next_onset_symbolic = symbolic_to_performed_times[i + 1]["symbolic"]["onset"]
-        duration_symbolic = float(next_onset_symbolic) - float(onset_symbolic)
-        result[i] = duration_symbolic / duration_performed
-    if symbolic_to_performed_times[len(symbolic_to_performed_times) - 1]["performed"]["beat_type"] == "db":
-        indexes.append(len(symbolic_to_performed_times) - 1)
-    return result, indexes
-
-
-def get_phrase_boundaries(path: str):
+    symbolic_onsets, performed_onsets, downbeats = get_timing_arrays(symbolic_to_performed_times)
+    tempo_ratios = get_tempo_ratios(symbolic_onsets, performed_onsets)
+    return dict(enumerate(tempo_ratios.tolist())), np.flatnonzero(downbeats).tolist()
+
+
+def get_measure_tempo_changes(tempo_ratios: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Compute the mean tempo change inside each measure, the measure k covering the beats starts[k] to ends[k] - 1
+    The changes between consecutive beats are summed in the beat order, as a loop over the beats would.
+    :param tempo_ratios: np.ndarray from get_tempo_ratios
+    :param starts: first beat of each measure
+    :param ends: first beat after each measure
+    :return: np.ndarray
+    """
+    changes = np.diff(tempo_ratios)
+    nb_changes = np.maximum(ends - starts - 1, 0)
+    total = np.zeros(len(starts))
+    # One step per beat of the longest measure, all the measures at once
+    for column in range(int(nb_changes.max(initial=0))):
+        active = np.flatnonzero(column < nb_changes)
+        total[active] = total[active] + changes[starts[active] + column]
+    return total / np.maximum(ends - starts, 1)
+
+
+def detect_phrase_boundaries_batch(tempo_ratios_list: list[np.ndarray], downbeats_list: list[np.ndarray]) \
+        -> list[np.ndarray]:
+    """
+    Detect the phrase boundaries of several pieces in one vectorized pass.
+    The first and the last downbeats are boundaries, and a downbeat is a boundary when the mean tempo change
+    of its measure is positive and the one of the previous measure is negative.
+    :param tempo_ratios_list: the tempo ratios of each piece, from get_tempo_ratios
+    :param downbeats_list: the indexes of the downbeats of each piece
+    :return: the indexes of the boundary beats of each piece
+    """
+    lengths = np.array([len(tempo_ratios) for tempo_ratios in tempo_ratios_list], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    tempo_ratios = np.concatenate([np.asarray(tempo_ratios, dtype=np.float64) for tempo_ratios in tempo_ratios_list]
+                                  + [np.zeros(1)])
+    local_downbeats = np.concatenate([np.asarray(downbeats, dtype=np.int64) for downbeats in downbeats_list]
+                                     + [np.zeros(0, dtype=np.int64)])
+    piece = np.repeat(np.arange(len(downbeats_list)), [len(downbeats) for downbeats in downbeats_list])
+    downbeats = local_downbeats + offsets[piece]
+
+    # Mean tempo change between each downbeat and the next one of the same piece
+    same_piece = piece[1:] == piece[:-1]
+    starts = downbeats[:-1]
+    ends = np.where(same_piece, downbeats[1:], starts)
+    measure_changes = get_measure_tempo_changes(tempo_ratios, starts, ends)
+
+    first = np.ones(len(downbeats), dtype=bool)
+    first[1:] = ~same_piece
+    last = np.ones(len(downbeats), dtype=bool)
+    last[:-1] = ~same_piece
+    inner = np.flatnonzero(~first & ~last)
+    is_boundary = first | last
+    last_measure_change = measure_changes[inner - 1]
+    next_measure_change = measure_changes[inner]
+    # Sign of the tempo change is different and the tempo is increasing inside the new measure
+    is_boundary[inner] = (last_measure_change * next_measure_change < 0) & (next_measure_change > 0)
+    # The last beat has no tempo ratio, it is never a boundary
+    is_boundary &= local_downbeats < lengths[piece]
+    return [local_downbeats[is_boundary & (piece == k)] for k in range(len(downbeats_list))]
+
+
+def get_annotation_files(path: str) -> list[str]:
+    """
+    Get the annotation files of a piece, the inputs of the tempo map
+    :param path: path to the piece folder
+    :return: list of paths
+    """
+    return [path + "/" + file for file in os.listdir(path) if file.endswith("annotations.txt")]
+
+
+def get_phrase_boundaries(path: str, use_cache: bool = True):
     """
     Get the phrase boundaries from the tempo map
+    The result is reused from the result cache while the annotation files and the detector are unchanged.
     :param path:
+    :param use_cache: read and store the result in the result cache
     :return:
     """
-    average = get_average_timing_one_piece(path)
-    tempo_map, indexes_db = get_tempo_map_db(average)
-
-    phrase_boundaries = []
-    for i in range(len(tempo_map)):
-        if i in indexes_db:
-            current_index = indexes_db.index(i)
-            if current_index == 0:
-                phrase_boundaries.append(i)
-                continue
-            last_db = indexes_db[current_index - 1]
-            if current_index == len(indexes_db) - 1:
-                phrase_boundaries.append(i)
-                continue
-            next_db = indexes_db[current_index + 1]
-            last_measure = list(tempo_map.values())[last_db:i]
-            next_measure = list(tempo_map.values())[i:next_db]
-            # -1 if the tempo is decreasing, 1 if the tempo is increasing inside the measure
-            last_measure_change = 0
-            for j in range(len(last_measure) - 1):
-                last_measure_change += last_measure[j + 1] - last_measure[j]
-            last_measure_change = last_measure_change / len(last_measure)
-            next_measure_change = 0
-            for j in range(len(next_measure) - 1):
-                next_measure_change += next_measure[j + 1] - next_measure[j]
-            next_measure_change = next_measure_change / len(next_measure)
-            # Check if sign of tempo change is different
-            if last_measure_change * next_measure_change < 0:
-                # Phrase boundary if the tempo is increasing inside the new measure
-                if next_measure_change > 0:
-                    phrase_boundaries.append(i)
-    boundaries_time = get_time_of_phrase_boundaries(phrase_boundaries, average)
-    return phrase_boundaries, boundaries_time
+    boundaries, boundaries_times = get_cached_result("phrase_boundaries", get_annotation_files(path), {},
+                                                     lambda: get_phrase_boundaries_batch([path])[0], use_cache)
+    return boundaries, boundaries_times
+
+
+def get_phrase_boundaries_batch(paths: list[str]) -> list[tuple]:
+    """
+    Get the phrase boundaries of several pieces, detected in a single vectorized pass
+    :param paths: paths to the piece folders
+    :return: list of (phrase boundaries, boundaries time) for each piece
+    """
+    tempo_ratios_list = []
+    downbeats_list = []
+    performed_onsets_list = []
+    for path in paths:
+        with trace_stage("averaging"):
+            average = get_average_timing_one_piece(path)
+            add_sizes(beats=len(average))
+        with trace_stage("tempo_map", beats=len(average)):
+            symbolic_onsets, performed_onsets, downbeats = get_timing_arrays(average)
+            tempo_ratios_list.append(get_tempo_ratios(symbolic_onsets, performed_onsets))
+            downbeats_list.append(np.flatnonzero(downbeats))
+            performed_onsets_list.append(performed_onsets)
+    with trace_stage("phrase_boundaries", pieces=len(paths)):
+        boundaries_list = detect_phrase_boundaries_batch(tempo_ratios_list, downbeats_list)
+        add_sizes(boundaries=sum(len(boundaries) for boundaries in boundaries_list))
+    return [(boundaries.tolist(), performed_onsets[boundaries].tolist())
+            for boundaries, performed_onsets in zip(boundaries_list, performed_onsets_list)]
 
 
 def get_time_of_phrase_boundaries(phrase_boundaries: list[int], average: dict):
@@ -92,41 +183,34 @@ def get_time_of_phrase_boundaries(phrase_boundaries: list[int], average: dict):
     return boundaries_time
 
 
-def get_times_volumes_measures(midi_file_path: str) -> tuple:
+def get_times_volumes_measures(midi_file_path: str, use_cache: bool = True, reader: str = "music21") -> tuple:
     """
     Extracts the start times, velocity values (volume), and measure numbers of each note from a MIDI file.
 
     Parameters:
     midi_file_path (str): The path to the input MIDI file.
+    use_cache (bool): Read the notes from the feature cache, the file is only parsed on a cache miss.
+    reader (str): "music21" or "native" for the lightweight reader of midi_reader.
     
     Returns:
     times (list of float): A list containing the start times of all the notes in the MIDI file.
     volumes (list of int): A list containing the velocity values of all the notes in the MIDI file.
     measures (list of int): A list containing the measure numbers of all the notes in the MIDI file.
     """
-    midi_data = music21.converter.parse(midi_file_path)
-
-    times = []
-    volumes = []
-    measures = []
-
-    for part in midi_data.parts:
-        for element in part.flatten().notesAndRests:
-            if isinstance(element, music21.note.Note):
-                start_time = element.offset
-                velocity = element.volume.velocity
-                measure_number = element.measureNumber
-                times.append(start_time)
-                volumes.append(velocity)
-                measures.append(measure_number)
-            elif isinstance(element, music21.chord.Chord):
-                start_time = element.offset
-                velocity = element.volume.velocity
-                measure_number = element.measureNumber
-                times.append(start_time)
-                volumes.append(velocity)
-                measures.append(measure_number)
+    return get_times_volumes_measures_from_table(load_note_table(midi_file_path, use_cache, reader=reader))
 
+
+def get_times_volumes_measures_from_table(table: dict) -> tuple:
+    """
+    Get the start times, velocity values (volume), and measure numbers of each note from a note table.
+
+    Parameters:
+    table (dict): The note table of a MIDI file, from feature_cache.load_note_table.
+
+    Returns:
+    times, volumes, measures: see get_times_volumes_measures.
+    """
+    times, measures, volumes, _, _ = get_events(table, "notes_")
     return times, volumes, measures
 
 
@@ -190,86 +274,190 @@ def offset_to_seconds(offset: float, tempo: float) -> float:
     return offset * quarter_note_duration
 
 
-def plot_volume(list_volume_performed: list[float], filtered_data: list[float], list_time: list[float], tempo: float):
+def plot_volume(list_volume_performed: list[float], filtered_data: list[float], list_time: list[float], tempo: float,
+                output_path: str = None):
     """
     Plots the scaled volume differences and highlights certain points with vertical lines.
+    The curve is decimated to the width of the figure and the lines are drawn as a single collection.
 
     Args:
     list_volume_performed (list of float): List of performed volume values.
     filtered_data (list of float): List of offsets that need to be highlighted.
     list_time (list of float): List of time offsets.
     tempo (float): The tempo in beats per minute (BPM).
+    output_path (str): Write the figure in this file instead of showing it.
     """
+    import matplotlib.pyplot as plt
+    from src.figure_renderer import add_boundary_lines, decimate_min_max, get_nb_pixels, show_or_save
     list_time_second = [offset_to_seconds(x, tempo) for x in list_time]
     list_filtered_second = [offset_to_seconds(x, tempo) for x in filtered_data]
     list_volume_differences_scaled = get_scaled_differences_in_volumes(list_volume_performed)
-    plt.figure(figsize=(10, 6))
-    plt.plot(list_time_second[:-2], list_volume_differences_scaled, linestyle='-', color='b')
-    for x in list_filtered_second:
-        plt.axvline(x=x, color='y', linestyle='--')
-    plt.xlabel('Time[s]')
-    plt.ylabel('Volume Differences Scaled ')
-    plt.title('Volume Differences Scaled')
-    plt.show()
+    figure, ax = plt.subplots(figsize=(10, 6))
+    ax.plot(*decimate_min_max(list_time_second[:-2], list_volume_differences_scaled, get_nb_pixels(figure)),
+            linestyle='-', color='b')
+    add_boundary_lines(ax, list_filtered_second, color='y', linestyle='--')
+    ax.set(xlabel='Time[s]', ylabel='Volume Differences Scaled ', title='Volume Differences Scaled')
+    show_or_save(figure, output_path)
 
 
-def get_number_of_phrases_detected(path: str) -> int:
+def filter_close_times(times: list[float], threshold_closest: float = 2) -> list[float]:
+    """
+    Keep a time only if it is more than threshold_closest after the last kept time.
+
+    Args:
+    times (list of float): List of times, the first one is always kept.
+    threshold_closest (float): The minimum gap between two kept times.
+
+    Returns:
+    list of float: The kept times.
+    """
+    filtered_data = [times[0]]
+    for i in range(1, len(times)):
+        if times[i] - filtered_data[-1] > threshold_closest:
+            filtered_data.append(times[i])
+    return filtered_data
+
+
+def fuse_boundaries(boundaries_times: list[float], split_points: list[float], threshold_similarity: float = 5) \
+        -> list[float]:
+    """
+    Fuse the tempo boundaries with the volume split points.
+    Each split point keeps the first unused tempo boundary (in time order) that is closer than threshold_similarity
+    to it, or that lies more than threshold_similarity outside the range of the split points.
+    The boundaries are sorted once, the window of each split point is found with searchsorted and the used
+    boundaries are skipped with a "next unused" union-find, so the fusion runs in O((n + m) log n).
+
+    Args:
+    boundaries_times (list of float): Times of the tempo boundaries, from get_phrase_boundaries.
+    split_points (list of float): Times of the volume split points.
+    threshold_similarity (float): Maximum distance in seconds between a boundary and a split point.
+
+    Returns:
+    list of float: The fused boundary times, in the order they were kept.
+    """
+    if len(split_points) == 0:
+        return []
+    times = np.unique(np.asarray(boundaries_times, dtype=np.float64))
+    nb_times = len(times)
+    min_velocity = min(split_points) - threshold_similarity
+    max_velocity = max(split_points) + threshold_similarity
+    # The boundaries before the split points come first in time order, the ones after come last
+    nb_before = int(np.count_nonzero(times < min_velocity))
+    first_after = nb_times - int(np.count_nonzero(times > max_velocity))
+    window_starts = np.searchsorted(times, np.asarray(split_points, dtype=np.float64) - threshold_similarity,
+                                    side="left").tolist()
+    next_unused = list(range(nb_times + 1))
+
+    def find_unused(i):
+        root = i
+        while next_unused[root] != root:
+            root = next_unused[root]
+        while next_unused[i] != root:
+            next_unused[i], i = root, next_unused[i]
+        return root
+
+    result_boundaries = []
+    for point, start in zip(split_points, window_starts):
+        j = find_unused(0)
+        if j >= nb_before:
+            j = nb_times
+            while start > 0 and abs(times[start - 1] - point) < threshold_similarity:
+                start -= 1
+            candidate = find_unused(start)
+            while candidate < nb_times and times[candidate] - point < threshold_similarity:
+                if abs(times[candidate] - point) < threshold_similarity:
+                    j = candidate
+                    break
+                candidate = find_unused(candidate + 1)
+            if j == nb_times:
+                j = find_unused(first_after)
+        if j < nb_times:
+            result_boundaries.append(float(times[j]))
+            next_unused[j] = j + 1
+    return result_boundaries
+
+
+def get_fused_phrase_boundaries(path: str, threshold_similarity: float = 5, threshold_closest: float = 2,
+                                midi_path: str = None, volume_threshold: float = VOLUME_THRESHOLD) -> list[float]:
     """
     Merged model_p
     :param path:
-    :return: number of phrases detected
+    :param threshold_similarity: maximum distance in seconds between a tempo boundary and a volume split point
+    :param threshold_closest: minimum gap in quarter length between two volume split points
+    :param midi_path: performance MIDI of the piece from the manifest, "" if it has none, searched in path if None
+    :param volume_threshold: minimum scaled volume change of a volume split point
+    :return: the times of the phrase boundaries detected
     """
     boundaries, boundaries_times = get_phrase_boundaries(path)
-    midi_path = ""
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file.endswith(".mid") and file != "midi_score.mid":
-                midi_path = root + "/" + file
-                break
+    if midi_path is None:
+        midi_path = find_performance_midi(path)
     if midi_path == "":
-        return 0
-    midi_data = music21.converter.parse(midi_path)
-    tempo = midi_data.metronomeMarkBoundaries()[0][2].number
-    list_time, list_volumes, list_measures = get_times_volumes_measures(midi_path)
-    list_volume_differences_scaled = get_scaled_differences_in_volumes(list_volumes)
-    times_above_threshold_ = get_times_threshold(list_time, list_volume_differences_scaled, 0.15)
-    times_above_threshold = [float(x) for x in times_above_threshold_]
-    threshold_closest = 2
-
-    filtered_data = [times_above_threshold[0]]
-    for i in range(1, len(times_above_threshold)):
-        if times_above_threshold[i] - filtered_data[-1] > threshold_closest:
-            filtered_data.append(times_above_threshold[i])
-
+        return []
+    with trace_stage("parse"):
+        table = load_note_table(midi_path)
+        add_sizes(notes=len(table["notes_onset_num"]))
+    with trace_stage("fusion", notes=len(table["notes_onset_num"]), boundaries=len(boundaries_times)):
+        fused_boundaries = fuse_boundaries_with_table(boundaries_times, table, threshold_similarity,
+                                                      threshold_closest, volume_threshold)
+        add_sizes(phrases=len(fused_boundaries))
+    return fused_boundaries
+
+
+def fuse_boundaries_with_table(boundaries_times: list[float], table: dict, threshold_similarity: float = 5,
+                               threshold_closest: float = 2, volume_threshold: float = VOLUME_THRESHOLD) \
+        -> list[float]:
+    """
+    Fuse the tempo boundaries with the volume split points of a performance
+    :param boundaries_times: times of the tempo boundaries, from get_phrase_boundaries
+    :param table: note table of the performance MIDI, from load_note_table
+    :param threshold_similarity: maximum distance in seconds between a tempo boundary and a volume split point
+    :param threshold_closest: minimum gap in quarter length between two volume split points
+    :param volume_threshold: minimum scaled volume change of a volume split point
+    :return: the times of the phrase boundaries detected
+    """
+    tempo = get_first_tempo(table)
+    times_above_threshold = NoteTable(table, "notes_").get_volume_change_times(volume_threshold).tolist()
+    filtered_data = filter_close_times(times_above_threshold, threshold_closest)
     split_point = [offset_to_seconds(x, tempo) for x in filtered_data]
+    return fuse_boundaries(boundaries_times, split_point, threshold_similarity)
 
-    potential_split_point = [split_point[0]]
-    for point in split_point:
-        for p in potential_split_point:
-            if abs(p - point) < 5:
-                break
-        else:
-            potential_split_point.append(point)
 
-    result_boundaries = []
-    boundaries_to_times = {}
-    for i in range(len(boundaries)):
-        boundaries_to_times[boundaries_times[i]] = boundaries[i]
-
-    threshold_similarity = 5
-    min_velocity = min(split_point) - threshold_similarity
-    max_velocity = max(split_point) + threshold_similarity
-
-    for point in split_point:
-        for boundaries_time in boundaries_times:
-            if abs(boundaries_time - point) < threshold_similarity and boundaries_time not in result_boundaries:
-                result_boundaries.append(boundaries_time)
-                break
-            elif boundaries_time < min_velocity and boundaries_time not in result_boundaries:
-                result_boundaries.append(boundaries_time)
-                break
-            elif boundaries_time > max_velocity and boundaries_time not in result_boundaries:
-                result_boundaries.append(boundaries_time)
-                break
-
-    return len(result_boundaries)
+def get_number_of_phrases_detected(path: str, threshold_similarity: float = 5, threshold_closest: float = 2,
+                                   midi_path: str = None, use_cache: bool = True,
+                                   volume_threshold: float = VOLUME_THRESHOLD) -> int:
+    """
+    Merged model_p
+    The result is reused from the result cache while the input files, the parameters and the detector are unchanged.
+    :param path:
+    :param threshold_similarity: maximum distance in seconds between a tempo boundary and a volume split point
+    :param threshold_closest: minimum gap in quarter length between two volume split points
+    :param midi_path: performance MIDI of the piece from the manifest, "" if it has none, searched in path if None
+    :param use_cache: read and store the result in the result cache
+    :param volume_threshold: minimum scaled volume change of a volume split point
+    :return: number of phrases detected
+    """
+    if midi_path is None:
+        midi_path = find_performance_midi(path)
+    input_paths, parameters = get_number_of_phrases_key(path, midi_path, threshold_similarity, threshold_closest,
+                                                        volume_threshold)
+    return get_cached_result("number_of_phrases", input_paths, parameters,
+                             lambda: len(get_fused_phrase_boundaries(path, threshold_similarity, threshold_closest,
+                                                                     midi_path, volume_threshold)), use_cache)
+
+
+def get_number_of_phrases_key(path: str, midi_path: str, threshold_similarity: float = 5,
+                              threshold_closest: float = 2,
+                              volume_threshold: float = VOLUME_THRESHOLD) -> tuple[list[str], dict]:
+    """
+    :param path: path to the piece folder
+    :param midi_path: performance MIDI of the piece, "" if it has none
+    :return: the input files and the parameters of get_number_of_phrases_detected in the key of its result
+    in the result cache
+    """
+    parameters = {
+        "threshold_similarity": threshold_similarity,
+        "threshold_closest": threshold_closest,
+        "volume_threshold": volume_threshold,
+        "performance": os.path.basename(midi_path)
+    }
+    return get_annotation_files(path) + ([midi_path] if midi_path else []), parameters
@@ -1,31 +1,80 @@
-import os
+from functools import partial
 
-import music21
+import numpy as np
 
+from src.approximate_repeats import find_approximate_repeats
+from src.feature_cache import get_events, load_note_table, preload_note_table
+from src.instrumentation import add_sizes, disable_tracing, enable_tracing, load_trace, summarize_trace, \
+    trace_piece, trace_stage
+from src.manifest import list_score_midis, load_manifest
+from src.note_table import NoteTable, OnsetGroups
+from src.parallel import DEFAULT_PREFETCH_DEPTH, map_pieces
+from src.result_cache import count_reuse, get_cached_result, has_cached_result, invalidate_results
+from src.results_store import C3_COLUMNS, RUNNER_BATCH_SIZE, ResultsStore
+from src.sharding import select_shard
+from src.repeats import MIN_PATTERN_DURATION, encode_array, encode_sequence, find_maximal_repeats_multi
 
-def extract_intervals_and_durations(midi_file_path) -> dict:
+FEATURES = ('interval', 'root', 'duration')
+# The intervals make the approximate search transposition invariant and blind to the rhythm
+APPROXIMATE_FEATURES = ('interval',)
+# Minimum number of measures between two merged boundaries
+MERGE_GAP = 2
+
+
+def extract_intervals_and_durations(midi_file_path, use_cache: bool = True, reader: str = "music21") -> dict:
     """
     Extract intervals and durations from a MIDI file.
+    The notes are read from the feature cache, the file is only parsed on a cache miss.
+    :param midi_file_path:
+    :param use_cache: read the notes from the feature cache
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
+    """
+    with trace_stage("parse"):
+        table = load_note_table(midi_file_path, use_cache, reader=reader)
+        offsets, measures, _, note_durations, note_pitches = get_events(table, "score_")
+        add_sizes(notes=len(offsets))
+    with trace_stage("extract", notes=len(offsets)):
+        pitches_with_intervals = get_intervals(offsets, measures, note_durations, note_pitches)
+        add_sizes(events=len(pitches_with_intervals))
+    return pitches_with_intervals
+
+
+def extract_onset_groups(midi_file_path, use_cache: bool = True, reader: str = "music21") -> OnsetGroups:
+    """
+    Extract the onsets of a MIDI file with their root, interval and duration, as arrays.
+    The same features as extract_intervals_and_durations, sorted by position, without a Python object per note.
+    :param midi_file_path:
+    :param use_cache: read the notes from the feature cache
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
+    :return: OnsetGroups
+    """
+    with trace_stage("parse"):
+        notes = NoteTable(load_note_table(midi_file_path, use_cache, reader=reader), "score_")
+        add_sizes(notes=len(notes))
+    with trace_stage("extract", notes=len(notes)):
+        groups = notes.group_onsets()
+        add_sizes(events=len(groups))
+    return groups
+
+
+def get_intervals(offsets: list, measures: list, note_durations: list, note_pitches: list) -> dict:
+    """
+    Group the notes by onset and compute the root and the interval with the previous onset
+    :param offsets: offset of each note in its measure
+    :param measures: measure number of each note
+    :param note_durations: duration of each note
+    :param note_pitches: MIDI pitches of each note
+    :return: dict of the pitches, root, interval and duration of each (measure, offset)
     """
-    midi_data = music21.converter.parse(midi_file_path)
     pitches = {}
-    for n in midi_data.recurse().notes:
-        if n.isNote:
-            if (n.measureNumber, n.offset) not in pitches:
-                pitches[(n.measureNumber, n.offset)] = {
-                    'pitch': {n.pitch.midi},
-                    'duration': n.duration.quarterLength
-                }
-            else:
-                pitches[(n.measureNumber, n.offset)]['pitch'].add(n.pitch.midi)
-        elif n.isChord:
-            if (n.measureNumber, n.offset) not in pitches:
-                pitches[(n.measureNumber, n.offset)] = {
-                    'pitch': {p.midi for p in n.pitches},
-                    'duration': n.duration.quarterLength
-                }
-            else:
-                pitches[(n.measureNumber, n.offset)]['pitch'].update({p.midi for p in n.pitches})
+    for measure_number, offset, duration, midi_pitches in zip(measures, offsets, note_durations, note_pitches):
+        if (measure_number, offset) not in pitches:
+            pitches[(measure_number, offset)] = {
+                'pitch': set(midi_pitches),
+                'duration': duration
+            }
+        else:
+            pitches[(measure_number, offset)]['pitch'].update(midi_pitches)
 
     # Calculate the interval (difference) between pitches
     pitches_with_intervals = {}
@@ -49,7 +98,109 @@ def extract_intervals_and_durations(midi_file_path) -> dict:
     return pitches_with_intervals
 
 
+def get_feature_sequences(data, keys) -> tuple[dict, list, list]:
+    """
+    Sort the data once and build the sequence of each feature.
+    A key can also be a tuple of features, e.g. ('interval', 'duration'), to build a joint feature.
+    :param data: dict from extract_intervals_and_durations
+    :param keys: the features to build
+    :return: dict of the sequence for each key, list of positions (measure, offset), list of durations
+    """
+    items = sorted(data.items())
+    positions = [position for position, _ in items]
+    durations = [value['duration'] for _, value in items]
+    sequences = {}
+    for key in keys:
+        if isinstance(key, tuple):
+            sequences[key] = [tuple(value[feature] for feature in key) for _, value in items]
+        else:
+            sequences[key] = [value[key] for _, value in items]
+    return sequences, positions, durations
+
+
+def find_repeating_sequences_multi(data, keys=FEATURES, min_duration: float = MIN_PATTERN_DURATION) -> dict:
+    """
+    Find the repeating sequences of several features in a single pass.
+    The sort, the positions and the suffix array are shared by all the features.
+    :param data: dict from extract_intervals_and_durations
+    :param keys: the features to use, a tuple of features is mined as a joint feature
+    :param min_duration: minimum total duration of a pattern in quarter length
+    :return: dict of the list of (pattern, positions) for each key
+    """
+    sequences, positions, durations = get_feature_sequences(data, keys)
+    repeats = find_maximal_repeats_multi([encode_sequence(sequences[key]) for key in keys], durations,
+                                         min_duration)
+    return {
+        key: [(tuple(sequences[key][starts[1]:starts[1] + length]), [positions[start] for start in starts])
+              for length, starts in key_repeats]
+        for key, key_repeats in zip(keys, repeats)
+    }
+
+
+def get_feature_codes(groups: OnsetGroups, keys=FEATURES) -> list:
+    """
+    Encode the features of the onsets as int codes, numbered as encode_sequence numbers the sequences
+    of get_feature_sequences
+    :param groups: OnsetGroups from extract_onset_groups
+    :param keys: the features to encode, a tuple of features is encoded as a joint feature
+    :return: list of np.ndarray of codes, one per key
+    """
+    codes = []
+    for key in keys:
+        if isinstance(key, tuple):
+            codes.append(encode_array(np.column_stack([groups.get_feature(feature) for feature in key])))
+        else:
+            codes.append(encode_array(groups.get_feature(key)))
+    return codes
+
+
+def find_repeat_positions(groups: OnsetGroups, keys=FEATURES, min_duration: float = MIN_PATTERN_DURATION) -> dict:
+    """
+    Find the positions of the repeating sequences of several features in a single pass.
+    The same positions, in the same order, as find_repeating_sequences_multi.
+    :param groups: OnsetGroups from extract_onset_groups
+    :param keys: the features to use, a tuple of features is mined as a joint feature
+    :param min_duration: minimum total duration of a pattern in quarter length
+    :return: dict of the list of the positions (measure, offset) of each pattern for each key
+    """
+    positions = groups.get_positions()
+    repeats = find_maximal_repeats_multi(get_feature_codes(groups, keys), groups.get_durations(), min_duration)
+    return {key: [[positions[start] for start in starts] for _, starts in key_repeats]
+            for key, key_repeats in zip(keys, repeats)}
+
+
+def find_approximate_repeat_positions(groups: OnsetGroups, keys=APPROXIMATE_FEATURES,
+                                     min_duration: float = MIN_PATTERN_DURATION) -> dict:
+    """
+    Find the positions of the approximate repeats of several features, see approximate_repeats.
+    :param groups: OnsetGroups from extract_onset_groups
+    :param keys: the features to use, a tuple of features is mined as a joint feature
+    :param min_duration: minimum total duration of a pattern in quarter length
+    :return: dict of the list of the positions (measure, offset) of the two occurrences of each repeat for each key
+    """
+    positions = groups.get_positions()
+    durations = groups.get_durations()
+    return {key: [[positions[start] for start in starts]
+                  for _, starts in find_approximate_repeats(codes, durations, min_duration)]
+            for key, codes in zip(keys, get_feature_codes(groups, keys))}
+
+
 def find_repeating_sequences(data, key):
+    """
+    Find the repeating sequences of a feature with a suffix array.
+    Returns the same patterns, in the same order, as find_repeating_sequences_naive.
+    :param data: dict from extract_intervals_and_durations
+    :param key: the feature to use ('interval', 'root' or 'duration')
+    :return: list of (pattern, positions)
+    """
+    return find_repeating_sequences_multi(data, (key,))[key]
+
+
+def find_repeating_sequences_naive(data, key):
+    """
+    Exhaustive search of the repeating sequences, trying every (start, length) pair.
+    Kept as the reference for find_repeating_sequences.
+    """
     sequence = []
     positions = []
     durations = []
@@ -105,98 +256,273 @@ def find_repeating_sequences(data, key):
     return filtered_patterns
 
 
-def get_boundaries(midi_file_path):
+def merge_boundaries(boundaries: list, merge_gap: int = MERGE_GAP) -> list[int]:
     """
-    Get boundaries for repeating patterns in a MIDI file.
-    :param midi_file_path:
-    :return:
+    Merge the start positions of the patterns into measure boundaries at least merge_gap measures apart.
+    :param boundaries: list of positions (measure, offset)
+    :param merge_gap: minimum number of measures between two boundaries
+    :return: sorted list of measure numbers
     """
-    data = extract_intervals_and_durations(midi_file_path)
-    repeating_intervals = find_repeating_sequences(data, 'interval')
-    repeating_root = find_repeating_sequences(data, 'root')
-    repeating_durations = find_repeating_sequences(data, 'duration')
-    boundaries = []
-    for pattern, start_pos in repeating_intervals:
-        boundaries.extend(start_pos)
-    for pattern, start_pos in repeating_root:
-        boundaries.extend(start_pos)
-    for pattern, start_pos in repeating_durations:
-        boundaries.extend(start_pos)
     boundaries = list(set(boundaries))
     boundary_results = set()
     for (measure, offset) in boundaries:
         for result in boundary_results:
-            if abs(result - measure) < 2:
+            if abs(result - measure) < merge_gap:
                 break
         else:
             boundary_results.add(measure)
     return sorted(boundary_results)
 
 
-def list_midi_files(base_path):
+def get_boundaries(midi_file_path, reader: str = "music21", use_cache: bool = True,
+                   min_duration: float = MIN_PATTERN_DURATION, merge_gap: int = MERGE_GAP, approximate: bool = False):
+    """
+    Get boundaries for repeating patterns in a MIDI file.
+    The result is reused from the result cache while the file, the parameters and the detector are unchanged.
+    :param midi_file_path:
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
+    :param use_cache: read and store the result in the result cache
+    :param min_duration: minimum total duration of a pattern in quarter length
+    :param merge_gap: minimum number of measures between two boundaries
+    :param approximate: use the approximate repeats of APPROXIMATE_FEATURES instead of the exact repeats
+    :return:
+    """
+    parameters = get_boundaries_parameters(reader, min_duration, merge_gap, approximate)
+    return get_cached_result("boundaries", [midi_file_path], parameters,
+                             lambda: compute_boundaries(midi_file_path, reader, min_duration, merge_gap, approximate),
+                             use_cache)
+
+
+def get_boundaries_parameters(reader: str = "music21", min_duration: float = MIN_PATTERN_DURATION,
+                              merge_gap: int = MERGE_GAP, approximate: bool = False) -> dict:
+    """
+    :return: the parameters of get_boundaries in the key of its result in the result cache
+    """
+    return {"reader": reader, "min_duration": min_duration, "merge_gap": merge_gap, "approximate": approximate}
+
+
+def compute_boundaries(midi_file_path, reader: str = "music21", min_duration: float = MIN_PATTERN_DURATION,
+                       merge_gap: int = MERGE_GAP, approximate: bool = False) -> list[int]:
+    """
+    Detect the boundaries for repeating patterns in a MIDI file, without the result cache.
+    :param midi_file_path:
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
+    :param min_duration: minimum total duration of a pattern in quarter length
+    :param merge_gap: minimum number of measures between two boundaries
+    :param approximate: use the approximate repeats of APPROXIMATE_FEATURES instead of the exact repeats
+    :return:
+    """
+    groups = extract_onset_groups(midi_file_path, reader=reader)
+    with trace_stage("mine", events=len(groups)):
+        if approximate:
+            repeating = find_approximate_repeat_positions(groups, APPROXIMATE_FEATURES, min_duration)
+        else:
+            repeating = find_repeat_positions(groups, FEATURES, min_duration)
+        add_sizes(**{f"{key}_patterns": len(repeating[key]) for key in repeating})
+    with trace_stage("merge"):
+        boundaries = []
+        for key in repeating:
+            for start_pos in repeating[key]:
+                boundaries.extend(start_pos)
+        merged = merge_boundaries(boundaries, merge_gap)
+        add_sizes(positions=len(boundaries), boundaries=len(merged))
+    return merged
+
+
+def get_boundaries_per_feature(midi_file_path, joint_features: tuple = (), reader: str = "music21") -> dict:
+    """
+    Get the boundaries of each feature for repeating patterns in a MIDI file, in a single mining pass.
+    :param midi_file_path:
+    :param joint_features: tuples of features to mine together, e.g. (('interval', 'duration'),)
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
+    :return: dict of the boundaries for each feature
+    """
+    groups = extract_onset_groups(midi_file_path, reader=reader)
+    keys = FEATURES + tuple(joint_features)
+    repeating = find_repeat_positions(groups, keys)
+    return {key: merge_boundaries([position for start_pos in repeating[key] for position in start_pos])
+            for key in keys}
+
+
+def check_repeating_sequences(midi_file_path) -> bool:
+    """
+    Check that find_repeating_sequences and find_repeat_positions give the same output as the exhaustive search
+    for a piece.
+    :param midi_file_path:
+    :return: True if the outputs are equal for every feature
+    """
+    data = extract_intervals_and_durations(midi_file_path)
+    repeating = find_repeating_sequences_multi(data, FEATURES)
+    positions = find_repeat_positions(extract_onset_groups(midi_file_path), FEATURES)
+    return all(repeating[key] == find_repeating_sequences_naive(data, key)
+               and positions[key] == [start_pos for _, start_pos in repeating[key]] for key in FEATURES)
+
+
+def list_midi_files(base_path, manifest: dict = None):
     """
     List all MIDI files in a directory and its subdirectories.
     :param base_path:
+    :param manifest: manifest of the dataset, from load_manifest(base_path) by default
     :return:
     """
-    midi_paths = []
-    # Specify exact filenames to search for
-    target_files = ['midi_score.mid', 'midi_score.midi']
-    for root, dirs, files in os.walk(base_path):
-        for file in files:
-            if file in target_files:
-                midi_paths.append(os.path.join(root, file).replace('\\', '/'))
-    return midi_paths
+    manifest = load_manifest(base_path) if manifest is None else manifest
+    return list_score_midis(manifest, base_path)
 
 
-def get_number_of_measures(midi_file_path):
+def get_number_of_measures(midi_file_path, use_cache: bool = True, reader: str = "music21"):
     """
     Get the number of measures in a MIDI file.
     :param midi_file_path:
+    :param use_cache: read the number of measures from the feature cache
+    :param reader: "music21" or "native" for the lightweight reader of midi_reader
     :return:
     """
-    midi_data = music21.converter.parse(midi_file_path)
-    return len(midi_data.parts[0].getElementsByClass('Measure'))
+    with trace_stage("measure_count"):
+        return int(load_note_table(midi_file_path, use_cache, reader=reader)["nb_measures"])
+
+
+def analyse_midi_file(midi_file, approximate: bool = False) -> dict:
+    """
+    Get the boundaries and the number of measures of one piece.
+    :param midi_file: path to the midi_score.mid of the piece
+    :param approximate: use the approximate repeats instead of the exact repeats
+    :return: dict
+    """
+    with trace_piece(midi_file):
+        boundaries = get_boundaries(midi_file, approximate=approximate)
+        nb_measures = get_number_of_measures(midi_file)
+    return {
+        'boundaries': boundaries,
+        "nb_boundaries": len(boundaries),
+        "nb_measures": nb_measures,
+        "approx_ratio": nb_measures / 8
+    }
+
+
+def prefetch_midi_file(midi_file, approximate: bool = False):
+    """
+    Read and parse the MIDI file of a piece ahead of its analysis, see preload_note_table.
+    Nothing is read when its boundaries are in the result cache.
+    :param midi_file: path to the midi_score.mid of the piece
+    :param approximate: use the approximate repeats instead of the exact repeats
+    :return: None
+    """
+    if not has_cached_result("boundaries", [midi_file], get_boundaries_parameters(approximate=approximate)):
+        preload_note_table(midi_file)
 
 
-def run_on_whole_dataset(base_path: str = '../asap-dataset/Bach') -> dict:
+def iter_on_whole_dataset(base_path: str = '../asap-dataset/Bach', workers: int = 1, chunksize: int = 1,
+                          progress=None, manifest: dict = None, approximate: bool = False,
+                          prefetch_depth: int = DEFAULT_PREFETCH_DEPTH, max_in_flight: int = None,
+                          ordered: bool = True, shard: tuple[int, int] = None):
+    """
+    Run the functions on the whole dataset, yielding the result of each piece as soon as it is done,
+    without keeping the results in memory.
+    The MIDI files of the next pieces are read and parsed in a thread while the current piece is mined.
+    :param base_path: path to the dataset
+    :param workers: number of worker processes, the results are the same as with 1
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, midi_file)
+    :param manifest: manifest of the dataset, from load_manifest(base_path) by default
+    :param approximate: use the approximate repeats instead of the exact repeats
+    :param prefetch_depth: number of pieces read and parsed ahead of the current one, 0 to not prefetch
+    :param max_in_flight: maximum number of chunks submitted to the workers and not yielded yet,
+    2 * workers by default
+    :param ordered: yield the pieces in the order of the dataset, if False as soon as they are done
+    :param shard: (index, count) from sharding.parse_shard, to run only the pieces of a shard
+    :return: generator of (midi_file, result of analyse_midi_file, error message), the result is None and the
+    error message is not None for the pieces that failed
+    """
+    midi_files = select_shard(list_midi_files(base_path, manifest), base_path, shard)
+    yield from map_pieces(partial(analyse_midi_file, approximate=approximate), midi_files, workers, chunksize, progress,
+                          prefetch=partial(prefetch_midi_file, approximate=approximate),
+                          prefetch_depth=prefetch_depth, max_in_flight=max_in_flight, ordered=ordered)
+
+
+def run_on_whole_dataset(base_path: str = '../asap-dataset/Bach', workers: int = 1, chunksize: int = 1,
+                         progress=None, manifest: dict = None, trace_path: str = None,
+                         trace_memory: bool = False, results_path: str = None, invalidate: bool = False,
+                         approximate: bool = False, shard: tuple[int, int] = None) -> dict:
     """
     Run the functions on the whole dataset.
     :param base_path: path to the dataset
+    :param workers: number of worker processes, the results are the same as with 1
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, midi_file)
+    :param manifest: manifest of the dataset, from load_manifest(base_path) by default
+    :param trace_path: if given, record the stages of every piece in this JSON Lines file and print a summary
+    :param trace_memory: also record the peak memory of the stages, which slows them down
+    :param results_path: if given, write a row per piece in this ResultsStore as the pieces are done, in batches
+    of RUNNER_BATCH_SIZE rows, and compact it at the end
+    :param invalidate: remove every result of the result cache first, so that all the pieces are recomputed
+    :param approximate: use the approximate repeats instead of the exact repeats
+    :param shard: (index, count) from sharding.parse_shard, to run only the pieces of a shard
     :return results: dict
     """
-    midi_files = list_midi_files(base_path)
+    midi_files = select_shard(list_midi_files(base_path, manifest), base_path, shard)
     results = {}
-    for midi_file in midi_files:
-        try:
-            boundaries = get_boundaries(midi_file)
+    nb_reused = nb_computed = 0
+    if invalidate:
+        invalidate_results()
+    store = None
+    if results_path is not None:
+        store = ResultsStore(results_path, C3_COLUMNS, RUNNER_BATCH_SIZE)
+        store.clear()
+    if trace_path is not None:
+        open(trace_path, "w").close()
+        enable_tracing(trace_path, trace_memory)
+    analyse = partial(count_reuse, partial(analyse_midi_file, approximate=approximate))
+    try:
+        prefetch = partial(prefetch_midi_file, approximate=approximate)
+        for midi_file, counted_result, error in map_pieces(analyse, midi_files, workers, chunksize, progress,
+                                                           prefetch=prefetch):
+            if error is not None:
+                print(f"Error for {midi_file}: {error}")
+                if store is not None:
+                    store.append({"piece": midi_file, "error": error})
+                continue
             print(f"MIDI File: {midi_file}")
-            nb_measures = get_number_of_measures(midi_file)
-            results[midi_file] = {
-                'boundaries': boundaries,
-                "nb_boundaries": len(boundaries),
-                "nb_measures": nb_measures,
-                "approx_ratio": nb_measures / 8
-            }
-        except Exception as e:
-            print(f"Error for {midi_file}: {e}")
-    print("AVERAGE RATIO:",
-          sum([value["nb_boundaries"] / value['approx_ratio'] for value in results.values()]) / len(results))
+            result, reused, computed = counted_result
+            nb_reused, nb_computed = nb_reused + reused, nb_computed + computed
+            results[midi_file] = result
+            if store is not None:
+                store.append(dict(result, piece=midi_file))
+    finally:
+        if trace_path is not None:
+            disable_tracing()
+        if store is not None:
+            store.flush()
+    if store is not None:
+        store.compact()
+    if trace_path is not None:
+        print(summarize_trace(load_trace(trace_path)))
+    print(f"Reused {nb_reused} of {nb_reused + nb_computed} results")
+    if results:
+        print("AVERAGE RATIO:",
+              sum([value["nb_boundaries"] / value['approx_ratio'] for value in results.values()]) / len(results))
     return results
 
 
-def plot_results(results: dict):
+def plot_results(results: dict or ResultsStore, output_path: str = None):
     """
     Plot the results as a line chart with the number of boundaries for each piece and the approximate ratio.
-    :param results:
+    :param results: dict from run_on_whole_dataset, or the ResultsStore of its results_path
+    :param output_path: write the figure in this file instead of showing it
     :return:
     """
     import matplotlib.pyplot as plt
     import seaborn as sns
+    from src.figure_renderer import show_or_save
+    if isinstance(results, ResultsStore):
+        frame = results.load(["approx_ratio", "nb_boundaries"], errors=False)
+        approx_ratios, nb_boundaries = frame["approx_ratio"].tolist(), frame["nb_boundaries"].tolist()
+    else:
+        approx_ratios = [value["approx_ratio"] for value in results.values()]
+        nb_boundaries = [value["nb_boundaries"] for value in results.values()]
     sns.set_theme()
     fig, ax = plt.subplots()
-    ax.plot([value["approx_ratio"] for value in results.values()], label='Approximate Ratio', linewidth=0.8)
-    ax.plot([value["nb_boundaries"] for value in results.values()], label='Number of Boundaries', linewidth=0.8)
+    ax.plot(approx_ratios, label='Approximate Ratio', linewidth=0.8)
+    ax.plot(nb_boundaries, label='Number of Boundaries', linewidth=0.8)
     ax.set(xlabel='Piece', ylabel='Value',
            title='Number of Boundaries vs Approximate Ratio')
-    plt.show()
+    show_or_save(fig, output_path)
@@ -1,38 +1,185 @@
-import os
+from functools import partial
 
-from src.task_c1 import get_number_of_phrases_detected
+from src.annotation_corpus import dataset_corpus, get_active_corpus
+from src.feature_cache import preload_note_table
+from src.instrumentation import add_sizes, disable_tracing, enable_tracing, load_trace, summarize_trace, \
+    trace_piece, trace_stage
+from src.manifest import list_pieces, load_manifest
+from src.parallel import DEFAULT_PREFETCH_DEPTH, map_pieces
+from src.result_cache import count_reuse, has_cached_result, invalidate_results
+from src.results_store import C1_COLUMNS, MEASURE_COLUMNS, RUNNER_BATCH_SIZE, ResultsStore
+from src.sharding import select_shard
+from src.task_c1 import get_number_of_phrases_detected, get_number_of_phrases_key
 
 
-def run_c1_whole_dataset(folder_path: str = "asap-dataset/"):
+def iter_c1_whole_dataset(folder_path: str = "asap-dataset/", workers: int = 1, chunksize: int = 1, progress=None,
+                          manifest: dict = None, use_corpus: bool = True,
+                          prefetch_depth: int = DEFAULT_PREFETCH_DEPTH, max_in_flight: int = None,
+                          ordered: bool = True, shard: tuple[int, int] = None):
+    """
+    Run task C1 for the whole dataset, yielding the result of each piece as soon as it is done,
+    without keeping the results in memory.
+    The performance MIDI files of the next pieces are read and parsed in a thread while the current piece is
+    analysed.
+    :param folder_path: path to the dataset
+    :param workers: number of worker processes, the results are the same as with 1
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, (path, midi_path))
+    :param manifest: manifest of the dataset, from load_manifest(folder_path) by default
+    :param use_corpus: read the annotations from the compiled annotation corpus of the dataset, if it was compiled,
+    unless a corpus is enabled already, see annotation_corpus.dataset_corpus
+    :param prefetch_depth: number of pieces read and parsed ahead of the current one, 0 to not prefetch
+    :param max_in_flight: maximum number of chunks submitted to the workers and not yielded yet,
+    2 * workers by default
+    :param ordered: yield the pieces in the order of the dataset, if False as soon as they are done
+    :param shard: (index, count) from sharding.parse_shard, to run only the pieces of a shard
+    :return: generator of (piece, result of analyse_piece, error message), the result is None and the
+    error message is not None for the pieces that failed
+    """
+    manifest = load_manifest(folder_path) if manifest is None else manifest
+    with dataset_corpus(folder_path, use_corpus):
+        pieces = select_shard(list_pieces(manifest, folder_path), folder_path, shard, key=lambda piece: piece[0])
+        for (path, _), result, error in map_pieces(analyse_piece, pieces, workers, chunksize, progress,
+                                                   prefetch=prefetch_piece, prefetch_depth=prefetch_depth,
+                                                   max_in_flight=max_in_flight, ordered=ordered):
+            yield path.replace("asap-dataset/", ""), result, error
+
+
+def run_c1_whole_dataset(folder_path: str = "asap-dataset/", workers: int = 1, chunksize: int = 1, progress=None,
+                         manifest: dict = None, trace_path: str = None, trace_memory: bool = False,
+                         results_path: str = None, invalidate: bool = False, use_corpus: bool = True,
+                         shard: tuple[int, int] = None):
     """
     Run task C1 for the whole dataset
     :param folder_path: path to the dataset
+    :param workers: number of worker processes, the results are the same as with 1
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, (path, midi_path))
+    :param manifest: manifest of the dataset, from load_manifest(folder_path) by default
+    :param trace_path: if given, record the stages of every piece in this JSON Lines file and print a summary
+    :param trace_memory: also record the peak memory of the stages, which slows them down
+    :param results_path: if given, write a row per piece in this ResultsStore as the pieces are done, in batches
+    of RUNNER_BATCH_SIZE rows, with the error message of the pieces that failed, and compact it at the end
+    :param invalidate: remove every result of the result cache first, so that all the pieces are recomputed
+    :param use_corpus: read the annotations from the compiled annotation corpus of the dataset, if it was compiled,
+    unless a corpus is enabled already, see annotation_corpus.dataset_corpus
+    :param shard: (index, count) from sharding.parse_shard, to run only the pieces of a shard
     :return: a dictionary with the number of phrases detected for each piece
     """
-    paths = []
-    for root, dirs, files in os.walk(folder_path):
-        if root in paths:
-            continue
-        for file in files:
-            if file.endswith("midi_score_annotations.txt"):
-                paths.append(root.replace("\\", "/"))
-                break
+    manifest = load_manifest(folder_path) if manifest is None else manifest
+    results = {}
+    nb_reused = nb_computed = 0
+    if invalidate:
+        invalidate_results()
+    store = None
+    if results_path is not None:
+        store = ResultsStore(results_path, C1_COLUMNS, RUNNER_BATCH_SIZE)
+        store.clear()
+    if trace_path is not None:
+        open(trace_path, "w").close()
+        enable_tracing(trace_path, trace_memory)
+    try:
+        with dataset_corpus(folder_path, use_corpus):
+            pieces = select_shard(list_pieces(manifest, folder_path), folder_path, shard, key=lambda piece: piece[0])
+            for (path, _), counted_result, error in map_pieces(partial(count_reuse, analyse_piece), pieces, workers,
+                                                               chunksize, progress, prefetch=prefetch_piece):
+                piece = path.replace("asap-dataset/", "")
+                if error is not None:
+                    print(f"Error for {path}: {error}")
+                    results[piece] = "Error"
+                    if store is not None:
+                        store.append({"piece": piece, "error": error})
+                else:
+                    result, reused, computed = counted_result
+                    nb_reused, nb_computed = nb_reused + reused, nb_computed + computed
+                    results[piece] = result
+                    if store is not None:
+                        store.append(dict(result, piece=piece))
+    finally:
+        if trace_path is not None:
+            disable_tracing()
+        if store is not None:
+            store.flush()
+    if store is not None:
+        store.compact()
+    if trace_path is not None:
+        print(summarize_trace(load_trace(trace_path)))
+    print(f"Reused {nb_reused} of {nb_reused + nb_computed} results")
+    return results
+
+
+def count_measures_whole_dataset(folder_path: str = "asap-dataset/", workers: int = 1, chunksize: int = 1,
+                                 progress=None, manifest: dict = None, results_path: str = None,
+                                 use_corpus: bool = True, shard: tuple[int, int] = None) -> dict:
+    """
+    Count the measures of every piece from its score annotations, without reading the MIDI files
+    :param folder_path: path to the dataset
+    :param workers: number of worker processes, the results are the same as with 1
+    :param chunksize: number of pieces sent to a worker at once
+    :param progress: optional callback progress(nb_done, nb_pieces, path)
+    :param manifest: manifest of the dataset, from load_manifest(folder_path) by default
+    :param results_path: if given, write a row per piece in this ResultsStore as the pieces are done, in batches
+    of RUNNER_BATCH_SIZE rows, and compact it at the end
+    :param use_corpus: count the downbeats in the compiled annotation corpus of the dataset, if it was compiled,
+    unless a corpus is enabled already, see annotation_corpus.dataset_corpus
+    :param shard: (index, count) from sharding.parse_shard, to run only the pieces of a shard
+    :return: a dictionary with the number of measures of each piece, "Error" for the pieces that failed
+    """
+    manifest = load_manifest(folder_path) if manifest is None else manifest
     results = {}
-    for path in paths:
-        try:
-            nb_measures = get_number_of_measures(path)
-            nb_phrases = get_number_of_phrases_detected(path)
-            results[path.replace("asap-dataset/", "")] = {
-                "nb_phrases": nb_phrases,
-                "nb_measures": nb_measures,
-                "approx_ratio": nb_measures / 8
-            }
-        except Exception as e:
-            print(f"Error for {path}: {e}")
-            results[path.replace("asap-dataset/", "")] = "Error"
+    store = None
+    if results_path is not None:
+        store = ResultsStore(results_path, MEASURE_COLUMNS, RUNNER_BATCH_SIZE)
+        store.clear()
+    try:
+        with dataset_corpus(folder_path, use_corpus):
+            paths = select_shard([path for path, _ in list_pieces(manifest, folder_path)], folder_path, shard)
+            for path, nb_measures, error in map_pieces(get_number_of_measures, paths, workers, chunksize, progress):
+                piece = path.replace("asap-dataset/", "")
+                if error is not None:
+                    print(f"Error for {path}: {error}")
+                    results[piece] = "Error"
+                else:
+                    results[piece] = nb_measures
+                if store is not None:
+                    store.append({"piece": piece, "nb_measures": nb_measures, "error": error})
+    finally:
+        if store is not None:
+            store.flush()
+    if store is not None:
+        store.compact()
     return results
 
 
+def prefetch_piece(piece: tuple[str, str]):
+    """
+    Read and parse the performance MIDI of a piece ahead of its analysis, see preload_note_table.
+    Nothing is read when its number of phrases is in the result cache.
+    :param piece: path to the piece folder and path to its performance MIDI, from list_pieces
+    :return: None
+    """
+    path, midi_path = piece
+    if midi_path and not has_cached_result("number_of_phrases", *get_number_of_phrases_key(path, midi_path)):
+        preload_note_table(midi_path)
+
+
+def analyse_piece(piece: tuple[str, str]) -> dict:
+    """
+    Run task C1 for one piece
+    :param piece: path to the piece folder and path to its performance MIDI, from list_pieces
+    :return: dict
+    """
+    path, midi_path = piece
+    with trace_piece(path):
+        nb_measures = get_number_of_measures(path)
+        nb_phrases = get_number_of_phrases_detected(path, midi_path=midi_path)
+    return {
+        "nb_phrases": nb_phrases,
+        "nb_measures": nb_measures,
+        "approx_ratio": nb_measures / 8
+    }
+
+
 def get_number_of_measures(folder_path: str):
     """
     Get the number of measures for a piece
@@ -40,10 +187,18 @@ def get_number_of_measures(folder_path: str):
     :return: int
     """
     file = folder_path + "/midi_score_annotations.txt"
-    count = 0
-    with open(file, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            if "db" in line:
-                count += 1
+    with trace_stage("measure_count"):
+        # The downbeats of the compiled annotation corpus, when the file did not change since its compilation
+        corpus = get_active_corpus()
+        count = corpus.count_downbeats(file) if corpus is not None else None
+        if count is not None:
+            add_sizes(measures=count)
+            return count
+        count = 0
+        with open(file, "r") as f:
+            lines = f.readlines()
+            for line in lines:
+                if "db" in line:
+                    count += 1
+        add_sizes(beats=len(lines), measures=count)
     return count
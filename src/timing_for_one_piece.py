@@ -7,75 +7,46 @@ From ASSIGNMENT 1 - Task A
 """
 
 import os
+from collections.abc import Mapping
 
+import numpy as np
 
-def get_performed_attributes(performed_path: str) -> dict:
+from src.annotations import PerformedAttributesView, SymbolicAttributesView, SymbolicToPerformedView, \
+    load_annotations
+
+
+def get_performed_attributes(performed_path: str) -> Mapping:
     """
     Get the performed attributes for each beat
+    The dict is a read-only view over the columnar BeatAnnotations, with the onsets as floats
     :param performed_path: path to the annotation file with the performed times
     :return: dict of the performed attributes for each beat
     """
-    result_performed = {}
-    with open(performed_path, "r") as f:
-        performed_data = f.readlines()
-        current_key = None
-        current_meter = None
-        current_beat = 0
-        for line in performed_data:
-            line_data = line.split()
-            beat_key_meter = line_data[2].split(',')
-            beat_type = beat_key_meter[0]
-            if len(beat_key_meter) == 3:
-                current_meter = beat_key_meter[1]
-                current_key = beat_key_meter[2]
-            elif len(beat_key_meter) == 2:
-                current_meter = beat_key_meter[1]
-
-            result_performed[current_beat] = {
-                "key": current_key,
-                "meter": current_meter,
-                "onset": line_data[0],
-                "beat_type": beat_type
-            }
-            current_beat += 1
-    return result_performed
-
-
-def get_symbolic_attributes(symbolic_path: str) -> dict:
+    return PerformedAttributesView(load_annotations(performed_path))
+
+
+def get_symbolic_attributes(symbolic_path: str) -> Mapping:
     """
     Get the symbolic attributes for each beat
+    The dict is a read-only view over the columnar BeatAnnotations, with the onsets as floats
     :param symbolic_path: path to the annotation file with the symbolic times
     :return: dict of the symbolic attributes for each beat
     """
-    result_symbolic = {}
-    with open(symbolic_path, "r") as f:
-        unperformed_data = f.readlines()
-        current_beat = 0
-        for line in unperformed_data:
-            line_data = line.split()
-            result_symbolic[current_beat] = {
-                "onset": line_data[0],
-            }
-            current_beat += 1
-    return result_symbolic
-
-
-def get_piece_symbolic_to_performed_times(symbolic_path: str, performed_path: str) -> dict:
+    return SymbolicAttributesView(load_annotations(symbolic_path))
+
+
+def get_piece_symbolic_to_performed_times(symbolic_path: str, performed_path: str) -> Mapping:
     """
     Get the symbolic and performed times for a piece
     :param symbolic_path:  path to the annotation file with the symbolic times
     :param performed_path: path to the annotation file with the performed times
     :return: a dict containing the symbolic and performed times for each beat, with their meter, key and beat type
     """
-    result_performed = get_performed_attributes(performed_path)
-    result_symbolic = get_symbolic_attributes(symbolic_path)
-    result = {}
-    for key in result_performed:
-        result[key] = {
-            "symbolic": result_symbolic[key],
-            "performed": result_performed[key]
-        }
-    return result
+    performed = load_annotations(performed_path)
+    symbolic = load_annotations(symbolic_path)
+    if len(symbolic) < len(performed):
+        raise KeyError(len(symbolic))
+    return SymbolicToPerformedView(symbolic.onsets[:len(performed)], performed.onsets, performed)
 
 
 def get_tempo_map(symbolic_to_performed_times: dict) -> dict:
@@ -99,48 +70,64 @@ def get_tempo_map(symbolic_to_performed_times: dict) -> dict:
     return result
 
 
-def get_average_timing_one_piece(folder_path: str) -> dict or None:
+def get_average_timing_one_piece(folder_path: str) -> Mapping or None:
     """
     Get the attributes for each beat for a piece where the piece can have
     multiple performances
     :param folder_path: the path to the piece folder
     :return: dict
     """
+    average = get_average_timing_statistics(folder_path)
+    if average is None:
+        return
+    return average[0]
+
+
+def get_average_timing_statistics(folder_path: str) -> tuple[Mapping, dict] or None:
+    """
+    Average the performed onsets of each beat over all the performances of a piece.
+    The performances are stacked in a 2D array where the beats missing from a shorter performance are masked,
+    so each beat is averaged over the performances that have it.
+    :param folder_path: the path to the piece folder
+    :return: the dict of get_average_timing_one_piece, and a dict of arrays with the "mean", "median", "std"
+    and "count" (number of performances) of the performed onset of each beat
+    """
     files = [file for file in os.listdir(folder_path) if file.endswith("annotations.txt")]
     files.remove("midi_score_annotations.txt")
     if len(files) == 0:
         print("No annotation files found")
         return
     if len(files) == 1:
-        return get_piece_symbolic_to_performed_times(folder_path + "/midi_score_annotations.txt",
-                                                     folder_path + "/" + files[0])
+        average = get_piece_symbolic_to_performed_times(folder_path + "/midi_score_annotations.txt",
+                                                        folder_path + "/" + files[0])
+        onsets = average.performed_onsets
+        return average, {
+            "mean": onsets,
+            "median": onsets,
+            "std": np.zeros(len(onsets)),
+            "count": np.ones(len(onsets), dtype=np.int64)
+        }
 
     # Case multiple files :
     # Get the symbolic times only once
-    symbolic_times = get_symbolic_attributes(folder_path + "/midi_score_annotations.txt")
-    performed_list = []
-    for file in files:
-        performed_list.append(get_performed_attributes(folder_path + "/" + file))
-
-    # Average the onsets for each beat for performed times
-    avg_performed = {}
-    for i in range(len(symbolic_times)):
-        onset_sum = 0
-        for performed in performed_list:
-            if i not in performed:
-                continue
-            onset_sum += float(performed[i]["onset"])
-        avg_performed[i] = onset_sum / len(performed_list)
-
-    result = {}
-    for key in symbolic_times:
-        result[key] = {
-            "symbolic": symbolic_times[key],
-            "performed": {
-                "onset": avg_performed[key],
-                "key": performed_list[0][key]["key"],
-                "meter": performed_list[0][key]["meter"],
-                "beat_type": performed_list[0][key]["beat_type"]
-            }
-        }
-    return result
+    symbolic = load_annotations(folder_path + "/midi_score_annotations.txt")
+    performed_list = [load_annotations(folder_path + "/" + file) for file in files]
+    # The meter, key and beat types are the ones of the first performance
+    if len(performed_list[0]) < len(symbolic):
+        raise KeyError(len(performed_list[0]))
+
+    nb_beats = len(symbolic)
+    onsets = np.full((len(performed_list), nb_beats), np.nan)
+    for k, performed in enumerate(performed_list):
+        length = min(len(performed), nb_beats)
+        onsets[k, :length] = performed.onsets[:length]
+    missing = np.isnan(onsets)
+    count = (~missing).sum(axis=0)
+    mean = np.where(missing, 0.0, onsets).sum(axis=0) / count
+    statistics = {
+        "mean": mean,
+        "median": np.nanmedian(onsets, axis=0),
+        "std": np.sqrt(np.where(missing, 0.0, (onsets - mean) ** 2).sum(axis=0) / count),
+        "count": count
+    }
+    return SymbolicToPerformedView(symbolic.onsets, mean, performed_list[0]), statistics
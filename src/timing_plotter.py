@@ -8,19 +8,23 @@ This module contains functions used to plot the results for Task A.
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from src.figure_renderer import add_boundary_lines, decimate_min_max, get_nb_pixels, show_or_save
 
-def plot_timing_for_one_piece(tempo_map: dict, boundaries:list[int]):
+
+def plot_timing_for_one_piece(tempo_map: dict, boundaries: list[int], output_path: str = None):
     """
     Plot the tempo curve from the dict of tempo ratios (for one piece) with each beat as x-axis
+    The curve is decimated to the width of the figure and the boundaries are drawn as a single collection.
     :param tempo_map: dict
+    :param boundaries: beats of the boundaries
+    :param output_path: write the figure in this file instead of showing it
     :return: None
     """
     fig, ax = plt.subplots()
-    ax.plot(list(tempo_map.keys()), list(tempo_map.values()), linewidth=0.8)
+    ax.plot(*decimate_min_max(list(tempo_map.keys()), list(tempo_map.values()), get_nb_pixels(fig)), linewidth=0.8)
     # Plot boundaries as vertical lines
-    for boundary in boundaries:
-        ax.axvline(x=boundary, color='r', linestyle='--', linewidth=0.5)
+    add_boundary_lines(ax, boundaries, color='r', linestyle='--', linewidth=0.5)
     ax.set(xlabel='Beats', ylabel='Tempo Ratio',
            title='Tempo curve')
-    plt.grid(True)
-    plt.show()
\ No newline at end of file
+    ax.grid(True)
+    show_or_save(fig, output_path)
\ No newline at end of file